@@ -4,21 +4,18 @@
 
 import sys
 import argparse
-from astropy.time import Time
-from barycorrpy import utc_tdb
 import remdefaults
-
-La_Silla_lat = -70.7380
-La_Silla_long = -29.2563
-La_Silla_alt = 2400
+import baryconv
 
 HIPs = {"ProximaCenb": 70890, "BarnardStar": 87937, "Ross154": 92403}
 
 parsearg = argparse.ArgumentParser(description='Calculate Barycentric dates of targets', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parsearg.add_argument('--listn', type=int, default=10, help="List progress every n")
+parsearg.add_argument('--perrow', action='store_true', help="Convert dates one at a time rather than all for each target at once")
 remdefaults.parseargs(parsearg, libdir=False, tempdir=False)
 resargs = vars(parsearg.parse_args())
 countevery = resargs['listn']
+perrow = resargs['perrow']
 remdefaults.getargs(resargs)
 
 mydb, mycurs = remdefaults.opendb()
@@ -35,13 +32,28 @@ if  ToDo == 0:
 Todopc = 100.0 / ToDo
 Done = 0
 
+# Group by target so we can do all the dates for each target in one call
+
+bytarget = dict()
 for obsind, date_obs, objname in rows:
-    bjdresult = utc_tdb.JDUTC_to_BJDTDB(Time(date_obs), hip_id=HIPs[objname], lat=La_Silla_lat, longi=La_Silla_long, alt=La_Silla_alt)[0][0]
-    mycurs.execute(f"UPDATE obsinf SET bjdobs={bjdresult:.12e} WHERE obsind={obsind}")
-    Done += 1
-    if countevery > 0 and Done % countevery == 0:
-        mydb.commit()
-        print(f"Done {Done} out of {ToDo} {Done * Todopc:.2f}%", file=sys.stderr)
+    bytarget.setdefault(objname, []).append((obsind, date_obs))
+
+pending = []
+for objname, obslist in bytarget.items():
+    bjdresults = baryconv.bjd_tdb([o[1] for o in obslist], HIPs[objname], perrow)
+
+    # Same precision as the values were always written with, committed every countevery as before
+
+    for (obsind, date_obs), bjd in zip(obslist, bjdresults):
+        pending.append((float(f"{bjd:.12e}"), obsind))
+        Done += 1
+        if countevery > 0 and Done % countevery == 0:
+            mycurs.executemany("UPDATE obsinf SET bjdobs=%s WHERE obsind=%s", pending)
+            mydb.commit()
+            pending = []
+            print(f"Done {Done} out of {ToDo} {Done * Todopc:.2f}%", file=sys.stderr)
 
+if len(pending) != 0:
+    mycurs.executemany("UPDATE obsinf SET bjdobs=%s WHERE obsind=%s", pending)
 mydb.commit()
 print("Update of BJDs complete", file=sys.stderr)
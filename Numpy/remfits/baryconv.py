@@ -0,0 +1,16 @@
+"""Conversion of UTC dates of observations at La Silla to barycentric Julian dates"""
+
+from astropy.time import Time
+from barycorrpy import utc_tdb
+
+La_Silla_lat = -70.7380
+La_Silla_long = -29.2563
+La_Silla_alt = 2400
+
+
+def bjd_tdb(dates, hip_id, perrow=False):
+    """Get BJD (TDB) for list of UTC dates of observations of the given HIP star, all in one
+    call unless perrow is set when they are done one at a time as previously"""
+    if perrow:
+        return [utc_tdb.JDUTC_to_BJDTDB(Time(d), hip_id=hip_id, lat=La_Silla_lat, longi=La_Silla_long, alt=La_Silla_alt)[0][0] for d in dates]
+    return list(utc_tdb.JDUTC_to_BJDTDB(Time(list(dates)), hip_id=hip_id, lat=La_Silla_lat, longi=La_Silla_long, alt=La_Silla_alt)[0])
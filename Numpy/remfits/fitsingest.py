@@ -0,0 +1,323 @@
+"""Fetch FITS files for observations concurrently into a spool directory ready to load into the database.
+
+Files are copied from the source by a pool of threads, as this is mostly waiting
+on the network or disk, into temporary files in the spool directory. Each one is
+then checked by a pool of processes, which decompress it and check it is a
+complete FITS file. The gzipped file as fetched is kept as it is rather than
+being decompressed and recompressed, files which came uncompressed are gzipped.
+At most prefetch files are being fetched or checked at once.
+
+Each file which passes is renamed to the obsind in the spool directory and
+recorded in a manifest file there, as is each file once it is loaded, so an
+interrupted run only fetches obsinds not already in the spool directory.
+
+The source is the remote archive, or a local directory with files in Ross and
+Remir subdirectories (or at the top level) under the same names as in the
+archive, which stands in for the archive for testing or loading files copied by
+other means."""
+
+import os
+import os.path
+import gzip
+import zlib
+import shutil
+import tempfile
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_SPOOLDIR = "~/.remfitsspool"
+MANIFEST_NAME = "manifest"
+SPOOL_SUFFIX = ".fits.gz"
+TMP_PREFIX = ".tmp"
+
+ARCHIVE_URL = "http://ross.iasfbo.inaf.it/RossDB/fits_retrieve.php?ffile=/"
+ARCHIVE_TIMEOUT = 300  # Seconds
+
+COPY_CHUNK = 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+NOT_FOUND = "FITS file not found"
+
+
+class IngestErr(Exception):
+    """Throw if we have problems fetching or spooling files"""
+
+
+def remdir(remir):
+    """Get archive directory for REMIR or ROSS files"""
+    if remir:
+        return "Remir"
+    return "Ross"
+
+
+class ArchiveSource:
+    """Fetch files from the remote archive"""
+
+    def __init__(self, url=ARCHIVE_URL, timeout=ARCHIVE_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def open(self, ffname, remir):
+        """Open file for reading from the archive"""
+        return urllib.request.urlopen(self.url + urllib.parse.quote(remdir(remir) + "/" + ffname), timeout=self.timeout)
+
+
+class LocalSource:
+    """Fetch files from a local directory laid out as the archive"""
+
+    def __init__(self, dirname):
+        self.dirname = os.path.expanduser(dirname)
+        if not os.path.isdir(self.dirname):
+            raise IngestErr("Source directory " + self.dirname + " not found")
+
+    def open(self, ffname, remir):
+        """Open file for reading from the subdirectory or the top level"""
+        fname = os.path.join(self.dirname, remdir(remir), ffname)
+        if not os.path.exists(fname):
+            fname = os.path.join(self.dirname, ffname)
+        return open(fname, "rb")
+
+
+def get_source(srcdir=None):
+    """Get local directory source if given, otherwise the archive"""
+    if srcdir is None:
+        return ArchiveSource()
+    return LocalSource(srcdir)
+
+
+def fetch_to_spool(source, spooldir, ffname, remir):
+    """Copy file from source to a temporary file in the spool directory.
+
+    Return name of temporary file"""
+    fd, tmpname = tempfile.mkstemp(dir=spooldir, prefix=TMP_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as fout, source.open(ffname, remir) as fin:
+            shutil.copyfileobj(fin, fout, COPY_CHUNK)
+    except OSError as e:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise IngestErr("Cannot fetch " + ffname + " error was " + str(e))
+    return tmpname
+
+
+def fits_problem(raw):
+    """Check raw contents of FITS file, returning reason why it is not a complete FITS file or None if it is"""
+    if raw[:1] == b"<" or len(raw) == 0:
+        return NOT_FOUND
+    if not raw.startswith(b"SIMPLE  ="):
+        return "Not a FITS file"
+    if len(raw) % FITS_BLOCK != 0:
+        return "FITS file truncated"
+
+    # Go through header cards until END picking up the dimensions
+
+    keys = dict()
+    hdrend = None
+    for pos in range(0, len(raw), FITS_CARD):
+        card = raw[pos:pos + FITS_CARD]
+        kw = card[:8].rstrip()
+        if kw == b"END":
+            hdrend = pos + FITS_CARD
+            break
+        if kw in (b"BITPIX", b"NAXIS") or kw.startswith(b"NAXIS"):
+            try:
+                keys[kw] = int(card[10:].split(b"/")[0])
+            except ValueError:
+                return "Invalid " + kw.decode() + " in FITS header"
+    if hdrend is None:
+        return "FITS header incomplete"
+    try:
+        datasize = abs(keys[b"BITPIX"]) // 8
+        naxis = keys[b"NAXIS"]
+        if naxis == 0:
+            datasize = 0
+        for n in range(1, naxis + 1):
+            datasize *= keys[b"NAXIS" + str(n).encode()]
+    except KeyError:
+        return "FITS header lacks dimensions"
+    hdrsize = -(-hdrend // FITS_BLOCK) * FITS_BLOCK
+    if hdrsize + datasize > len(raw):
+        return "FITS file truncated"
+    return None
+
+
+def check_spooled(tmpname, spoolname):
+    """Check fetched file, which may or may not be gzipped, rename it to spoolname if it is a valid FITS file,
+    gzipping it if need be, otherwise delete it. This is run in worker processes.
+
+    Return reason for rejection or None if OK"""
+    try:
+        with open(tmpname, "rb") as fin:
+            contents = fin.read()
+        iszipped = contents[:2] == GZIP_MAGIC
+        raw = contents
+        if iszipped:
+            try:
+                raw = gzip.decompress(contents)
+            except (OSError, EOFError, zlib.error):
+                os.unlink(tmpname)
+                return "Cannot decompress FITS file"
+        reason = fits_problem(raw)
+        if reason is not None:
+            os.unlink(tmpname)
+            return reason
+        if not iszipped:
+            with open(tmpname, "wb") as fout:
+                fout.write(gzip.compress(raw))
+        os.replace(tmpname, spoolname)
+    except OSError as e:
+        raise IngestErr("Cannot spool " + spoolname + " error was " + str(e))
+    return None
+
+
+class Manifest:
+    """Record of files fetched into the spool directory and loaded from it.
+
+    The manifest file has a line for each event giving the obsind and "fetched" with the
+    compressed size or "loaded" and is appended to as we go"""
+
+    def __init__(self, spooldir=DEFAULT_SPOOLDIR):
+        self.spooldir = os.path.expanduser(spooldir)
+        self.fname = os.path.join(self.spooldir, MANIFEST_NAME)
+        self.fetched = dict()
+        try:
+            os.makedirs(self.spooldir, exist_ok=True)
+            with os.scandir(self.spooldir) as it:
+                for ent in it:
+                    if ent.name.startswith(TMP_PREFIX):
+                        os.unlink(ent.path)
+        except OSError as e:
+            raise IngestErr("Cannot set up spool directory " + self.spooldir + " error was " + e.strerror)
+        try:
+            with open(self.fname) as fin:
+                for line in fin:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[1] == 'fetched':
+                        self.fetched[int(fields[0])] = int(fields[2])
+                    elif len(fields) == 2 and fields[1] == 'loaded':
+                        self.fetched.pop(int(fields[0]), None)
+                    else:
+                        raise ValueError(line)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            raise IngestErr("Manifest " + self.fname + " is not in expected format")
+        except OSError as e:
+            raise IngestErr("Cannot read manifest " + self.fname + " error was " + e.strerror)
+        for obsind in list(self.fetched):
+            if not os.path.exists(self.spool_file(obsind)):
+                del self.fetched[obsind]
+
+    def spool_file(self, obsind):
+        """Get name of spooled file for obsind"""
+        return os.path.join(self.spooldir, str(obsind) + SPOOL_SUFFIX)
+
+    def _append(self, lines):
+        """Append lines to manifest file"""
+        try:
+            with open(self.fname, "a") as fout:
+                fout.write("".join(lines))
+        except OSError as e:
+            raise IngestErr("Cannot update manifest " + self.fname + " error was " + e.strerror)
+
+    def record_fetched(self, obsind):
+        """Note file for obsind is in the spool directory"""
+        nbytes = os.path.getsize(self.spool_file(obsind))
+        self._append([f"{obsind} fetched {nbytes}\n"])
+        self.fetched[obsind] = nbytes
+
+    def record_loaded(self, obsinds, keep=False):
+        """Note files for obsinds are loaded into the database, deleting them unless keep set"""
+        self._append([f"{obsind} loaded\n" for obsind in obsinds])
+        for obsind in obsinds:
+            self.fetched.pop(obsind, None)
+            if not keep:
+                try:
+                    os.unlink(self.spool_file(obsind))
+                except FileNotFoundError:
+                    pass
+
+    def compact(self):
+        """Rewrite manifest with just the files fetched and not loaded"""
+        fd, tmpname = tempfile.mkstemp(dir=self.spooldir, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wt") as fout:
+                for obsind, nbytes in self.fetched.items():
+                    fout.write(f"{obsind} fetched {nbytes}\n")
+            os.replace(tmpname, self.fname)
+        except OSError as e:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise IngestErr("Cannot rewrite manifest " + self.fname + " error was " + e.strerror)
+
+
+def fetch_all(rows, source, manifest, nthreads=8, maxproc=4, prefetch=32):
+    """Get files for rows of (ffname, dithID, obsind) into the spool directory, fetching
+    only those not already there.
+
+    Yield row, rejection reason and error message as each one is ready, which are both None if the
+    file is ready to load from manifest.spool_file(obsind)"""
+
+    todo = []
+    for row in rows:
+        if row[2] in manifest.fetched:
+            yield row, None, None
+        else:
+            todo.append(row)
+    if len(todo) == 0:
+        return
+
+    rowiter = iter(todo)
+    inflight = dict()
+    with ThreadPoolExecutor(max(nthreads, 1)) as tpool, ProcessPoolExecutor(max(maxproc, 1)) as ppool:
+        while True:
+            while len(inflight) < max(prefetch, 1):
+                row = next(rowiter, None)
+                if row is None:
+                    break
+                ffname, dithID, obsind = row
+                inflight[tpool.submit(fetch_to_spool, source, manifest.spooldir, ffname, dithID != 0)] = (row, True)
+            if len(inflight) == 0:
+                break
+            done, notdone = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                row, fetching = inflight.pop(fut)
+                obsind = row[2]
+                if fetching:
+                    try:
+                        tmpname = fut.result()
+                    except IngestErr as e:
+                        yield row, NOT_FOUND, e.args[0]
+                        continue
+                    inflight[ppool.submit(check_spooled, tmpname, manifest.spool_file(obsind))] = (row, False)
+                else:
+                    reason = fut.result()
+                    if reason is None:
+                        manifest.record_fetched(obsind)
+                        yield row, None, None
+                    else:
+                        yield row, reason, "File for " + str(obsind) + " rejected: " + reason
+
+
+def rate_report(nfiles, nbytes, elapsed):
+    """Return string giving number and size of files with rates"""
+    mbytes = nbytes / (1024.0 * 1024.0)
+    elapsed = max(elapsed, 1e-6)
+    return "{:d} files {:.1f} MB in {:.1f} sec {:.2f} files/sec {:.2f} MB/sec".format(nfiles, mbytes, elapsed, nfiles / elapsed, mbytes / elapsed)
+
+
+def parseargs(argp):
+    """Add arguments for fetching to argument parser"""
+    argp.add_argument('--source', type=str, help='Local directory to take files from instead of the archive')
+    argp.add_argument('--spooldir', type=str, default=DEFAULT_SPOOLDIR, help='Directory to hold files fetched until loaded')
+    argp.add_argument('--keepspool', action='store_true', help='Keep files in spool directory after loading')
+    argp.add_argument('--threads', type=int, default=8, help='Number of files to fetch at once')
+    argp.add_argument('--maxproc', type=int, default=4, help='Number of processes to check files')
+    argp.add_argument('--prefetch', type=int, default=32, help='Maximum number of files being fetched or checked at once')
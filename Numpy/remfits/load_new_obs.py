@@ -3,11 +3,12 @@
 """Load new FITS files from observations"""
 
 import sys
+import time
 import argparse
 import remdefaults
 import remtargets
 import parsetime
-import remget
+import fitsingest
 import logs
 
 parsearg = argparse.ArgumentParser(description='Copy new or specified FITS files to local DB', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -20,6 +21,9 @@ parsearg.add_argument('--verbose', action='store_false', help='Print out summary
 parsearg.add_argument('--targets', action='store_false', help='Load files for targets otherwise everything')
 parsearg.add_argument('--objects', type=str, nargs='*', help='Objects to restrict load to (plus targets if specified)')
 parsearg.add_argument("--debug", action='store_true', help='Debug selection command')
+parsearg.add_argument('--commitevery', type=int, default=20, help='Number of files to load between commits')
+parsearg.add_argument('--reportevery', type=int, default=0, help='Report progress and rates every so many files, 0 for only at end')
+fitsingest.parseargs(parsearg)
 resargs = vars(parsearg.parse_args())
 logging = logs.getargs(resargs)
 obsinds = resargs['obsinds']
@@ -28,9 +32,18 @@ verbose = resargs['verbose']
 targets = resargs['targets']
 objects = resargs['objects']
 debug = resargs['debug']
+commitevery = max(resargs['commitevery'], 1)
+reportevery = resargs['reportevery']
+keepspool = resargs['keepspool']
 
 remdefaults.getargs(resargs)
 
+try:
+    source = fitsingest.get_source(resargs['source'])
+    manifest = fitsingest.Manifest(resargs['spooldir'])
+except fitsingest.IngestErr as e:
+    logging.die(10, e.args[0])
+
 fieldselect = []
 fieldselect.append("ind=0")
 
@@ -63,8 +76,6 @@ if len(objselect_list) != 0:
     else:
         fieldselect.append("(" + " OR ".join(objselect_list) + ")")
 
-loaded = errors = 0
-
 selection = "SELECT ffname,dithID,obsind FROM obsinf WHERE " + " AND ".join(fieldselect)
 if debug:
     logging.write("Selection:", selection)
@@ -72,26 +83,53 @@ mycurs.execute(selection)
 
 dbrows = mycurs.fetchall()
 
-for ffname, dithID, obsind in dbrows:
-    try:
-        ffile = remget.get_obs(ffname, dithID != 0)
+loaded = errors = loadedbytes = 0
+pendloaded = []
+rejections = []
+starttime = time.time()
+
+
+def flush():
+    """Record rejections and commit files loaded, then note those in the manifest"""
+    if len(rejections) != 0:
+        mycurs.executemany("UPDATE obsinf SET rejreason=%s WHERE obsind=%s", rejections)
+    mydb.commit()
+    manifest.record_loaded(pendloaded, keepspool)
+    pendloaded.clear()
+    rejections.clear()
+
+
+try:
+    for (ffname, dithID, obsind), reason, message in fitsingest.fetch_all(dbrows, source, manifest, resargs['threads'], resargs['maxproc'], resargs['prefetch']):
+        if reason is not None:
+            logging.write(f"Could not fetch {obsind} error was {message}")
+            rejections.append((reason, obsind))
+            errors += 1
+            continue
+        with open(manifest.spool_file(obsind), "rb") as fin:
+            ffile = fin.read()
         side = 1024
         if dithID != 0:
             side = 512
-        mycurs.execute(f"INSERT INTO fitsfile (side,fitsgz) VALUES ({side},%s)", ffile)
-        mycurs.execute(f"UPDATE obsinf SET ind={mycurs.lastrowid} WHERE obsind={obsind}")
-        mydb.commit()
+        mycurs.execute("INSERT INTO fitsfile (side,fitsgz) VALUES (%s,%s)", (side, ffile))
+        mycurs.execute("UPDATE obsinf SET ind=%s WHERE obsind=%s", (mycurs.lastrowid, obsind))
+        pendloaded.append(obsind)
         loaded += 1
-    except remget.RemGetError as e:
-        logging.write(f"Caould not fetch {obsind} error was {e.args[0]}")
-        mycurs.execute(f"UPDATE obsinf SET rejreason='FITS file not found' WHERE obsind={obsind}")
-        errors += 1
+        loadedbytes += len(ffile)
+        if len(pendloaded) >= commitevery:
+            flush()
+        if reportevery > 0 and loaded % reportevery == 0:
+            logging.write("Loaded", fitsingest.rate_report(loaded, loadedbytes, time.time() - starttime))
+    flush()
+    manifest.compact()
+except (fitsingest.IngestErr, OSError) as e:
+    logging.die(30, str(e))
 
 if verbose:
     if errors > 0:
         logging.write(errors, "files not loaded")
     if loaded > 0:
-        logging.write(loaded, "files loaded")
+        logging.write("Loaded", fitsingest.rate_report(loaded, loadedbytes, time.time() - starttime))
     else:
         logging.write("No new obs files loaded")
 if errors > 0:
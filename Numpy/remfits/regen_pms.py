@@ -7,6 +7,7 @@ import sys
 from astropy.time import Time
 from astropy.coordinates import SkyCoord
 import astropy.units as u
+import numpy as np
 import remdefaults
 import parsetime
 import col_from_file
@@ -17,31 +18,65 @@ import objdata
 MAS_YR = u.mas / u.yr
 
 
-def count_pm(cond):
-    """Count the number of objpms which fit the given condition"""
-    dbcurs.execute("SELECT COUNT(*) FROM objpm WHERE " + cond)
-    return  dbcurs.fetchall()[0][0]
-
-
-def create_pm(dbe, date_pm, thresh=0):
-    """Create an objpm entry"""
-    indc, dummy, rad, decd, distance, ra_pm, dec_pm, rvel = dbe
-    args = dict(ra=rad * u.deg, dec=decd * u.deg, obstime=Time('J2000'), pm_ra_cosdec=ra_pm * MAS_YR, pm_dec=dec_pm * MAS_YR)
-    if distance is not None and rvel is not None:
-        args['distance'] = distance * u.lightyear
-        args['radial_velocity'] = rvel * u.km / u.second
-    spos = SkyCoord(**args).apply_space_motion(new_obstime=Time(date_pm))
+def propagate(pairs):
+    """Apply proper motion for list of (dbent, date) pairs all at once, doing ones with
+    distance and radial velocity in one SkyCoord and the rest in another.
+
+    Return arrays of RA, Dec and distance (NaN where not known)"""
+    npairs = len(pairs)
+    radeg = np.array([p[0][2] for p in pairs], dtype=np.float64)
+    decdeg = np.array([p[0][3] for p in pairs], dtype=np.float64)
+    rapm = np.array([p[0][5] for p in pairs], dtype=np.float64)
+    decpm = np.array([p[0][6] for p in pairs], dtype=np.float64)
+    full = np.array([p[0][4] is not None and p[0][7] is not None for p in pairs], dtype=bool)
+    dist = np.array([p[0][4] if f else np.nan for p, f in zip(pairs, full)], dtype=np.float64)
+    rvel = np.array([p[0][7] if f else np.nan for p, f in zip(pairs, full)], dtype=np.float64)
+    newtimes = Time([p[1] for p in pairs])
+    resra = np.empty(npairs)
+    resdec = np.empty(npairs)
+    resdist = np.full(npairs, np.nan)
+    for sel in (full, ~full):
+        if not sel.any():
+            continue
+        args = dict(ra=radeg[sel] * u.deg, dec=decdeg[sel] * u.deg, obstime=Time('J2000'), pm_ra_cosdec=rapm[sel] * MAS_YR, pm_dec=decpm[sel] * MAS_YR)
+        if sel is full:
+            args['distance'] = dist[sel] * u.lightyear
+            args['radial_velocity'] = rvel[sel] * u.km / u.second
+        spos = SkyCoord(**args).apply_space_motion(new_obstime=newtimes[sel])
+        resra[sel] = spos.ra.deg
+        resdec[sel] = spos.dec.deg
+        if sel is full:
+            resdist[sel] = spos.distance.lightyear
+    return resra, resdec, resdist
+
+
+def insert_pms(pairs, thresh=0):
+    """Create objpm entries for list of (dbent, date) pairs with parameterised bulk inserts,
+    committing after each batch of commitint.
+
+    Return number inserted"""
+    if len(pairs) == 0:
+        return 0
+    resra, resdec, resdist = propagate(pairs)
     fields = ["objind", "obsdate", "radeg", "decdeg"]
-    values = [ "{:d}".format(indc), mydb.escape(date_pm), str(spos.ra.deg), str(spos.dec.deg)]
-    if distance is not None and rvel is not None:
-        fields.append("dist")
-        values.append(str(spos.distance.lightyear))
     if thresh != 0:
-        fields.append('slow')
-        values.append('1')
-        fields.append('slowth')
-        values.append("{:.6e}".format(thresh))
-    dbcurs.execute("INSERT INTO objpm (" + ",".join(fields) + ") VALUES (" + ",".join(values) + ")")
+        fields += ["slow", "slowth"]
+    withdist = []
+    nodist = []
+    for (dbe, date_pm), ra, dec, dist in zip(pairs, resra, resdec, resdist):
+        values = [dbe[0], date_pm, float(ra), float(dec)]
+        if thresh != 0:
+            values += [1, thresh]
+        if np.isnan(dist):
+            nodist.append(values)
+        else:
+            withdist.append(values + [float(dist)])
+    for flds, rows in ((fields, nodist), (fields + ["dist"], withdist)):
+        stmt = "INSERT INTO objpm (" + ",".join(flds) + ") VALUES (" + ",".join(["%s"] * len(flds)) + ")"
+        for n in range(0, len(rows), commitint):
+            dbcurs.executemany(stmt, rows[n:n + commitint])
+            mydb.commit()
+    return len(pairs)
 
 
 parsearg = argparse.ArgumentParser(description='Update table of proper motions to cope with slow-moving objects',
@@ -50,7 +85,7 @@ parsearg.add_argument('datelist', type=str, nargs='*', help='Dates to calculate
 parsearg.add_argument('--colnum', type=int, default=0, help='Column to use from stdin')
 parsearg.add_argument('--threshold', type=float, default=20.0, help='Threshold in MAS at which we just store single value')
 parsearg.add_argument('--verbose', action='count', help='Give increasing commentary on stderr')
-parsearg.add_argument('--commit', type=int, default=10, help='Commit after this number of inserts')
+parsearg.add_argument('--commit', type=int, default=1000, help='Commit after this number of inserts')
 parsearg.add_argument('--vicinity', type=str, help='Only consider objects in this vicinity')
 parsearg.add_argument('--basedate', type=str, default='2020-01-01', help='Date to calculate slow-moving things for')
 
@@ -69,9 +104,9 @@ if len(datelist) == 0:
 remdefaults.getargs(resargs)
 commitint = resargs['commit']
 if commitint <= 0:
-    print("Do not understand commit", commitint, "reverting to 10", file=sys.stderr)
-    commitint = 10
-verbose = resargs['verbose']
+    print("Do not understand commit", commitint, "reverting to 1000", file=sys.stderr)
+    commitint = 1000
+verbose = resargs['verbose'] or 0
 threshold = resargs['threshold']
 thresholdsq = threshold ** 2
 vicinity = resargs['vicinity']
@@ -113,47 +148,63 @@ for dbent in dbtab:
     else:
         slowmoving[ind] = dbent
 
+# Get all the existing entries for all the objects we're thinking about at once
+
+existing = dict()
+if len(dbtab) != 0:
+    dbcurs.execute("SELECT objind,obsdate,slow FROM objpm WHERE objind IN (" + ",".join(["%s"] * len(dbtab)) + ")", [dbent[0] for dbent in dbtab])
+    for objind, dat, slow in dbcurs.fetchall():
+        existing.setdefault(objind, []).append((dat, slow))
+
 # First check through the ones we are saying are slow moving and move any across to that
 # if we've got full records
 
 dbchanges = 0
+slowdelete = []
+slowpairs = []
 
 for ind, dbent in slowmoving.items():
 
-    if count_pm("objind={:d} AND slow!=0".format(ind)) != 0:
+    entries = existing.get(ind, [])
+    if any(slow for dat, slow in entries):
         if verbose > 2:
             print("Already got", dbent[1], "on slow", file=sys.stderr)
         continue
-    ndel = dbcurs.execute("DELETE FROM objpm WHERE objind={:d}".format(ind))
-    if ndel != 0:
-        dbchanges += ndel
+    if len(entries) != 0:
+        slowdelete.append(ind)
+        dbchanges += len(entries)
         if verbose > 0:
-            print("Deleting {:d} individual PMs for {:s}".format(ndel, dbent[1]), file=sys.stderr)
-    create_pm(dbent, basedate, threshold)
+            print("Deleting {:d} individual PMs for {:s}".format(len(entries), dbent[1]), file=sys.stderr)
+    slowpairs.append((dbent, basedate))
     if verbose > 0:
         print("Creating slow entry for {:s}".format(dbent[1]), file=sys.stderr)
 
+if len(slowdelete) != 0:
+    dbcurs.execute("DELETE FROM objpm WHERE objind IN (" + ",".join(["%s"] * len(slowdelete)) + ")", slowdelete)
+
 # Check we haven't got items as slow-moving which shouldn't be
 
+fastdelete = []
 for ind, dbent in fullrecord.items():
-    ndel = dbcurs.execute("DELETE FROM objpm WHERE objind={:d} AND slow!=0".format(ind))
-    if ndel != 0:
-        dbchanges += ndel
+    nslow = sum(1 for dat, slow in existing.get(ind, []) if slow)
+    if nslow != 0:
+        fastdelete.append(ind)
+        dbchanges += nslow
         if verbose > 0:
             print("Removing slow entry for {:s}".format(dbent[1]), file=sys.stderr)
 
+if len(fastdelete) != 0:
+    dbcurs.execute("DELETE FROM objpm WHERE slow!=0 AND objind IN (" + ",".join(["%s"] * len(fastdelete)) + ")", fastdelete)
+
+dbchanges += insert_pms(slowpairs, threshold)
+
 # Get all the dates we have entries for for each object we're thinking about
 
 frsets = dict()
 for ind in fullrecord:
-    try:
-        indset = frsets[ind]
-    except KeyError:
-        indset = frsets[ind] = set()
-    dbcurs.execute("SELECT obsdate FROM objpm WHERE objind={:d}".format(ind))
-    for dat, in dbcurs.fetchall():
-        indset.add(dat.strftime("%Y-%m-%d"))
+    frsets[ind] = set(dat.strftime("%Y-%m-%d") for dat, slow in existing.get(ind, []) if not slow)
 
+fullpairs = []
 for poss_date in convdates:
 
     descr = poss_date
@@ -168,12 +219,11 @@ for poss_date in convdates:
             if verbose > 2:
                 print("Already have full record for", poss_date, "in", dbent[1], file=sys.stderr)
             continue
-        create_pm(dbent, poss_date)
+        fullpairs.append((dbent, poss_date))
         if verbose > 0:
-            print("Created full record for", poss_date, "in", dbent[1], file=sys.stderr)
-        dbchanges += 1
-        if dbchanges % commitint == 0:
-            mydb.commit()
+            print("Creating full record for", poss_date, "in", dbent[1], file=sys.stderr)
+
+dbchanges += insert_pms(fullpairs)
 
 if dbchanges > 0:
     mydb.commit()
@@ -0,0 +1,6 @@
+"""Make the modules in the directory above importable by the tests"""
+
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+"""Tests for barycentric date conversion"""
+
+import datetime
+import numpy as np
+import pytest
+
+pytest.importorskip("astropy")
+pytest.importorskip("barycorrpy")
+import baryconv
+
+MICROSEC_DAYS = 1e-6 / 86400.0
+
+
+def test_all_at_once_matches_per_row():
+    start = datetime.datetime(2019, 3, 1, 23, 15, 7)
+    dates = [start + datetime.timedelta(days=37.3 * n, seconds=611 * n) for n in range(12)]
+    for hip in (70890, 87937):
+        batch = np.array(baryconv.bjd_tdb(dates, hip))
+        perrow = np.array(baryconv.bjd_tdb(dates, hip, perrow=True))
+        assert batch.shape == perrow.shape == (len(dates), )
+        assert np.all(np.abs(batch - perrow) < MICROSEC_DAYS)
+
+
+def test_single_date():
+    date = datetime.datetime(2021, 7, 4, 3, 0, 0)
+    assert len(baryconv.bjd_tdb([date], 92403)) == 1
+    assert abs(baryconv.bjd_tdb([date], 92403)[0] - baryconv.bjd_tdb([date], 92403, perrow=True)[0]) < MICROSEC_DAYS
@@ -0,0 +1,116 @@
+"""Tests for fetching FITS files into the spool directory from a local source"""
+
+import os
+import gzip
+import pytest
+import fitsingest
+
+
+def fits_bytes(nrows=4, ncols=6, truncate=False):
+    cards = ["SIMPLE  =                    T", "BITPIX  =                   16", "NAXIS   =                    2",
+             "NAXIS1  = {:20d}".format(ncols), "NAXIS2  = {:20d}".format(nrows), "END"]
+    hdr = "".join(c.ljust(fitsingest.FITS_CARD) for c in cards).encode()
+    hdr += b" " * (-len(hdr) % fitsingest.FITS_BLOCK)
+    data = bytes(range(256)) * (2 * nrows * ncols // 256 + 1)
+    data = data[:2 * nrows * ncols]
+    data += b"\0" * (-len(data) % fitsingest.FITS_BLOCK)
+    if truncate:
+        return hdr
+    return hdr + data
+
+
+class CountingSource(fitsingest.LocalSource):
+    """Local source counting the files opened"""
+
+    def __init__(self, dirname):
+        super().__init__(dirname)
+        self.opened = []
+
+    def open(self, ffname, remir):
+        self.opened.append(ffname)
+        return super().open(ffname, remir)
+
+
+@pytest.fixture
+def srcdir(tmp_path):
+    src = tmp_path / "src"
+    (src / "Ross").mkdir(parents=True)
+    (src / "Remir").mkdir()
+    (src / "Ross" / "plain.fits").write_bytes(fits_bytes())
+    (src / "Ross" / "zipped.fits.gz").write_bytes(gzip.compress(fits_bytes(8, 8)))
+    (src / "Remir" / "remir.fits").write_bytes(fits_bytes(2, 2))
+    (src / "top.fits").write_bytes(fits_bytes(3, 3))
+    (src / "Ross" / "short.fits").write_bytes(fits_bytes(truncate=True))
+    (src / "Ross" / "html.fits").write_bytes(b"<html>No such file</html>")
+    return src
+
+
+ROWS = [("plain.fits", 0, 1), ("zipped.fits.gz", 0, 2), ("remir.fits", 1, 3), ("top.fits", 0, 4),
+        ("short.fits", 0, 5), ("html.fits", 0, 6), ("missing.fits", 0, 7)]
+GOOD = {1, 2, 3, 4}
+
+
+def run(rows, source, manifest):
+    return {row[2]: reason for row, reason, message in fitsingest.fetch_all(rows, source, manifest, nthreads=3, maxproc=2, prefetch=4)}
+
+
+def test_fetch_checks_and_spools(srcdir, tmp_path):
+    manifest = fitsingest.Manifest(str(tmp_path / "spool"))
+    results = run(ROWS, fitsingest.LocalSource(str(srcdir)), manifest)
+    assert set(results) == set(r[2] for r in ROWS)
+    assert {o for o, reason in results.items() if reason is None} == GOOD
+    assert results[5] == "FITS file truncated"
+    assert results[6] == fitsingest.NOT_FOUND and results[7] == fitsingest.NOT_FOUND
+    assert set(manifest.fetched) == GOOD
+    for obsind in GOOD:
+        with open(manifest.spool_file(obsind), "rb") as fin:
+            assert fitsingest.fits_problem(gzip.decompress(fin.read())) is None
+    assert (tmp_path / "spool" / "2.fits.gz").read_bytes() == (srcdir / "Ross" / "zipped.fits.gz").read_bytes()
+    assert not [f for f in os.listdir(manifest.spooldir) if f.startswith(fitsingest.TMP_PREFIX)]
+
+
+def test_rerun_fetches_nothing_already_spooled(srcdir, tmp_path):
+    run(ROWS, fitsingest.LocalSource(str(srcdir)), fitsingest.Manifest(str(tmp_path / "spool")))
+    source = CountingSource(str(srcdir))
+    results = run(ROWS, source, fitsingest.Manifest(str(tmp_path / "spool")))
+    assert {o for o, reason in results.items() if reason is None} == GOOD
+    assert sorted(source.opened) == ["html.fits", "missing.fits", "short.fits"]
+
+
+def test_resume_after_interruption(srcdir, tmp_path):
+    spooldir = tmp_path / "spool"
+    run(ROWS[:2], fitsingest.LocalSource(str(srcdir)), fitsingest.Manifest(str(spooldir)))
+
+    # Left over from a fetch in progress and a file spooled but not recorded
+
+    (spooldir / (fitsingest.TMP_PREFIX + "abc")).write_bytes(b"partial")
+    (spooldir / "3.fits.gz").write_bytes(b"not recorded")
+    source = CountingSource(str(srcdir))
+    manifest = fitsingest.Manifest(str(spooldir))
+    assert not (spooldir / (fitsingest.TMP_PREFIX + "abc")).exists()
+    results = run(ROWS[:4], source, manifest)
+    assert all(reason is None for reason in results.values())
+    assert sorted(source.opened) == ["remir.fits", "top.fits"]
+    assert fitsingest.fits_problem(gzip.decompress((spooldir / "3.fits.gz").read_bytes())) is None
+
+
+def test_loaded_files_removed_and_manifest_compacted(srcdir, tmp_path):
+    spooldir = tmp_path / "spool"
+    manifest = fitsingest.Manifest(str(spooldir))
+    run(ROWS, fitsingest.LocalSource(str(srcdir)), manifest)
+    manifest.record_loaded([1, 2])
+    manifest.record_loaded([3], keep=True)
+    assert not (spooldir / "1.fits.gz").exists() and (spooldir / "3.fits.gz").exists()
+    assert set(fitsingest.Manifest(str(spooldir)).fetched) == {4}
+    manifest.compact()
+    assert (spooldir / fitsingest.MANIFEST_NAME).read_text().split() == ["4", "fetched", str(os.path.getsize(spooldir / "4.fits.gz"))]
+    os.unlink(spooldir / "4.fits.gz")
+    assert fitsingest.Manifest(str(spooldir)).fetched == {}
+
+
+def test_bad_manifest_and_source(tmp_path):
+    with pytest.raises(fitsingest.IngestErr):
+        fitsingest.LocalSource(str(tmp_path / "nowhere"))
+    (tmp_path / fitsingest.MANIFEST_NAME).write_text("12 eaten\n")
+    with pytest.raises(fitsingest.IngestErr):
+        fitsingest.Manifest(str(tmp_path))
@@ -5,91 +5,69 @@
 import argparse
 import sys
 import csv
-import math
-from operator import attrgetter
 import astropy.units as u
+from scipy.spatial import cKDTree
 import remdefaults
-import objdata
 import miscutils
 import vicinity
 import numpy as np
 import parsedms
+import skyregion
 
 Parallax_conv = u.parallax()
 
+REQUIRED_COLUMNS = ('source_id', 'ra', 'dec', 'phot_g_mean_mag')
+OPTIONAL_COLUMNS = ('pmra', 'pmdec', 'dr2_radial_velocity', 'parallax')
 
-class csvobj:
-    """Remember object extracted from CSV"""
-
-    def __init__(self, csvrow):
-        self.id = csvrow['source_id']
-        self.radeg = float(csvrow['ra'])
-        self.decdeg = float(csvrow['dec'])
-        try:
-            self.pmra = float(csvrow['pmra'])
-        except ValueError:
-            self.pmra = None
-        try:
-            self.pmdec = float(csvrow['pmdec'])
-        except ValueError:
-            self.pmdec = None
-#         try:
-#             self.ruwe = float(csvrow['ruwe'])
-#         except ValueError:
-#             self.ruwe = 1e6
-        self.gmag = float(csvrow['phot_g_mean_mag'])
-        try:
-            self.rv = float(csvrow['dr2_radial_velocity'])
-        except ValueError:
-            self.rv = None
-        try:
-            self.distance = (float(csvrow['parallax']) * u.arcsec).to(u.lightyear, equivalencies=Parallax_conv).value
-            if math.isnan(self.distance):
-                self.distance = None
-        except ValueError:
-            self.distance = None
-
-    def gen_insert(self):
-        """Generate insert statement - need dbase for escapes"""
-
-        global mydb, vic
-
-        fields = []
-        values = []
-
-        fields.append("objname")
-        escname = mydb.escape("Gaia DR3 " + self.id)
-        values.append(escname)
-        fields.append("dispname")
-        values.append(escname)
-        fields.append("objtype")
-        values.append(mydb.escape('Star'))
-        fields.append('vicinity')
-        values.append(mydb.escape(vic))
-
-        fields.append("radeg")
-        values.append("{:.8e}".format(self.radeg))
-        fields.append("decdeg")
-        values.append("{:.8e}".format(self.decdeg))
-
-        if self.rv is not None:
-            fields.append('rv')
-            values.append("{:.8e}".format(self.rv))
-
-        if self.pmra is not None:
-            fields.append('rapm')
-            values.append("{:.8e}".format(self.pmra))
-        if self.pmdec is not None:
-            fields.append('decpm')
-            values.append("{:.8e}".format(self.pmdec))
-
-        if self.distance is not None:
-            fields.append("dist")
-            values.append("{:.8e}".format(self.distance))
-
-        fields.append("gmag")
-        values.append("{:.8e}".format(self.gmag))
-        return "INSERT INTO objdata (" + ",".join(fields) + ") VALUES (" + ",".join(values) + ")"
+# Fields in insert which are left out if not known in the same way as before, in order
+
+OPTIONAL_FIELDS = ('rv', 'rapm', 'decpm', 'dist')
+
+
+def float_column(values):
+    """Convert list of strings to float array, giving NaN where empty or not valid"""
+    try:
+        return np.array([v if v != '' else 'nan' for v in values], dtype=np.float64)
+    except ValueError:
+        result = np.empty(len(values))
+        for n, v in enumerate(values):
+            try:
+                result[n] = float(v)
+            except ValueError:
+                result[n] = np.nan
+        return result
+
+
+def read_csv(inf):
+    """Read CSV file into dictionary of arrays for each column we need,
+    dropping rows without valid required fields.
+
+    Return dictionary and list of line numbers of rows dropped"""
+    reader = csv.reader(inf)
+    try:
+        header = next(reader)
+    except StopIteration:
+        header = []
+    missing = [c for c in REQUIRED_COLUMNS + OPTIONAL_COLUMNS if c not in header]
+    if len(missing) != 0:
+        raise ValueError("Missing columns " + ", ".join(missing))
+    colnums = [header.index(c) for c in REQUIRED_COLUMNS + OPTIONAL_COLUMNS]
+    rows = [[r[c] if c < len(r) else '' for c in colnums] for r in reader]
+    columns = dict(zip(REQUIRED_COLUMNS + OPTIONAL_COLUMNS, zip(*rows))) if len(rows) != 0 else dict()
+    result = dict(source_id=np.array(columns.get('source_id', ()), dtype=str))
+    for c in REQUIRED_COLUMNS[1:] + OPTIONAL_COLUMNS:
+        result[c] = float_column(columns.get(c, ()))
+    good = np.isfinite(result['ra']) & np.isfinite(result['dec']) & np.isfinite(result['phot_g_mean_mag'])
+    for c in result:
+        result[c] = result[c][good]
+    return result, (np.flatnonzero(~good) + 2).tolist()
+
+
+def optional(value):
+    """Give None for NaN or infinite values, otherwise float"""
+    if np.isfinite(value):
+        return float(value)
+    return None
 
 
 parsearg = argparse.ArgumentParser(description='Process output from GAIA DR3 to identify objects', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -125,106 +103,147 @@ except OSError as e:
     print("Could not open", csvfile, e.args[1], file=sys.stderr)
     sys.exit(12)
 
-reader = csv.DictReader(inf)
-
-mydb, dbcurs = remdefaults.opendb()
-
-ilist = []
-# nonruwe = 0
+try:
+    with inf:
+        cols, badlines = read_csv(inf)
+except ValueError as e:
+    print("Input error in", csvfile, e.args[0], file=sys.stderr)
+    sys.exit(13)
 
-for row in reader:
-    try:
-        newitem = csvobj(row)
-    except ValueError:
-        print("Input error in", csvfile, "line", reader.line_num, "expected fields missing", file=sys.stderr)
-        continue
-#     if newitem.ruwe <= maxruew:
-    ilist.append(newitem)
-#     else:
-#         nonruwe += 1
+for lnum in badlines:
+    print("Input error in", csvfile, "line", lnum, "expected fields missing", file=sys.stderr)
 
-if len(ilist) == 0:
+if cols['ra'].size == 0:
     print("No acceptable lines found", file=sys.stderr)
     sys.exit(51)
 
-# if nonruwe > 0:
-#     print(nonruwe, "lines omitted as excess RUWE")
+# Sort by RA and DEC and get distances from parallax all in one go
+
+order = np.lexsort((cols['dec'], cols['ra']))
+for c in cols:
+    cols[c] = cols[c][order]
+ids = cols['source_id']
+radegs = cols['ra']
+decdegs = cols['dec']
+pmras = cols['pmra']
+pmdecs = cols['pmdec']
+gmags = cols['phot_g_mean_mag']
+rvs = cols['dr2_radial_velocity']
+with np.errstate(divide='ignore', invalid='ignore'):
+    distances = (cols['parallax'] * u.arcsec).to(u.lightyear, equivalencies=Parallax_conv).value
 
-ilist = sorted(ilist, key=attrgetter('radeg', 'decdeg'))
+mydb, dbcurs = remdefaults.opendb()
 
-vic = vicinity.get_vicinity(dbcurs, ilist[0].radeg, ilist[0].decdeg)
+vic = vicinity.get_vicinity(dbcurs, radegs[0], decdegs[0])
 if vic is None:
-    print("Cannot find vicinity of object at", ilist[0].radeg, ilist[0].decdeg, file=sys.stderr)
+    print("Cannot find vicinity of object at", radegs[0], decdegs[0], file=sys.stderr)
     sys.exit(50)
 print("Vicinity of", vic)
 
-coord_pos = [complex(a.radeg, a.decdeg) for a in ilist]
+# Drop any objects with another within minimum separation
 
-diffs = np.append(np.abs(np.diff(coord_pos)), 1e50)
-rdiffs = np.roll(diffs, 1)
+coord_pos = np.column_stack((radegs, decdegs))
+csvtree = cKDTree(coord_pos)
+nclose = np.array([len(n) for n in csvtree.query_ball_point(coord_pos, minsep, return_sorted=False)])
+distinct = np.flatnonzero(nclose <= 1)
 
-distinct_list = [a for a, d, rd in zip(ilist, diffs, rdiffs) if d >= minsep and rd >= minsep]
+print("Before pruning for too adjacent", radegs.size, "after", distinct.size)
 
-print("Before pruning for too adjacent", len(ilist), "after", len(distinct_list))
+# Get existing objects in the region covered with one query and find those within difference of each
+
+minra = radegs.min() - difference
+maxra = radegs.max() + difference
+mindec = decdegs.min() - difference
+maxdec = decdegs.max() + difference
+dbcurs.execute("SELECT objname,radeg,decdeg,dist,rv FROM objdata WHERE radeg BETWEEN %s AND %s AND decdeg BETWEEN %s AND %s",
+               (float(minra), float(maxra), float(mindec), float(maxdec)))
+existing = dbcurs.fetchall()
+if len(existing) != 0:
+    dbtree = cKDTree(np.array([(r[1], r[2]) for r in existing], dtype=np.float64))
+    inregs = dbtree.query_ball_point(coord_pos[distinct], difference)
+else:
+    inregs = [[] for d in distinct]
+
+# Aliases of all the ones we matched in one query
+
+matchednames = sorted(set(existing[m[0]][0] for m in inregs if len(m) == 1))
+aliases = dict()
+if len(matchednames) != 0:
+    dbcurs.execute("SELECT objname,alias FROM objalias WHERE objname IN (" + ",".join(["%s"] * len(matchednames)) + ")", matchednames)
+    for objname, alias in dbcurs.fetchall():
+        aliases.setdefault(objname, []).append(alias)
 
-diffsq = difference ** 2
 nomatches = dupmatches = foundmatch = already = 0
 newentries = newaliases = updrv = upddist = 0
-
-for item in distinct_list:
-    pmra = item.pmra
-    pmdec = item.pmdec
-    if pmra is None:
+inserts = dict()
+skycells = skyregion.cell_index(radegs, decdegs)
+newalias_list = []
+distupdates = []
+rvupdates = []
+
+for n, inreg in zip(distinct, inregs):
+    pmra = pmras[n]
+    pmdec = pmdecs[n]
+    if not np.isfinite(pmra):
         pmra = 0
-    if pmdec is None:
+    if not np.isfinite(pmdec):
         pmdec = 0
- #   print("{id:<16s}{ra:9.3f}{dec:9.3f}{pmra:9.3f}{pmdec:9.3f} {mag:6.3f}".format(id=item.id, ra=item.radeg, dec=item.decdeg, pmra=pmra, pmdec=pmdec, mag=item.gmag), item.rv, sep='\t')
-    dbcurs.execute("SELECT objname,radeg,decdeg,dist,rv FROM objdata WHERE POWER(radeg-{radeg:.8e},2)+POWER(decdeg-{decdeg:.8e},2)<={diff:.8e}".format(radeg=item.radeg, decdeg=item.decdeg, diff=diffsq))
-    inreg = dbcurs.fetchall()
+    rv = optional(rvs[n])
+    distance = optional(distances[n])
     if len(inreg) == 0:
         nomatches += 1
         if update:
-            dbcurs.execute(item.gen_insert())
+            objname = "Gaia DR3 " + ids[n]
+            optvals = (rv, optional(pmras[n]), optional(pmdecs[n]), distance)
+            present = tuple(v is not None for v in optvals)
+            inserts.setdefault(present, []).append((objname, objname, 'Star', vic, float(radegs[n]), float(decdegs[n]))
+                                                   + tuple(v for v in optvals if v is not None) + (float(gmags[n]), int(skycells[n])))
             newentries += 1
         continue
     if len(inreg) > 1:
-        possnames = sorted([m[0] for m in inreg])
+        possnames = sorted([existing[m][0] for m in inreg])
         print("\t***Near to", len(inreg), "objects", ", ".join(possnames))
         dupmatches += 1
         continue
-    dbobjname, dbra, dbdec, dbdist, dbrv = inreg[0]
-    dbobj = objdata.ObjData(dbobjname)
-    alist = dbobj.list_aliases(dbcurs)
-    anames = [a.aliasname for a in alist]
-    anames.append(dbobj.objname)
+    dbobjname, dbra, dbdec, dbdist, dbrv = existing[inreg[0]]
+    anames = aliases.get(dbobjname, []) + [dbobjname]
     anames.sort()
     matched = False
     for a in anames:
-        try:
-            if a[0:7] == 'Gaia DR' and item.id in a:
-                matched = True
-                break
-        except (IndexError, ValueError):
-            continue
+        if a[0:7] == 'Gaia DR' and ids[n] in a:
+            matched = True
+            break
     if matched:
-        print("\t***", item.id, "Previously matched to GAIA release", ", ".join(anames))
+        print("\t***", ids[n], "Previously matched to GAIA release", ", ".join(anames))
         already += 1
     else:
-        print("{id:<16s}{ra:9.3f}{dec:9.3f}{pmra:9.3f}{pmdec:9.3f} {mag:6.3f}".format(id=item.id, ra=item.radeg, dec=item.decdeg, pmra=pmra, pmdec=pmdec, mag=item.gmag), item.rv, sep='\t')
-        print("\t***Found object", item.id, "before with names", ", ".join(anames))
+        print("{id:<16s}{ra:9.3f}{dec:9.3f}{pmra:9.3f}{pmdec:9.3f} {mag:6.3f}".format(id=ids[n], ra=radegs[n], dec=decdegs[n], pmra=pmra, pmdec=pmdec, mag=gmags[n]), rv, sep='\t')
+        print("\t***Found object", ids[n], "before with names", ", ".join(anames))
         if update:
-            dbcurs.execute("INSERT INTO objalias (objname,alias,source,sbok) VALUES (%s,%s,%s,0)", (dbobjname, 'Gaid DR3 ' + item.id, "Gaia DR3"))
+            newalias_list.append((dbobjname, 'Gaid DR3 ' + ids[n], "Gaia DR3"))
             newaliases += 1
     foundmatch += 1
     if update:
-        if dbdist is None and item.distance is not None:
-            dbcurs.execute("UPDATE objdata SET dist={:.8e}".format(item.distance) + " WHERE objname=%s", dbobjname)
+        if dbdist is None and distance is not None:
+            distupdates.append((distance, dbobjname))
             upddist += 1
-        if dbrv is None and item.rv is not None:
-            dbcurs.execute("UPDATE objdata SET rv={:.8e}".format(item.rv) + " WHERE objname=%s", dbobjname)
+        if dbrv is None and rv is not None:
+            rvupdates.append((rv, dbobjname))
             updrv += 1
 
 print(nomatches, "not matched", dupmatches, "duplicate", foundmatch, "found match", already, "already as GAIA")
 if update and (nomatches > 0 or newentries > 0 or newaliases > 0 or upddist > 0 or updrv > 0):
+
+    # One insert for each combination of optional fields known so the others get the default as before
+
+    for present, values in inserts.items():
+        fields = ["objname", "dispname", "objtype", "vicinity", "radeg", "decdeg"] + [f for f, p in zip(OPTIONAL_FIELDS, present) if p] + ["gmag", "skycell"]
+        dbcurs.executemany("INSERT INTO objdata (" + ",".join(fields) + ") VALUES (" + ",".join(["%s"] * len(fields)) + ")", values)
+    if len(newalias_list) != 0:
+        dbcurs.executemany("INSERT INTO objalias (objname,alias,source,sbok) VALUES (%s,%s,%s,0)", newalias_list)
+    if len(distupdates) != 0:
+        dbcurs.executemany("UPDATE objdata SET dist=%s WHERE objname=%s", distupdates)
+    if len(rvupdates) != 0:
+        dbcurs.executemany("UPDATE objdata SET rv=%s WHERE objname=%s", rvupdates)
     print(newentries, "new entries", newaliases, "new aliases", upddist, "update dists", updrv, "update rv")
     mydb.commit()
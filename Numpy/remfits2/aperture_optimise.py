@@ -6,6 +6,7 @@ import argparse
 import warnings
 import sys
 import os
+from multiprocessing import Pool
 import numpy as np
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import remdefaults
@@ -15,19 +16,38 @@ import objdata
 import searchparam
 import logs
 
-def get_fitsfile(ind):
-    """Get fits file by ID"""
+def fits_name(ind):
+    """Get name of FITS file for obsind"""
+    return "{:s}{:d}.fits.gz".format(prefix, ind)
+
+
+def init_worker():
+    """Give each worker process its own database connection"""
+    global dbcurs
+    mydb, dbcurs = remdefaults.opendb()
+
+
+def opt_obs(task):
+    """Load FITS file for obsind once and optimise apertures for all the (objind, row, col) in it.
+
+    Return (obsind, error message or None, list of (objind, aperture or None if not found))"""
+    obsind, objlocs = task
     try:
-        fname = "{:s}{:d}.fits.gz".format(prefix, ind)
-        logging.set_filename(fname)
-        ff = remfits.parse_filearg(fname, dbcurs)
+        ff = remfits.parse_filearg(fits_name(obsind), dbcurs)
         ff.calc_skylevel(skylevstd)
     except remfits.RemFitsErr:
-        logging.write("Could not find file for id", ind)
-        raise
-    finally:
-        logging.set_filename("")
-    return ff
+        return obsind, "Could not find file for id {:d}".format(obsind), []
+    if ff.from_obsind != obsind:
+        return obsind, "{:d} does not match file which is {}".format(obsind, ff.from_obsind), []
+    findres = find_results.FindResults(ff)
+    results = []
+    for objind, row, col in objlocs:
+        try:
+            results.append((objind, findres.opt_aperture(row, col, searchpar)))
+        except find_results.FindResultErr:
+            results.append((objind, None))
+    return obsind, None, results
+
 
 # Shut up warning messages
 
@@ -47,6 +67,7 @@ parsearg.add_argument('--verbose', action='store_true', help='Tell everything')
 parsearg.add_argument('--skylevelstd', type=float, default=remfits.DEFAULT_SKYLEVELSTD, help='Theshold level of std devs to include points in sky')
 parsearg.add_argument('--minoccs', type=int, default=10, help='Minimum number of occurences to consider for inclusion')
 parsearg.add_argument('--vicinity', type=str, help='Vicinity when identifying by label')
+parsearg.add_argument('--maxproc', type=int, default=8, help='Maximum number of processes to run')
 logs.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
@@ -61,6 +82,7 @@ direc = resargs['dir']
 minoccs = resargs['minoccs']
 objlist = resargs['objects']
 vicinity = resargs['vicinity']
+maxproc = resargs['maxproc']
 
 # If we are saving stuff, do so and do not exit
 
@@ -84,7 +106,7 @@ if vicinity is not None:
 
 # Lookup of objdata retrieved_objects looks ob objind to objdata struct
 # objind_ot_obsind is a list of (obsind, row, col)
-# obsind_cache is a cache of the firs files for each obsind
+# FITS files are not opened until we have the plan of which objects to do in each
 
 retrieved_objects = dict()
 objind_to_obsind = dict()
@@ -100,15 +122,6 @@ if len(objlist) == 0:
             objd = objdata.ObjData(objind=objind)
             objd.get(dbcurs)
             retrieved_objects[objind] = objd
-        try:
-            fitsf = get_fitsfile(obsind)
-        except remfits.RemFitsErr:
-            errors += 1
-            continue
-        if fitsf.from_obsind != obsind:
-            logging.write(obsind, "does not match file which is", fitsf.from_obsind)
-            errors += 1
-            continue
         valid_obs += 1
         if objind not in objind_to_obsind:
             objind_to_obsind[objind] = []
@@ -166,21 +179,7 @@ else:
     for objind in retrieved_objects:
         dbcurs.execute("SELECT obsind,nrow,ncol FROM findresult WHERE hide=0 AND objind={:d}".format(objind))
         for obsind, row, col in dbcurs.fetchall():
-            try:
-                fitsf = get_fitsfile(obsind)
-            except remfits.RemFitsErr:
-                errors += 1
-                continue
-            if fitsf.from_obsind != obsind:
-                logging.write(obsind, "does not match file which is", fitsf.from_obsind)
-                errors += 1
-                continue
             valid_obs += 1
-            if fitsf is None:
-                logging.write("Skipping reference to unread obsind", obsind)
-                errors += 1
-                continue
-
             if objind not in objind_to_obsind:
                 objind_to_obsind[objind] = []
             objind_to_obsind[objind].append((obsind, row, col))
@@ -213,16 +212,29 @@ calculated_apertures = dict()
 for objind in retrieved_objects:
     calculated_apertures[objind] = []
 
+# Turn it round so we load each FITS file once and do all the objects in it
+
+obsind_to_objlocs = dict()
 for objind, obslist in objind_to_obsind.items():
     for obsind, row, col in obslist:
-        try:
-            fitsf = get_fitsfile(obsind)
-        except remfits.RemFitsErr:
+        if obsind not in obsind_to_objlocs:
+            obsind_to_objlocs[obsind] = []
+        obsind_to_objlocs[obsind].append((objind, row, col))
+
+tasks = sorted(obsind_to_objlocs.items())
+
+with Pool(max(1, min(len(tasks), maxproc)), initializer=init_worker) as pool:
+    for obsind, mess, results in pool.imap_unordered(opt_obs, tasks):
+        if mess is not None:
+            logging.set_filename(fits_name(obsind))
+            logging.write(mess)
+            logging.set_filename("")
+            errors += len(obsind_to_objlocs[obsind])
             continue
-        findres = find_results.FindResults(fitsf)
-        try:
-            optapp = findres.opt_aperture(row, col, searchpar)
-        except find_results.FindResultErr as e:
+        for objind, optapp in results:
+            if optapp is not None:
+                calculated_apertures[objind].append((obsind, optapp))
+                continue
             if len(objlist) != 0 or verbose:
                 obj = retrieved_objects[objind]
                 if obj.valid_label():
@@ -232,8 +244,6 @@ for objind, obslist in objind_to_obsind.items():
                 logging.write("Could not find aperture for {:s} ({:s}) (previously {:.2f})".format(obj.dispname, lab, obj.apsize))
             if len(objlist) != 0:
                 errors += 1
-            continue
-        calculated_apertures[objind].append((obsind, optapp))
 
 to_delete = set()
 
@@ -286,7 +296,7 @@ for lab in sorted(haslabel.keys(), key=lambda x: x.rjust(4)):
         print("{:<4s} {:<16s} {:6.2f} {:6.2f} {:6.2f}".format(lab, dname, existap, meanap, stdap))
 
 for dname in sorted(nolabel.keys()):
-    for dummy, existap, meanap, stdap in sorted(nolabel[dname].keys()):
+    for dummy, existap, meanap, stdap in sorted(nolabel[dname]):
         print("     {:<16s} {:6.2f} {:6.2f} {:6.2f}".format(dname, existap, meanap, stdap))
 
 if errors > 0:
@@ -294,13 +304,12 @@ if errors > 0:
     if not force:
         logging.die(50, "Aborting use --force if needed")
 
-nupd = 0
+updates = []
 for objind, aplist in calculated_apertures.items():
-
-    obj = retrieved_objects[objind]
     aps = np.array([a for oi, a in aplist])
+    updates.append((round(float(aps.mean()), 2), round(float(aps.std()), 2), aps.size, objind))
 
-    nupd += dbcurs.execute("UPDATE objdata SET apsize={:.2f},apstd={:.2f},basedon={:d} WHERE ind={:d}".format(aps.mean(),aps.std(),aps.size,objind))
-    mydb.commit()
+nupd = dbcurs.executemany("UPDATE objdata SET apsize=%s,apstd=%s,basedon=%s WHERE ind=%s", updates)
+mydb.commit()
 
 logging.write(nupd, "updates")
@@ -0,0 +1,204 @@
+"""Circular aperture photometry for many objects and aperture sizes at once.
+
+The pixels around all the centres are cut out into one stacked array, and
+the fraction of each pixel inside each aperture is worked out by sampling each
+pixel on an nsub by nsub grid, so nsub=1 counts a pixel as in the aperture if
+its centre is, and larger values approach the exact overlap area, the default
+being within about 1% of it for the apertures used.
+
+Sums, numbers of pixels and errors for every centre and radius are returned as
+a structured array, the centres being taken in chunks so the weights for each
+chunk fit in WEIGHTS_CHUNK_BYTES.
+
+For searching for the best centre of apertures, an integral image is kept
+with each image, being cumulative sums along each row and these summed down the
+columns, so any box sum takes 4 lookups and any disc (with pixels counted if
+their centres are inside it) one lookup per row of the disc."""
+
+import numpy as np
+import multifind
+
+DEFAULT_NSUB = 5
+WEIGHTS_CHUNK_BYTES = 16 * 1024 * 1024
+
+PHOT_DTYPE = np.dtype([('col', np.float64), ('row', np.float64), ('radius', np.float64),
+                       ('adus', np.float64), ('aduerr', np.float64), ('npix', np.float64)])
+
+
+class AppPhotErr(Exception):
+    """Throw if we have problems with photometry"""
+
+
+def overlap_weights(cols, rows, radii, halfside, nsub=DEFAULT_NSUB):
+    """Get fraction of each pixel in windows of side 2 * halfside + 1 centred on the nearest pixels
+    to (cols, rows) lying inside circles of each radius about (cols, rows).
+
+    Return array of shape (number of centres, number of radii, side, side)"""
+
+    cols = np.asarray(cols, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.float64)
+    radsq = np.asarray(radii, dtype=np.float64) ** 2
+    fcol = (cols - np.rint(cols))[:, np.newaxis, np.newaxis, np.newaxis]
+    frow = (rows - np.rint(rows))[:, np.newaxis, np.newaxis, np.newaxis]
+    offs = np.arange(-halfside, halfside + 1, dtype=np.float64)
+    prow = offs[np.newaxis, np.newaxis, :, np.newaxis]
+    pcol = offs[np.newaxis, np.newaxis, np.newaxis, :]
+    radsq = radsq[np.newaxis, :, np.newaxis, np.newaxis]
+
+    # Sub-pixel sample points at the centres of an nsub x nsub grid on each pixel
+
+    subs = (np.arange(nsub, dtype=np.float64) + 0.5) / nsub - 0.5
+    weights = np.zeros((cols.size, radsq.shape[1], offs.size, offs.size))
+    for sr in subs:
+        drsq = (prow + sr - frow) ** 2
+        for sc in subs:
+            weights += drsq + (pcol + sc - fcol) ** 2 <= radsq
+    return weights / (nsub * nsub)
+
+
+def aperture_sums(data, cols, rows, radii, variance=None, nsub=DEFAULT_NSUB):
+    """Sum data in circular apertures of each of radii about each of (cols, rows).
+
+    variance may be None, a scalar or an array of the same shape as data, in which case errors
+    are propagated from it, otherwise errors are left as zero.
+
+    Pixels outside the image or NaN are left out and not counted in npix.
+
+    Return structured array of shape (number of centres, number of radii)"""
+
+    cols = np.atleast_1d(np.asarray(cols, dtype=np.float64))
+    rows = np.atleast_1d(np.asarray(rows, dtype=np.float64))
+    radii = np.atleast_1d(np.asarray(radii, dtype=np.float64))
+    if cols.shape != rows.shape:
+        raise AppPhotErr("Number of columns and rows differ")
+    result = np.zeros((cols.size, radii.size), dtype=PHOT_DTYPE)
+    result['col'] = cols[:, np.newaxis]
+    result['row'] = rows[:, np.newaxis]
+    result['radius'] = radii[np.newaxis, :]
+    if cols.size == 0 or radii.size == 0:
+        return result
+
+    icols = np.rint(cols).astype(np.int64)
+    irows = np.rint(rows).astype(np.int64)
+    if np.any(icols < 0) or np.any(irows < 0) or np.any(icols >= data.shape[1]) or np.any(irows >= data.shape[0]):
+        raise AppPhotErr("Aperture centre outside image")
+    halfside = int(np.ceil(radii.max())) + 1
+    side = 2 * halfside + 1
+    chunk = max(1, WEIGHTS_CHUNK_BYTES // (radii.size * side * side * 8))
+
+    for start in range(0, cols.size, chunk):
+        sel = slice(start, start + chunk)
+        windows = multifind.cut_windows(data, irows[sel], icols[sel], halfside)
+        valid = np.isfinite(windows)
+        weights = overlap_weights(cols[sel], rows[sel], radii, halfside, nsub) * valid[:, np.newaxis]
+        res = result[sel]
+        res['adus'] = np.einsum('nrij,nij->nr', weights, np.where(valid, windows, 0.0))
+        res['npix'] = weights.sum(axis=(2, 3))
+        if variance is not None:
+            if np.ndim(variance) == 0:
+                varsum = np.einsum('nrij,nrij->nr', weights, weights) * float(variance)
+            else:
+                varwin = multifind.cut_windows(variance, irows[sel], icols[sel], halfside)
+                varsum = np.einsum('nrij,nrij,nij->nr', weights, weights, np.where(valid, varwin, 0.0))
+            res['aduerr'] = np.sqrt(varsum)
+    return result
+
+
+def growth_curves(data, cols, rows, minap, maxap, sky=0.0, variance=None, nsub=DEFAULT_NSUB):
+    """Get sky-subtracted sums for each integer aperture size from minap to maxap inclusive about each centre.
+
+    Return structured array as per aperture_sums with sky subtracted from adus"""
+    result = aperture_sums(data, cols, rows, np.arange(minap, maxap + 1), variance, nsub)
+    result['adus'] -= result['npix'] * sky
+    return result
+
+
+class IntegralImage:
+    """Cumulative sums of an image with NaNs taken as zero and not counted as pixels"""
+
+    def __init__(self, data):
+        self.source = data
+        self.nrows, self.ncols = data.shape
+        valid = np.isfinite(data)
+        self.rowsum = np.zeros((self.nrows, self.ncols + 1))
+        np.cumsum(np.where(valid, data, 0.0), axis=1, out=self.rowsum[:, 1:])
+        self.rowcount = np.zeros((self.nrows, self.ncols + 1), dtype=np.int64)
+        np.cumsum(valid, axis=1, out=self.rowcount[:, 1:])
+        self.table = np.zeros((self.nrows + 1, self.ncols + 1))
+        np.cumsum(self.rowsum, axis=0, out=self.table[1:])
+        self.counttable = np.zeros((self.nrows + 1, self.ncols + 1), dtype=np.int64)
+        np.cumsum(self.rowcount, axis=0, out=self.counttable[1:])
+
+    def box_sums(self, rows, cols, halfside):
+        """Get sums and numbers of pixels in boxes of side 2 * halfside + 1 about integer (rows, cols)
+        clipped at the edges of the image"""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        r0 = np.clip(rows - halfside, 0, self.nrows)
+        r1 = np.clip(rows + halfside + 1, 0, self.nrows)
+        c0 = np.clip(cols - halfside, 0, self.ncols)
+        c1 = np.clip(cols + halfside + 1, 0, self.ncols)
+        sums = self.table[r1, c1] - self.table[r0, c1] - self.table[r1, c0] + self.table[r0, c0]
+        npix = self.counttable[r1, c1] - self.counttable[r0, c1] - self.counttable[r1, c0] + self.counttable[r0, c0]
+        return sums, npix
+
+    def disc_sums(self, rows, cols, radius):
+        """Get sums and numbers of pixels with centres within radius of integer (rows, cols)
+        which may be arrays of any shape, clipped at the edges of the image"""
+        rows = np.asarray(rows, dtype=np.int64)[..., np.newaxis]
+        cols = np.asarray(cols, dtype=np.int64)[..., np.newaxis]
+        rad = int(np.floor(radius))
+        drows = np.arange(-rad, rad + 1)
+        halfwidths = np.floor(np.sqrt(np.maximum(radius * radius - drows * drows, 0.0))).astype(np.int64)
+        rr = rows + drows
+        inside = (rr >= 0) & (rr < self.nrows)
+        rr = np.clip(rr, 0, self.nrows - 1)
+        c0 = np.clip(cols - halfwidths, 0, self.ncols)
+        c1 = np.clip(cols + halfwidths + 1, 0, self.ncols)
+        sums = np.where(inside, self.rowsum[rr, c1] - self.rowsum[rr, c0], 0.0).sum(axis=-1)
+        npix = np.where(inside, self.rowcount[rr, c1] - self.rowcount[rr, c0], 0).sum(axis=-1)
+        return sums, npix
+
+    def annulus_sums(self, rows, cols, inner, outer):
+        """Get sums and numbers of pixels with centres between inner (exclusive) and outer (inclusive)
+        radii about integer (rows, cols)"""
+        osums, onpix = self.disc_sums(rows, cols, outer)
+        isums, inpix = self.disc_sums(rows, cols, inner)
+        return osums - isums, onpix - inpix
+
+
+def integral_image(fitsfile):
+    """Get integral image for the data in fitsfile, keeping it with the file so it is only made once"""
+    integ = getattr(fitsfile, 'integral', None)
+    if integ is None or integ.source is not fitsfile.data:
+        integ = IntegralImage(fitsfile.data)
+        fitsfile.integral = integ
+    return integ
+
+
+def findbest_many(integ, cols, rows, apsize, maxshift):
+    """Find centres within maxshift pixels each way of (cols, rows) giving the largest sums in apertures
+    of radius apsize, preferring the smallest shift where sums are equal.
+
+    Return arrays of columns, rows, sums and numbers of pixels"""
+    icols = np.atleast_1d(np.rint(np.asarray(cols, dtype=np.float64))).astype(np.int64)
+    irows = np.atleast_1d(np.rint(np.asarray(rows, dtype=np.float64))).astype(np.int64)
+    shifts = np.arange(-maxshift, maxshift + 1)
+    srow, scol = np.meshgrid(shifts, shifts, indexing='ij')
+    order = np.argsort(srow.ravel() ** 2 + scol.ravel() ** 2, kind='stable')
+    srow = srow.ravel()[order]
+    scol = scol.ravel()[order]
+    crows = np.clip(irows[:, np.newaxis] + srow, 0, integ.nrows - 1)
+    ccols = np.clip(icols[:, np.newaxis] + scol, 0, integ.ncols - 1)
+    sums, npix = integ.disc_sums(crows, ccols, apsize)
+    best = sums.argmax(axis=1)
+    n = np.arange(icols.size)
+    return ccols[n, best], crows[n, best], sums[n, best], npix[n, best]
+
+
+def findbest_colrow(integ, col, row, apsize, maxshift):
+    """Version of FindResults.findbest_colrow using the integral image.
+
+    Return (col, row, sum of ADUs, number of pixels)"""
+    bcols, brows, sums, npix = findbest_many(integ, [col], [row], apsize, maxshift)
+    return int(bcols[0]), int(brows[0]), float(sums[0]), int(npix[0])
@@ -12,6 +12,7 @@ import remfits
 import find_results
 import objedits
 import objdata
+import skyregion
 import searchparam
 import logs
 
@@ -89,6 +90,7 @@ def create_invented_object(fres, newobject):
     newfr.obj = newobject
     findres.resultlist.append(newfr)
     newobject.put(dbcurs)
+    skyregion.set_object_cell(dbcurs, newobject.objname, newfr.radeg, newfr.decdeg)
     return  True
 
 # Shut up warning messages
@@ -4,9 +4,10 @@
 
 import argparse
 import sys
+import time
+from multiprocessing import Pool
 #import math
 import warnings
-#import numpy as np
 from astropy.utils.exceptions import ErfaWarning
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import remdefaults
@@ -14,8 +15,121 @@ import remfits
 import col_from_file
 import stdarray
 import find_results
+import apphot
 import logs
 
+FINDRESULT_QUERY = "SELECT obsind,objind,nrow,ncol,apsize,ind,amp,sigma FROM findresult WHERE hide=0 AND obsind IN ({:s})"
+ADUCALC_INSERT = "INSERT INTO aducalc (objind,obsind,frind,skylevel,skystd,apsize,aducount,aduerr,modaducount,modaduerr) " \
+                 "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+FINDRESULT_UPDATE = "UPDATE findresult SET apsize=%s,adus=%s,modadus=%s WHERE ind=%s"
+
+
+def findresult_rows(curs, obsinds):
+    """Get find results for all the given obsinds in one query, returning dictionary of lists
+    of (objind, row, col, apsize, frind, fr) indexed by obsind, fr being a FindResult with
+    what is needed to calculate the model integral"""
+    result = dict()
+    if len(obsinds) == 0:
+        return result
+    curs.execute(FINDRESULT_QUERY.format(",".join(["%s"] * len(obsinds))), list(obsinds))
+    for obsind, objind, row, col, apsize, frind, amp, sigma in curs.fetchall():
+        fr = find_results.FindResult()
+        fr.amp = amp
+        fr.sigma = sigma
+        if obsind not in result:
+            result[obsind] = []
+        result[obsind].append((objind, row, col, apsize, frind, fr))
+    return result
+
+
+def init_worker():
+    """Give each worker process its own database connection"""
+    global dbcurs
+    mydb, dbcurs = remdefaults.opendb()
+
+
+def calc_file(file):
+    """Calculate ADUs for find results in one file.
+
+    Return (file, obsind, status, messages, results) where status is None if OK, 'error' or 'null'"""
+
+    messages = []
+    try:
+        ff = remfits.parse_filearg(file, dbcurs)
+    except remfits.RemFitsErr as e:
+        return file, 0, 'error', ["Cannot open error was " + e.args[0]], []
+
+    obsind = ff.from_obsind
+    if obsind == 0:
+        return file, 0, 'error', ["No obsind found"], []
+
+    try:
+        frows = prefetched[obsind]
+    except KeyError:
+        frows = findresult_rows(dbcurs, [obsind]).get(obsind, [])
+    if  len(frows) == 0:
+        return file, obsind, 'null', ["No find results"], []
+
+    imagedata = ff.data
+    fimagedata = imagedata.flatten()
+    skymask = fimagedata - ff.meanval <= skylevelstd * ff.stdval
+    fimagedata = fimagedata[skymask]
+    if len(fimagedata) < 100:
+        return file, obsind, 'error', ["No possible sky"], []
+
+    # We've hopefully excluded objects from result so we can put
+    # the std dev of the sky in as the error
+
+    imagedata = stdarray.StdArray(values=imagedata, stddevs=fimagedata.std())
+
+    # Apply bias and flats
+
+    imagedata -= biasarray
+    imagedata /= flatarray
+
+    # Calculate sky level again and subtract.
+
+    fimagedata = imagedata.get_values().flatten()[skymask]
+    skylevel = float(fimagedata.mean())
+    skystd = float(fimagedata.std())
+
+    # Sums for all the objects with each aperture size at once. Errors come from the
+    # std devs propagated through the bias and flat by StdArray for each object
+
+    values = imagedata.get_values()
+    sums = dict()
+    byap = dict()
+    for objind, row, col, apsize, frind, fr in frows:
+        try:
+            dummy, aduerr = imagedata.get_sum(col, row, apsize)
+        except stdarray.StdArrayErr as e:
+            if e.errortype == stdarray.INVALID_COL:
+                messages.append("Cannot fetch for obj {:d} column {} out of range".format(objind, e.args[1]))
+            elif e.errortype == stdarray.INVALID_ROW:
+                messages.append("Cannot fetch for obj {:d} row {} out of range".format(objind, e.args[1]))
+            else:
+                messages.append("Cannot fetch for obj {:d} {:s}".format(objind, e.args[0]))
+            continue
+        byap.setdefault(apsize, []).append((frind, col, row, aduerr))
+    for apsize, objs in byap.items():
+        phot = apphot.aperture_sums(values, [c for f, c, r, e in objs], [r for f, c, r, e in objs], [apsize])
+        for (frind, col, row, aduerr), ph in zip(objs, phot[:, 0]):
+            sums[frind] = (ph['adus'], aduerr)
+
+    results = []
+    for objind, row, col, apsize, frind, fr in frows:
+        if frind not in sums:
+            continue
+        adus, aduerr = sums[frind]
+        if adus <= 0:
+            messages.append("Skipping {:d} as negative {}".format(objind, adus))
+            continue
+        modadus = fr.calculate_mod_integral()
+        modaduerr = aduerr # cheat for now
+        results.append((objind, obsind, frind, skylevel, skystd, round(float(apsize), 2), float(adus), float(aduerr), float(modadus), float(modaduerr)))
+    return file, obsind, None, messages, results
+
+
 warnings.simplefilter('ignore', ErfaWarning)
 warnings.simplefilter('ignore', AstropyWarning)
 warnings.simplefilter('ignore', AstropyUserWarning)
@@ -30,6 +144,8 @@ parsearg.add_argument('--colnum', type=int, default=0, help='Column to use from
 parsearg.add_argument('--skylevelstd', type=float, default=remfits.DEFAULT_SKYLEVELSTD, help='Theshold level of std devs to include points in sky')
 parsearg.add_argument('--stoperr', action='store_false', help='Stop processing if any errors met')
 parsearg.add_argument('--nullstop', action='store_true', help='Stop processing if nothing found for an observation')
+parsearg.add_argument('--maxproc', type=int, default=8, help='Maximum number of processes to run')
+parsearg.add_argument('--timing', action='store_true', help='Report time taken calculating and saving')
 logs.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
@@ -43,6 +159,8 @@ if len(ids) == 0:
 biasfile = remdefaults.stdarray_file(resargs['biasfile'])
 flatfile = remdefaults.stdarray_file(resargs['flatfile'])
 logging = logs.getargs(resargs)
+maxproc = resargs['maxproc']
+timing = resargs['timing']
 
 try:
     biasarray = stdarray.load_array(biasfile)
@@ -60,74 +178,28 @@ mydb, dbcurs = remdefaults.opendb(waitlock=True)
 had_obsind = set()
 resulttab = []
 
-for file in ids:
-    logging.set_filename(file)
-    try:
-        ff = remfits.parse_filearg(file, dbcurs)
-    except remfits.RemFitsErr as e:
-        logging.write("Cannot open error was", e.args[0])
-        errors += 1
-        continue
+# Ids are normally obsids so get all the find results for them in one go
+# Anything else gets looked up by the worker once it knows the obsind
 
-    obsind = ff.from_obsind
-    if obsind == 0:
-        logging.write("No obsind found")
-        errors += 1
-        continue
+starttime = time.time()
+prefetched = findresult_rows(dbcurs, set([int(i) for i in ids if str(i).isdigit()]))
 
-    had_obsind.add(obsind)
-    dbcurs.execute("SELECT objind,nrow,ncol,apsize,ind FROM findresult WHERE hide=0 AND obsind={:d}".format(obsind))
-    frows = dbcurs.fetchall()
-    if  len(frows) == 0:
-        logging.write("No find results")
-        nullres += 1
-        continue
-
-    imagedata = ff.data
-    fimagedata = imagedata.flatten()
-    skymask = fimagedata - ff.meanval <= skylevelstd * ff.stdval
-    fimagedata = fimagedata[skymask]
-    if len(fimagedata) < 100:
-        logging.write("No possible sky")
-        errors += 1
-        continue
-
-    # We've hopefully excluded objects from result so we can put
-    # the std dev of the sky in as the error
-
-    imagedata = stdarray.StdArray(values=imagedata, stddevs=fimagedata.std())
-
-    # Apply bias and flats
-
-    imagedata -= biasarray
-    imagedata /= flatarray
-
-    # Calculate sky level again and subtract.
-
-    fimagedata = imagedata.get_values().flatten()[skymask]
-    skylevel = fimagedata.mean()
-    skystd = fimagedata.std()
-
-    for objind, row, col, apsize, frind in frows:
-
-        try:
-            adus, aduerr = imagedata.get_sum(col, row, apsize)
-        except stdarray.StdArrayErr as e:
-            if e.errortype == stdarray.INVALID_COL:
-                logging.write("Cannot fetch for obj", objind, "column", e.args[1], "out of range")
-            elif e.errortype == stdarray.INVALID_ROW:
-                logging.write("Cannot fetch for obj", objind, "row", e.args[1], "out of range")
-            else:
-                logging.write("Cannot fetch for obj", objind, e.args[0])
+with Pool(max(1, min(len(ids), maxproc)), initializer=init_worker) as pool:
+    for file, obsind, status, messages, results in pool.imap(calc_file, ids):
+        logging.set_filename(file)
+        for mess in messages:
+            logging.write(mess)
+        if status == 'error':
+            errors += 1
             continue
-        if adus <= 0:
-            logging.write("Skipping", objind, "as negative", adus)
+        had_obsind.add(obsind)
+        if status == 'null':
+            nullres += 1
             continue
-        fr = find_results.FindResult()
-        fr.loaddb(dbcurs, ind=frind)
-        modadus = fr.calculate_mod_integral()
-        modaduerr = aduerr # cheat for now
-        resulttab.append((obsind, objind, frind, skylevel, skystd, apsize, adus, aduerr, modadus, modaduerr))
+        resulttab += results
+
+logging.set_filename("")
+calctime = time.time() - starttime
 
 if errors != 0:
     logging.write(errors, "errors found")
@@ -141,30 +213,22 @@ if nullres != 0:
 if len(resulttab) == 0:
     logging.die(2, "No usable results found")
 
-# Delete previous with the observations we had
+# Delete previous with the observations we had and save new ones in one transaction
 
-deletions = 0
-for obsind in had_obsind:
-    deletions += dbcurs.execute("DELETE FROM aducalc WHERE obsind={:d}".format(obsind))
+starttime = time.time()
+obslist = sorted(had_obsind)
+deletions = dbcurs.execute("DELETE FROM aducalc WHERE obsind IN (" + ",".join(["%s"] * len(obslist)) + ")", obslist)
 if deletions == 0:
     logging.write("No existing adu calculations deleted")
 else:
-    mydb.commit()
     logging.write(deletions, "existing calculations deleted")
 
-for obsind, objind, frind, skylevel, skystd, apsize, adus, aduerr, modadus, modaduerr in resulttab:
-    dbcurs.execute("INSERT INTO aducalc (objind,obsind,frind,skylevel,skystd,apsize,aducount,aduerr,modaducount,modaduerr) " \
-                   "VALUES ({:d},{:d},{:d},{:.8e},{:.8e},{:.2f},{:.8e},{:.8e},{:.8e},{:.8e})".format(objind,
-                                                                                                      obsind,
-                                                                                                      frind,
-                                                                                                      skylevel,
-                                                                                                      skystd,
-                                                                                                      apsize,
-                                                                                                      adus,
-                                                                                                      aduerr,
-                                                                                                      modadus,
-                                                                                                      modaduerr))
-    dbcurs.execute("UPDATE findresult SET apsize={:.2f},adus={:.8e},modadus={:.8e} WHERE ind={:d}".format(apsize,adus,modadus,frind))
+dbcurs.executemany(ADUCALC_INSERT, resulttab)
+dbcurs.executemany(FINDRESULT_UPDATE, [(apsize, adus, modadus, frind) for objind, obsind, frind, skylevel, skystd, apsize, adus, aduerr, modadus, modaduerr in resulttab])
 mydb.commit()
+savetime = time.time() - starttime
+
 logging.write(len(resulttab), "rows added")
+if timing:
+    logging.write("{:d} files in {:.3f} seconds {:.1f} files/sec, saved in {:.3f} seconds".format(len(ids), calctime, len(ids) / max(calctime, 1e-6), savetime))
 sys.exit(0)
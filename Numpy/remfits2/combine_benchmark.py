@@ -0,0 +1,53 @@
+#!  /usr/bin/env python3
+
+"""Compare speed and noise of frame combining methods against np.median on synthetic bias frames"""
+
+import argparse
+import sys
+import time
+import numpy as np
+import combine_frames
+
+parsearg = argparse.ArgumentParser(description='Benchmark frame combining methods', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parsearg.add_argument('--nframes', type=int, default=30, help='Number of frames to combine')
+parsearg.add_argument('--size', type=int, default=1024, help='Size of side of each frame')
+parsearg.add_argument('--level', type=float, default=300.0, help='Mean level of frames')
+parsearg.add_argument('--noise', type=float, default=5.0, help='Std dev of noise in frames')
+parsearg.add_argument('--cosmics', type=float, default=0.001, help='Proportion of pixels in each frame hit by cosmic rays')
+parsearg.add_argument('--cosmiclevel', type=float, default=5000.0, help='Level added by cosmic rays')
+parsearg.add_argument('--memlimit', type=float, default=combine_frames.DEFAULT_MEMLIMIT, help='Memory in MB to use for each band of rows combined')
+parsearg.add_argument('--seed', type=int, default=42, help='Random number seed')
+
+resargs = vars(parsearg.parse_args())
+nframes = resargs['nframes']
+size = resargs['size']
+level = resargs['level']
+noise = resargs['noise']
+cosmics = resargs['cosmics']
+cosmiclevel = resargs['cosmiclevel']
+memlimit = resargs['memlimit']
+
+rng = np.random.default_rng(resargs['seed'])
+truth = level + rng.normal(0.0, noise / 10.0, (size, size))
+cube = truth + rng.normal(0.0, noise, (nframes, size, size))
+hits = rng.random(cube.shape) < cosmics
+cube[hits] += cosmiclevel * rng.random(np.count_nonzero(hits))
+
+print("{:<40s} {:>9s} {:>8s} {:>8s}".format("Method", "Time", "Bias", "Noise"))
+starttime = time.time()
+result = np.median(cube, axis=0)
+elapsed = time.time() - starttime
+resid = result - truth
+print("{:<40s} {:8.3f}s {:8.3f} {:8.3f}".format("np.median (whole cube)", elapsed, resid.mean(), resid.std()))
+
+for method in combine_frames.COMBINE_METHODS:
+    if method == 'gmean':
+        continue
+    params = combine_frames.CombineParams(method)
+    try:
+        result, cstats = combine_frames.combine(cube, params, memlimit=memlimit)
+    except combine_frames.CombineErr as e:
+        print("Could not combine using", method, "error was", e.args[0], file=sys.stderr)
+        continue
+    resid = result - truth
+    print("{:<40s} {:8.3f}s {:8.3f} {:8.3f}".format(params.describe(), cstats.elapsed, resid.mean(), resid.std()))
@@ -0,0 +1,349 @@
+"""Combine stacks of equal-sized frames a band of rows at a time so that
+memory use stays within a given budget however many frames there are"""
+
+import os
+import time
+import resource
+import tempfile
+import warnings
+import numpy as np
+
+DEFAULT_MEMLIMIT = 256          # Megabytes to allow for working on each band
+DEFAULT_NSIGMA = 3.0
+DEFAULT_MAXITER = 5
+DEFAULT_NREJECT = 1             # Number of lowest and highest values rejected by minmax
+
+COMBINE_METHODS = ('median', 'mean', 'sigclip', 'minmax', 'gmean')
+
+# Working copies made by median and rejection as a multiple of the band size
+
+WORK_FACTOR = 4
+
+
+class CombineErr(Exception):
+    """Throw if we have problems combining frames"""
+
+
+class CombineStats:
+    """Record of how a combine went for reporting"""
+
+    def __init__(self, nframes, shape):
+        self.nframes = nframes
+        self.shape = shape
+        self.nbands = 0
+        self.bandrows = 0
+        self.elapsed = 0.0
+
+    def npixels(self):
+        """Total number of pixels processed"""
+        return self.nframes * self.shape[0] * self.shape[1]
+
+    def throughput(self):
+        """Megapixels per second processed"""
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.npixels() / self.elapsed / 1e6
+
+    def report(self):
+        """Give a one-line summary"""
+        return "{:d} frames {:d}x{:d} in {:d} bands of {:d} rows {:.2f}s {:.1f} Mpix/s peak memory {:.1f} MB".format(
+            self.nframes, self.shape[0], self.shape[1], self.nbands, self.bandrows,
+            self.elapsed, self.throughput(), peak_memory())
+
+
+def peak_memory():
+    """Return peak resident memory of this process in megabytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class FrameStack:
+    """Stack of frames held in a memory-mapped scratch file.
+
+    Frames are copied in as they are loaded so the caller can drop each one
+    straight away, and bands of rows from all the frames are read back."""
+
+    def __init__(self, maxframes, shape, dtype=np.float64, tmpdir=None):
+        self.shape = tuple(shape)
+        self.nframes = 0
+        fd, self.filename = tempfile.mkstemp(prefix='stack', suffix='.npy', dir=tmpdir)
+        os.close(fd)
+        try:
+            self.cube = np.lib.format.open_memmap(self.filename, mode='w+', dtype=dtype, shape=(maxframes, ) + self.shape)
+        except (OSError, ValueError) as e:
+            os.unlink(self.filename)
+            raise CombineErr("Could not create stack file " + self.filename + " error was " + str(e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.nframes
+
+    def add(self, data):
+        """Copy a frame onto the end of the stack"""
+        if data.shape != self.shape:
+            raise CombineErr("Frame shape " + str(data.shape) + " does not match stack shape " + str(self.shape))
+        if self.nframes >= self.cube.shape[0]:
+            raise CombineErr("Stack is full with " + str(self.nframes) + " frames")
+        self.cube[self.nframes] = data
+        self.nframes += 1
+
+    def frames(self):
+        """Return view of the frames loaded so far"""
+        return self.cube[:self.nframes]
+
+    def close(self):
+        """Finish with the stack and remove the scratch file"""
+        if self.cube is not None:
+            del self.cube
+            self.cube = None
+            try:
+                os.unlink(self.filename)
+            except FileNotFoundError:
+                pass
+
+
+def band_rows(nframes, ncols, itemsize, memlimit=DEFAULT_MEMLIMIT):
+    """Work out how many rows of every frame we can deal with at once within memlimit megabytes"""
+    rowbytes = nframes * ncols * itemsize * WORK_FACTOR
+    return max(1, int(memlimit * 1024 * 1024) // rowbytes)
+
+
+class CombineParams:
+    """Parameters for how to combine frames"""
+
+    def __init__(self, method='median', nsigma=DEFAULT_NSIGMA, maxiter=DEFAULT_MAXITER, nlow=DEFAULT_NREJECT, nhigh=DEFAULT_NREJECT):
+        if method not in COMBINE_METHODS:
+            raise CombineErr("Unknown combine method " + method)
+        self.method = method
+        self.nsigma = nsigma
+        self.maxiter = maxiter
+        self.nlow = nlow
+        self.nhigh = nhigh
+
+    def describe(self):
+        """Short description for headers and reports"""
+        if self.method == 'sigclip':
+            return "sigma-clipped mean {:.3g} sigma".format(self.nsigma)
+        if self.method == 'minmax':
+            return "mean rejecting {:d} low {:d} high".format(self.nlow, self.nhigh)
+        if self.method == 'gmean':
+            return "geometric mean"
+        return self.method
+
+
+def parseargs(argp, default='median', methods=COMBINE_METHODS):
+    """Add arguments for combining frames to argument parser"""
+    argp.add_argument('--combine', type=str, default=default, choices=methods, help='Method of combining frames')
+    argp.add_argument('--nsigma', type=float, default=DEFAULT_NSIGMA, help='Rejection threshold in std devs for sigclip')
+    argp.add_argument('--maxiter', type=int, default=DEFAULT_MAXITER, help='Maximum iterations for sigclip')
+    argp.add_argument('--nlow', type=int, default=DEFAULT_NREJECT, help='Number of lowest values to reject for minmax')
+    argp.add_argument('--nhigh', type=int, default=DEFAULT_NREJECT, help='Number of highest values to reject for minmax')
+
+
+def getargs(resargs):
+    """Get combine parameters from parsed arguments"""
+    return CombineParams(resargs['combine'], resargs['nsigma'], resargs['maxiter'], resargs['nlow'], resargs['nhigh'])
+
+
+def frame_weights(weights, block):
+    """Return weights shaped to broadcast along the frame axis of block, or None"""
+    if weights is None:
+        return None
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape != block.shape[:1]:
+        raise CombineErr("Expecting " + str(block.shape[0]) + " weights but have " + str(weights.size))
+    return weights.reshape((block.shape[0], ) + (1, ) * (block.ndim - 1))
+
+
+def masked_mean(block, keep, weights=None):
+    """(Weighted) mean along the frame axis of the values in block selected by keep.
+
+    Pixels with nothing selected come out as NaN"""
+
+    if weights is None:
+        wts = keep.astype(np.float64)
+    else:
+        wts = keep * frame_weights(weights, block)
+    sumw = wts.sum(axis=0)
+    wts *= np.where(keep, block, 0.0)
+    result = wts.sum(axis=0) / np.where(sumw > 0.0, sumw, 1.0)
+    result[sumw <= 0.0] = np.nan
+    return result
+
+
+def sigclip_mask(block, keep, weights=None, nsigma=DEFAULT_NSIGMA, maxiter=DEFAULT_MAXITER):
+    """Iteratively drop from keep values more than nsigma standard deviations from the (weighted)
+    mean of the remaining values for each pixel. Return the reduced keep mask"""
+
+    vals = np.where(keep, block, 0.0)
+    fw = frame_weights(weights, block)
+    nkept = np.count_nonzero(keep)
+    for _ in range(maxiter):
+        wts = keep.astype(np.float64)
+        if fw is not None:
+            wts *= fw
+        sumw = np.maximum(wts.sum(axis=0), 1e-300)
+        means = (wts * vals).sum(axis=0) / sumw
+        devs = np.abs(vals - means)
+        stds = np.sqrt((wts * devs ** 2).sum(axis=0) / sumw)
+        newkeep = keep & (devs <= nsigma * stds)
+        newkept = np.count_nonzero(newkeep)
+        if newkept == nkept:
+            break
+        keep = newkeep
+        nkept = newkept
+    return keep
+
+
+def minmax_mask(block, keep, nlow=DEFAULT_NREJECT, nhigh=DEFAULT_NREJECT):
+    """Drop from keep the nlow lowest and nhigh highest values for each pixel.
+    Uses partial partitions rather than a sort along the frame axis"""
+
+    nframes = block.shape[0]
+    if nlow + nhigh >= nframes:
+        raise CombineErr("Cannot reject {:d} values from {:d} frames".format(nlow + nhigh, nframes))
+    keep = keep.copy()
+    if nlow == 1:
+        lows = np.argmin(np.where(keep, block, np.inf), axis=0)[np.newaxis]
+        np.put_along_axis(keep, lows, False, axis=0)
+    elif nlow > 1:
+        lows = np.argpartition(np.where(keep, block, np.inf), nlow - 1, axis=0)[:nlow]
+        np.put_along_axis(keep, lows, False, axis=0)
+    if nhigh == 1:
+        highs = np.argmax(np.where(keep, block, -np.inf), axis=0)[np.newaxis]
+        np.put_along_axis(keep, highs, False, axis=0)
+    elif nhigh > 1:
+        highs = np.argpartition(np.where(keep, block, -np.inf), nframes - nhigh, axis=0)[nframes - nhigh:]
+        np.put_along_axis(keep, highs, False, axis=0)
+    return keep
+
+
+def reject_mask(block, params, weights=None):
+    """Return mask of values in block to keep after rejection according to params.
+    NaNs are never kept"""
+
+    keep = np.isfinite(block)
+    if params.method == 'sigclip':
+        return sigclip_mask(block, keep, weights, params.nsigma, params.maxiter)
+    if params.method == 'minmax':
+        return minmax_mask(block, keep, params.nlow, params.nhigh)
+    return keep
+
+
+class GeomMeanAccumulator:
+    """Accumulate the geometric mean of frames one at a time in log space.
+
+    Non-positive or NaN values and pixels in the exclusion mask are left out of
+    the mean for that pixel rather than being treated as errors"""
+
+    def __init__(self, shape, exclude=None, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.exclude = exclude
+        self.dtype = np.dtype(dtype)
+        self.work = np.empty(self.shape, dtype=self.dtype)
+        self.valid = np.empty(self.shape, dtype=bool)
+        self.logsums = np.zeros(self.shape, dtype=np.float64)
+        self.counts = np.zeros(self.shape, dtype=np.int32)
+        self.nframes = 0
+        self.nexcluded = 0
+
+    def add(self, data, subtract=None):
+        """Fold in a frame, optionally subtracting (e.g. bias) first"""
+        if data.shape != self.shape:
+            raise CombineErr("Frame shape " + str(data.shape) + " does not match shape " + str(self.shape))
+        if subtract is None:
+            self.work[...] = data
+        else:
+            np.subtract(data, subtract, out=self.work, casting='unsafe')
+        np.greater(self.work, 0.0, out=self.valid)
+        self.nexcluded += self.valid.size - np.count_nonzero(self.valid)
+        if self.exclude is not None:
+            self.valid &= ~self.exclude
+        np.log(self.work, out=self.work, where=self.valid)
+        np.add(self.logsums, self.work, out=self.logsums, where=self.valid)
+        self.counts += self.valid
+        self.nframes += 1
+
+    def result(self, fill=np.nan):
+        """Return the geometric mean, with fill where there were no valid values"""
+        if self.nframes == 0:
+            raise CombineErr("No frames to combine")
+        res = np.exp(self.logsums / np.maximum(self.counts, 1))
+        res[self.counts == 0] = fill
+        return res
+
+
+def log_frame(data, subtract=None, exclude=None):
+    """Return log of data (less subtract if given) with NaN where the value is not positive
+    or excluded, together with the number of non-positive values"""
+
+    work = np.array(data, dtype=np.float64)
+    if subtract is not None:
+        work -= subtract
+    valid = work > 0.0
+    nexcluded = valid.size - np.count_nonzero(valid)
+    if exclude is not None:
+        valid &= ~exclude
+    np.log(work, out=work, where=valid)
+    work[~valid] = np.nan
+    return work, nexcluded
+
+
+def gmean_block(block, exclude=None, weights=None):
+    """Geometric mean along the frame axis of block, overwriting block with its logarithm.
+
+    Non-positive or NaN values and pixels in exclude are left out, pixels with no
+    valid values come out as NaN"""
+
+    keep = block > 0.0
+    if exclude is not None:
+        keep &= ~exclude
+    np.log(block, out=block, where=keep)
+    return np.exp(masked_mean(block, keep, weights))
+
+
+def combine_block(block, params, weights=None):
+    """Combine a block of frames (or bands of frames) along the first axis according to params.
+    NaN values are treated as missing"""
+
+    if params.method == 'median':
+        if weights is not None:
+            raise CombineErr("Cannot use weights with median")
+        if np.isnan(block).any():
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return np.nanmedian(block, axis=0)
+        return np.median(block, axis=0)
+    if params.method == 'gmean':
+        return gmean_block(block, weights=weights)
+    return masked_mean(block, reject_mask(block, params, weights), weights)
+
+
+def combine(stack, params, memlimit=DEFAULT_MEMLIMIT, weights=None):
+    """Combine frames in stack (FrameStack or array) band by band within memlimit megabytes.
+
+    Return the combined frame and a CombineStats structure"""
+
+    if isinstance(stack, FrameStack):
+        cube = stack.frames()
+    else:
+        cube = stack
+    nframes, nrows, ncols = cube.shape
+    if nframes == 0:
+        raise CombineErr("No frames to combine")
+
+    stats = CombineStats(nframes, (nrows, ncols))
+    result = np.empty((nrows, ncols), dtype=np.float64)
+    stats.bandrows = min(nrows, band_rows(nframes, ncols, result.itemsize, memlimit))
+    starttime = time.time()
+    for startrow in range(0, nrows, stats.bandrows):
+        endrow = min(startrow + stats.bandrows, nrows)
+        block = np.array(cube[:, startrow:endrow, :], dtype=np.float64)
+        result[startrow:endrow] = combine_block(block, params, weights)
+        stats.nbands += 1
+    stats.elapsed = time.time() - starttime
+    return result, stats
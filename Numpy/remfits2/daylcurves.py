@@ -15,16 +15,18 @@ import find_results
 import objdata
 import remgeom
 import miscutils
+import lcstore
+import hoverpick
 
 
 class Result:
 
     """Recuord results"""
 
-    def __init__(self, when, filtname, findresult, obsind, adubyref=None):
+    def __init__(self, when, filtname, adus, obsind, adubyref=None):
         self.when = when
         self.filtname = filtname
-        self.findres = findresult
+        self.adus = adus
         if adubyref is None:
             self.refset = self.adubyref = None
         else:
@@ -36,8 +38,7 @@ class Result:
 
 Valuelist = np.array([]).reshape(0, 2)
 Points_list = []
-Annotation = None
-XBase = YBase = XScale = YScale = None
+Picker = Popup = None
 
 
 def setup_hover(plotres, obs):
@@ -49,53 +50,37 @@ def setup_hover(plotres, obs):
 
 def complete_hover(figur):
     """Complete setup of hover"""
-    global Annotation, XBase, YBase, XScale, YScale, Valuelist
+    global Picker, Popup
     canv = figur.canvas
     axs = figur.axes[0]
-    Annotation = axs.annotate("", xy=(0, 0), xytext=(20, 20),
+    annotation = axs.annotate("", xy=(0, 0), xytext=(20, 20),
                               xycoords='figure pixels',
                               textcoords="offset points",
                               bbox=dict(boxstyle="round",
                               fc=popupcolour),
                               arrowprops=dict(arrowstyle="->"))
-    Annotation.get_bbox_patch().set_alpha(alphaflag)
-    Annotation.set_visible(False)
+    annotation.get_bbox_patch().set_alpha(alphaflag)
+    annotation.set_visible(False)
+    Picker = hoverpick.HoverPicker(axs, Valuelist, flagdist)
+    Popup = hoverpick.BlitPopup(figur, annotation)
     canv.mpl_connect('motion_notify_event', hover)
-    XBase, XScale = axs.get_xlim()
-    YBase, YScale = axs.get_ylim()
-    XScale -= XBase
-    YScale -= YBase
-    Valuelist -= (XBase, YBase)
-    Valuelist /= (XScale, YScale)
-    Valuelist = np.array([complex(r, i) for r, i in Valuelist])
 
 
 def find_nearest_result(event):
     """Get result nearest to event"""
-    axs = event.inaxes
-    if axs is None:
+    ind = Picker.nearest(event)
+    if ind is None:
         return  None
-    distances = np.abs(Valuelist - complex((event.xdata - XBase) / XScale, (event.ydata - YBase) / YScale))
-    min_dist_arg = np.argmin(distances)
-    if  distances[min_dist_arg] <= flagdist:
-        return  Points_list[min_dist_arg]
-    return  None
+    return  Points_list[ind]
 
 
 def hover(event):
     """Callback for mouse hover"""
-    global Annotation
-    vis = Annotation.get_visible()
     res = find_nearest_result(event)
     if res is None:
-        if vis:
-            Annotation.set_visible(False)
-            event.canvas.draw_idle()
+        Popup.hide()
         return
-    Annotation.set_text("{:%d/%m/%Y %H:%M:%S} obsid {:d}".format(res.when, res.obsind))
-    Annotation.xy = (event.x, event.y)
-    Annotation.set_visible(True)
-    event.canvas.draw_idle()
+    Popup.show(res.obsind, "{:%d/%m/%Y %H:%M:%S} obsid {:d}".format(res.when, res.obsind), (event.x, event.y))
 
 
 resultlist = []
@@ -113,7 +98,7 @@ for filtp in Filt_colour:
 rg = remgeom.load()
 
 parsearg = argparse.ArgumentParser(description='Get light curve over day', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parsearg.add_argument('files', nargs='+', type=str, help='Find results files')
+parsearg.add_argument('files', nargs='*', type=str, help='Find results files, not needed with --fromstore')
 parsearg.add_argument('--object', type=str, required=True, help='Object')
 remdefaults.parseargs(parsearg, tempdir=False)
 # parsearg.add_argument('--marker', type=str, default=',', help='Marker style for scatter plot')
@@ -130,6 +115,8 @@ parsearg.add_argument('--bytime', action='store_true', help='Display by time')
 parsearg.add_argument('--ylower', type=float, help='Lower limit of Y axis')
 parsearg.add_argument('--yupper', type=float, help='Upper limit of Y axis')
 parsearg.add_argument('--yscale', type=float, help='Scale for Y axis')
+parsearg.add_argument('--fromstore', action='store_true', help='Take results from light curve store rather than find results files')
+parsearg.add_argument('--storedir', type=str, default=lcstore.DEFAULT_STOREDIR, help='Directory for light curve store')
 rg.disp_argparse(parsearg)
 
 resargs = vars(parsearg.parse_args())
@@ -152,6 +139,8 @@ bytime = resargs['bytime']
 ylower = resargs['ylower']
 yupper = resargs['yupper']
 yscale = resargs['yscale']
+fromstore = resargs['fromstore']
+storedir = resargs['storedir']
 
 if xlab is None:
     if bytime:
@@ -199,6 +188,32 @@ except objdata.ObjDataError as e:
     print("Trouble with", targobj, e.args[0], file=sys.stderr)
     sys.exit(10)
 
+if fromstore:
+    try:
+        tobj = objdata.ObjData()
+        tobj.get(mycurs, name=targobj)
+        lctable = lcstore.load(tobj.vicinity, storedir)
+    except objdata.ObjDataError as e:
+        print("Trouble with", targobj, e.args[0], file=sys.stderr)
+        sys.exit(10)
+    except lcstore.LcStoreErr as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(11)
+    targrows = lcstore.object_rows(lctable, tobj.objind, filt)
+    if userefs:
+        refrows = lcstore.obsind_rows(lctable, targrows['obsind'])
+        refrows = refrows[refrows['objind'] != tobj.objind]
+        refobs = dict()
+        for obsind, objind, adus in zip(refrows['obsind'], refrows['objind'], refrows['adus']):
+            refobs.setdefault(obsind, dict())[objind] = adus
+    for trow in targrows:
+        if userefs:
+            resultlist.append(Result(trow['dateobs'].item(), trow['filter'], trow['adus'], int(trow['obsind']), refobs.get(trow['obsind'], dict())))
+        else:
+            resultlist.append(Result(trow['dateobs'].item(), trow['filter'], trow['adus'], int(trow['obsind'])))
+        nresults[trow['filter']] += 1
+    flist = []
+
 for fil in flist:
     try:
         findres = find_results.load_results_from_file(fil)
@@ -231,9 +246,9 @@ for fil in flist:
             name = fr.obj.objname
             if name != targobj:
                 refobjadus[name] = fr.adus
-        resultlist.append(Result(findres.obsdate, findres.filter, targfr, findres.obsind, refobjadus))
+        resultlist.append(Result(findres.obsdate, findres.filter, targfr.adus, findres.obsind, refobjadus))
     else:
-        resultlist.append(Result(findres.obsdate, findres.filter, targfr, findres.obsind))
+        resultlist.append(Result(findres.obsdate, findres.filter, targfr.adus, findres.obsind))
     nresults[findres.filter] += 1
 
 if len(resultlist) < 2:
@@ -270,7 +285,7 @@ if userefs:
             print("Warning only", nsub, "in subset for filter", filtp, file=sys.stderr)
         for resp in resultlist:
             if resp.filtname == filtp:
-                resp.reladus = resp.findres.adus / np.sum([resp.adubyref[n] for n in fsub])
+                resp.reladus = resp.adus / np.sum([resp.adubyref[n] for n in fsub])
 
 fig = rg.plt_figure()
 ax = plt.subplot(111)
@@ -326,7 +341,7 @@ if bytime:
             if userefs:
                 adulist.append(nxtr.reladus)
             else:
-                adulist.append(nxtr.findres.adus)
+                adulist.append(nxtr.adus)
             obsinds.append(nxtr)
 
         # Do trailing ones
@@ -354,7 +369,7 @@ else:
             if userefs:
                 adulist.append(rl.reladus)
             else:
-                adulist.append(rl.findres.adus)
+                adulist.append(rl.adus)
             obsinds.append(rl)
         if len(datelist) < 2:
             continue
@@ -12,6 +12,7 @@ from scipy.stats import linregress
 import col_from_file
 import remdefaults
 import remgeom
+import lcstore
 
 class Objresult:
 
@@ -70,6 +71,8 @@ parsearg.add_argument('--objects', type=str, nargs='*', help='Specific objects t
 parsearg.add_argument('--normalise', action='store_true', help='Normalise flux around 1')
 parsearg.add_argument('--regress', action='store_true', help='Perform regression analysis')
 parsearg.add_argument('--objregress', action='store_true', help='Regression by specified objects only')
+parsearg.add_argument('--fromstore', type=str, metavar='VICINITY', help='Take results from light curve store for given vicinity rather than database')
+parsearg.add_argument('--storedir', type=str, default=lcstore.DEFAULT_STOREDIR, help='Directory for light curve store')
 rg.disp_argparse(parsearg)
 
 resargs = vars(parsearg.parse_args())
@@ -100,6 +103,8 @@ regress = resargs['regress']
 objregress = resargs['objregress']
 maxvar = resargs['variability']
 maxsky = resargs['maxsky']
+fromstore = resargs['fromstore']
+storedir = resargs['storedir']
 
 if xlab is None:
     if bytime:
@@ -115,33 +120,51 @@ mydb, mycurs = remdefaults.opendb()
 resulttab = dict()
 result_by_date = dict()
 
-for obsind in obsinds:
-
-    mycurs.execute("SELECT date_obs,label,variability,findresult.objind,aducount,"
-                   "IF(filter='g',gbri,IF(filter='r',rbri,IF(filter='i',ibri,IF(filter='z',zbri,1e6)))) AS bri"
-                   " FROM obsinf INNER JOIN findresult ON obsinf.obsind=findresult.obsind "
-                   "INNER JOIN aducalc ON findresult.ind=aducalc.frind "
-                   "INNER JOIN objdata ON aducalc.objind=objdata.ind "
-                   "WHERE obsinf.obsind={:d} AND label IS NOT NULL AND aducalc.skylevel<={:.8e}".format(obsind, maxsky))
-
-    adusres = mycurs.fetchall()
-
-    for dateobs, label, variability, objind, aducount, bri in adusres:
-
-        if  label in resulttab:
-            resulttab[label].append(dateobs, aducount)
-        else:
-            resulttab[label] = Objresult(objind, label, variability, dateobs, aducount, bri)
-
-        if variability > maxvar:
+if fromstore is not None:
+    try:
+        lcrows = lcstore.obsind_rows(lcstore.load(fromstore, storedir), obsinds)
+    except lcstore.LcStoreErr as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(11)
+    lcrows = lcrows[lcrows['sky'] <= maxsky]
+    mycurs.execute("SELECT ind,label,variability,gbri,rbri,ibri,zbri FROM objdata WHERE vicinity=%s AND label IS NOT NULL", fromstore)
+    objinfo = dict()
+    for objind, label, variability, gbri, rbri, ibri, zbri in mycurs.fetchall():
+        objinfo[objind] = (label, variability, dict(g=gbri, r=rbri, i=ibri, z=zbri))
+    adusres = []
+    for lcrow in lcrows:
+        try:
+            label, variability, bris = objinfo[lcrow['objind']]
+        except KeyError:
             continue
+        adusres.append((lcrow['dateobs'].item(), label, variability, int(lcrow['objind']), float(lcrow['adus']), bris.get(lcrow['filter'], 1e6)))
+else:
+    adusres = []
+    for obsind in obsinds:
+        mycurs.execute("SELECT date_obs,label,variability,findresult.objind,aducount,"
+                       "IF(filter='g',gbri,IF(filter='r',rbri,IF(filter='i',ibri,IF(filter='z',zbri,1e6)))) AS bri"
+                       " FROM obsinf INNER JOIN findresult ON obsinf.obsind=findresult.obsind "
+                       "INNER JOIN aducalc ON findresult.ind=aducalc.frind "
+                       "INNER JOIN objdata ON aducalc.objind=objdata.ind "
+                       "WHERE obsinf.obsind={:d} AND label IS NOT NULL AND aducalc.skylevel<={:.8e}".format(obsind, maxsky))
+        adusres += mycurs.fetchall()
+
+for dateobs, label, variability, objind, aducount, bri in adusres:
+
+    if  label in resulttab:
+        resulttab[label].append(dateobs, aducount)
+    else:
+        resulttab[label] = Objresult(objind, label, variability, dateobs, aducount, bri)
 
-        if dateobs in result_by_date:
-            drdict = result_by_date[dateobs]
-        else:
-            result_by_date[dateobs] = drdict = dict()
+    if variability > maxvar:
+        continue
+
+    if dateobs in result_by_date:
+        drdict = result_by_date[dateobs]
+    else:
+        result_by_date[dateobs] = drdict = dict()
 
-        drdict[label] = (aducount, bri)
+    drdict[label] = (aducount, bri)
 
 if objects is not None:
     objects = set(objects)
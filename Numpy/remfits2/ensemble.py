@@ -0,0 +1,94 @@
+"""Ensemble photometry against reference objects for many observations at once.
+
+ADU counts of the reference objects are held as a dense array of observations
+by reference objects with NaN where an object was not measured, and the
+regressions of ADU count against expected brightness for every observation
+done together with masked array operations, giving the same values as
+scipy.stats.linregress on each observation separately."""
+
+import numpy as np
+
+FILTERS = 'griz'
+
+
+class EnsembleErr(Exception):
+    """Throw if we have problems with ensemble photometry"""
+
+
+def dense_matrix(rowkeys, colkeys, rowvals, colvals, *values):
+    """Place values given against (rowvals, colvals) pairs into arrays with rows for each of rowkeys
+    and columns for each of colkeys, dropping pairs not in those and leaving NaN where no value given.
+
+    Return tuple of arrays, one for each of values"""
+    rowkeys = np.asarray(rowkeys)
+    colkeys = np.asarray(colkeys)
+    rorder = np.argsort(rowkeys, kind='stable')
+    corder = np.argsort(colkeys, kind='stable')
+    rowvals = np.asarray(rowvals)
+    colvals = np.asarray(colvals)
+    rpos = np.clip(np.searchsorted(rowkeys[rorder], rowvals), 0, max(rowkeys.size - 1, 0))
+    cpos = np.clip(np.searchsorted(colkeys[corder], colvals), 0, max(colkeys.size - 1, 0))
+    result = tuple(np.full((rowkeys.size, colkeys.size), np.nan) for v in values)
+    if rowkeys.size == 0 or colkeys.size == 0:
+        return result
+    found = (rowkeys[rorder][rpos] == rowvals) & (colkeys[corder][cpos] == colvals)
+    rinds = rorder[rpos[found]]
+    cinds = corder[cpos[found]]
+    for res, vals in zip(result, values):
+        res[rinds, cinds] = np.asarray(vals, dtype=np.float64)[found]
+    return result
+
+
+def masked_linregress(x, y, valid):
+    """Linear regression of y on x along the last axis using points where valid is True.
+
+    Return arrays of slope, intercept, rvalue, stderr and intercept_stderr as
+    scipy.stats.linregress would give for each row"""
+    n = valid.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xmean = np.where(valid, x, 0.0).sum(axis=-1) / n
+        ymean = np.where(valid, y, 0.0).sum(axis=-1) / n
+        dx = np.where(valid, x - xmean[..., np.newaxis], 0.0)
+        dy = np.where(valid, y - ymean[..., np.newaxis], 0.0)
+        ssxm = (dx * dx).sum(axis=-1) / n
+        ssym = (dy * dy).sum(axis=-1) / n
+        ssxym = (dx * dy).sum(axis=-1) / n
+
+        degenerate = (ssxm == 0.0) | (ssym == 0.0)
+        rvalue = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        rvalue = np.where(degenerate, np.where(ssxym == 0.0, np.nan, 0.0), rvalue)
+        slope = ssxym / ssxm
+        intercept = ymean - slope * xmean
+        stderr = np.where(n > 2, np.sqrt((1 - rvalue ** 2) * ssym / ssxm / (n - 2)), 0.0)
+        intercept_stderr = stderr * np.sqrt(ssxm + xmean ** 2)
+    return slope, intercept, rvalue, stderr, intercept_stderr
+
+
+def lreg_fluxes(targadus, targaduerr, refadus, referr, refbri, refbrisd, minrefs=5, minsnr=1.0, mincorr=0.5):
+    """Rescale target ADUs for each observation to expected brightness from regression of reference
+    object ADUs against their expected brightness.
+
+    targadus and targaduerr are arrays for each observation, the ref* arrays are observations by
+    reference objects with NaN where there is no value.
+
+    Return mask of observations with results, and arrays of scaled brightness and its error"""
+    present = np.isfinite(refadus)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        usable = present & np.isfinite(refbri) & np.isfinite(refbrisd) & (refadus / referr >= minsnr)
+    nusable = usable.sum(axis=1)
+    ok = (present.sum(axis=1) >= minrefs) & (nusable >= minrefs)
+
+    slope, intercept, rvalue, stderr, intercept_stderr = masked_linregress(refbri, refadus, usable)
+
+    # Reject observations where the references all have the same expected brightness, where
+    # ssxm is zero and the slope not finite, or with no correlation, before the correlation cut
+
+    ok &= np.isfinite(slope) & np.isfinite(rvalue)
+    with np.errstate(invalid='ignore'):
+        ok &= rvalue ** 2 >= mincorr
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = targadus - intercept
+        scaled = diff / slope
+        scalederr = scaled * np.sqrt((np.sqrt(targaduerr ** 2 + intercept_stderr ** 2) / diff) ** 2 + (stderr / slope) ** 2)
+    return ok, scaled, scalederr
@@ -0,0 +1,123 @@
+"""Detection of objects over the whole of an image in one pass.
+
+Each local maximum more than the given multiple of the sky noise above the sky
+level is taken as an object, however close to others, flat tops such as saturated
+cores counting as one maximum, and the centroid, aperture sum and Gaussian amplitude and width from the second
+moments of each region are found with scipy.ndimage and NumPy for all of them
+at once, giving the fields of find results as arrays.
+
+Error estimates are from the sky noise alone, as for a faint object."""
+
+import time
+import numpy as np
+from scipy import ndimage
+import multifind
+
+CONNECTIVITY = ndimage.generate_binary_structure(2, 2)
+
+RESULT_FIELDS = ('row', 'col', 'adus', 'amp', 'sigma', 'modadus', 'xoffstd', 'yoffstd', 'ampstd', 'sigmastd')
+
+
+class FastDetectErr(Exception):
+    """Throw if we have problems detecting objects"""
+
+
+class Detections:
+    """Objects detected, arrays of each of RESULT_FIELDS ordered by decreasing ADU count"""
+
+    def __init__(self, apsize, **fields):
+        self.apsize = apsize
+        order = np.argsort(-fields['adus'], kind='stable')
+        for name in RESULT_FIELDS + ('peak', 'npix'):
+            setattr(self, name, fields[name][order])
+        self.elapsed = 0.0
+
+    def __len__(self):
+        return self.adus.size
+
+
+def empty_detections(apsize):
+    """Get Detections structure with nothing in it"""
+    fields = {name: np.zeros(0, dtype=np.float64) for name in RESULT_FIELDS + ('peak', )}
+    return Detections(apsize, npix=np.zeros(0, dtype=np.int64), **fields)
+
+
+def window_moments(windows, sky, mask):
+    """Get second moment width of sky-subtracted positive values within mask about the centroid for each window"""
+    nwin, side, dummy = windows.shape
+    offs = np.arange(side, dtype=np.float64) - side // 2
+    wts = np.where(mask & np.isfinite(windows), np.maximum(windows - sky, 0.0), 0.0)
+    tot = wts.sum(axis=(1, 2))
+    safe = np.where(tot > 0.0, tot, 1.0)
+    crow = np.dot(wts.sum(axis=2), offs) / safe
+    ccol = np.dot(wts.sum(axis=1), offs) / safe
+    drsq = (offs[np.newaxis, :, np.newaxis] - crow[:, np.newaxis, np.newaxis]) ** 2
+    dcsq = (offs[np.newaxis, np.newaxis, :] - ccol[:, np.newaxis, np.newaxis]) ** 2
+    return np.sqrt(((drsq + dcsq) * wts).sum(axis=(1, 2)) / (2.0 * safe))
+
+
+def detect(data, sign=10.0, apsize=6, totsign=1.0, ignleft=0, ignright=0, igntop=0, ignbottom=0):
+    """Detect objects in data with peaks sign std devs above sky and total ADUs in an aperture of
+    radius apsize about the peak totsign std devs above the noise expected in that aperture.
+
+    ign* give the number of pixels at each side to leave out, bottom being row 0.
+
+    Return Detections structure"""
+
+    starttime = time.time()
+    nrows, ncols = data.shape
+    region = (slice(ignbottom, nrows - igntop), slice(ignleft, ncols - ignright))
+    if region[0].start >= region[0].stop or region[1].start >= region[1].stop:
+        raise FastDetectErr("Nothing left of image after ignoring edges")
+    sky, skystd = multifind.image_sky(data[region])
+
+    filled = np.where(np.isfinite(data), data, -np.inf)
+    above = np.zeros(data.shape, dtype=bool)
+    above[region] = filled[region] > sky + sign * skystd
+    above &= filled == ndimage.maximum_filter(filled, footprint=CONNECTIVITY, mode='constant', cval=-np.inf)
+    labels, nlabels = ndimage.label(above, structure=CONNECTIVITY)
+    if nlabels == 0:
+        result = empty_detections(apsize)
+        result.elapsed = time.time() - starttime
+        return result
+
+    lablist = np.arange(1, nlabels + 1)
+    peakpos = np.array(ndimage.maximum_position(filled, labels, lablist), dtype=np.int64).reshape(-1, 2)
+    peaks = filled[peakpos[:, 0], peakpos[:, 1]]
+
+    windows = multifind.cut_windows(data, peakpos[:, 0], peakpos[:, 1], apsize)
+    apmask = multifind.disc_mask(apsize, apsize)
+    crow, ccol = multifind.window_centroids(windows, sky, apmask)
+    adus, npix = multifind.window_sums(windows, sky, apmask)
+    sigma = window_moments(windows, sky, apmask)
+    noise = skystd * np.sqrt(np.maximum(npix, 1))
+    signif = adus > totsign * noise
+    snr = np.where(signif, adus / noise, 1.0)
+
+    amp = peaks - sky
+    result = Detections(apsize,
+                        row=(peakpos[:, 0] + crow)[signif],
+                        col=(peakpos[:, 1] + ccol)[signif],
+                        adus=adus[signif],
+                        amp=amp[signif],
+                        sigma=sigma[signif],
+                        modadus=(2.0 * np.pi * amp * sigma ** 2)[signif],
+                        xoffstd=(sigma / snr)[signif],
+                        yoffstd=(sigma / snr)[signif],
+                        ampstd=np.full(int(signif.sum()), skystd),
+                        sigmastd=(sigma / (np.sqrt(2.0) * snr))[signif],
+                        peak=peaks[signif],
+                        npix=npix[signif])
+    result.elapsed = time.time() - starttime
+    return result
+
+
+def set_result(fr, dets, n, wcs=None):
+    """Set the fields of find result fr from the n'th detection, with coordinates if wcs given"""
+    for name in RESULT_FIELDS:
+        setattr(fr, name, float(getattr(dets, name)[n]))
+    fr.rdiff = fr.cdiff = 0.0
+    fr.apsize = dets.apsize
+    if wcs is not None:
+        fr.radeg, fr.decdeg = wcs.colrow_to_coords(fr.col, fr.row)
+    return fr
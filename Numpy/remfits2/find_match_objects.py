@@ -5,33 +5,157 @@
 import argparse
 import warnings
 import sys
+import time
 from multiprocessing import Pool
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import remdefaults
 import remfits
 import find_results
 import searchparam
-import objdata
+import skyregion
 import logs
+import multifind
 
-def run_find(objpixes):
-    """For running multiprocessor"""
+class FindMatchErr(Exception):
+    """Throw if we have to give up on a file, with exit code"""
 
-    obj, pixes = objpixes
-    pcol, prow = pixes
-    if  pcol < trimleft or prow < trimbottom or pcol >= maxcol or prow >= maxrow or obj.is_target():
-        if verbose > 1:
-            logging.write(obj.dispname, "not in image")
-        return None
+    def __init__(self, code, *args):
+        super().__init__(" ".join([str(a) for a in args]))
+        self.code = code
+
+
+def load_image(fname, curs):
+    """Load image and find results for it, returning (fitsfile, findres)"""
     try:
-        newfr = findres.find_object(prow, pcol, obj, searchpar)
-        newfr.obsind = fitsfile.from_obsind
-        return newfr
+        ff = remfits.parse_filearg(fname, curs)
+        ff.calc_skylevel(skylevstdp)
+    except remfits.RemFitsErr as e:
+        raise FindMatchErr(52, e.args[0])
+    try:
+        fr = find_results.FindResults(ff)
+        fr.loaddb(curs)
+    except find_results.FindResultErr as e:
+        raise FindMatchErr(14, "Could not load find results, error was", e.args[0])
+    return ff, fr
+
+
+def init_worker(findres):
+    """Set up worker process with the find results for the current image.
+
+    The pool is forked for each file, so the workers get the image already decoded in the
+    parent as part of the fork rather than each loading it again"""
+    global worker_findres
+    worker_findres = findres
+
+
+def run_find(task):
+    """For running multiprocessor, returning None if the object is not found.
+
+    Any other error is passed back to the parent"""
+
+    obj, prow, pcol = task
+    try:
+        return worker_findres.find_object(prow, pcol, obj, searchpar)
     except find_results.FindResultErr as e:
         if verbose > 1:
             logging.write(e.args[0])
         return None
 
+
+def process_file(infilename):
+    """Find objects in one image and save results, returning number of objects searched for"""
+
+    fitsfile, findres = load_image(infilename, dbcurs)
+
+    if filt is not None and fitsfile.filter not in filt:
+        raise FindMatchErr(53, "is for filter", fitsfile.filter, "not in specified", filt)
+
+    num_existing = findres.num_results()
+
+    if num_existing == 0:
+        raise FindMatchErr(15, "No results in findres file, expecting at least 1 for target")
+
+    targfr = findres[0]
+
+    if not targfr.istarget:
+        raise FindMatchErr(17, "No target (should be first) in findres file")
+
+    if num_existing > 1:
+        if not deleteold:
+            raise FindMatchErr(18, "Already done, use --deleteold if needed")
+        if verbose > 0:
+            logging.write("Deleting {:d} old results".format(num_existing-1))
+        for fr in findres.results():
+            if not fr.istarget:
+                fr.delete(dbcurs)
+
+    # Get objects in vicinity
+
+    objlist = skyregion.frame_region(dbcurs, fitsfile, maxvar).objects()
+    coordlist = [(obj.ra, obj.dec) for obj in objlist]
+    pixlist = fitsfile.wcs.coords_to_pix(coordlist)
+    maxrow = fitsfile.nrows - trimtop
+    maxcol = fitsfile.ncolumns - trimright
+
+    # Build new results list
+
+    newfrlist = [targfr]
+    notfound = newones = 0
+
+    tasks = []
+    for obj, (pcol, prow) in zip(objlist, pixlist):
+        if pcol < trimleft or prow < trimbottom or pcol >= maxcol or prow >= maxrow or obj.is_target():
+            if verbose > 1:
+                logging.write(obj.dispname, "not in image")
+            notfound += 1
+        else:
+            tasks.append((obj, prow, pcol))
+
+    # Screen all the positions at once to avoid searching where there is nothing
+
+    if prescreen is not None and len(tasks) != 0:
+        keep = multifind.prescreen(fitsfile, [(pcol, prow) for obj, prow, pcol in tasks], prescreenshift, prescreenap, prescreen)
+        notfound += len(tasks) - int(keep.sum())
+        tasks = [t for t, k in zip(tasks, keep) if k]
+
+    # Workers are forked for each file with its find results already loaded
+
+    starttime = time.time()
+    if len(tasks) != 0:
+        with Pool(min(maxproc, len(tasks)), initializer=init_worker, initargs=(findres, )) as pool:
+            for r in pool.imap_unordered(run_find, tasks, chunksize=max(1, len(tasks) // (maxproc * 4))):
+                if r is None:
+                    notfound += 1
+                else:
+                    r.obsind = fitsfile.from_obsind
+                    newfrlist.append(r)
+                    newones += 1
+    elapsed = time.time() - starttime
+
+    if benchmark:
+        logging.write("{:d} objects searched in {:.3f} seconds {:.1f} objects/sec".format(len(tasks), elapsed, len(tasks) / max(elapsed, 1e-6)))
+
+    if notfound > 0  and  verbose > 0:
+        logging.write(notfound, "objects not found")
+
+    if verbose > 0:
+        logging.write("{:d} objects found".format(newones))
+
+    if newones+1 < findmin:
+        raise FindMatchErr(60, "too few ({:d}) objects found need at least {:d}".format(len(newfrlist), findmin))
+
+    findres.resultlist = newfrlist
+    findres.reorder()
+    findres.relabel()
+    findres.rekey()
+    if verbose > 0:
+        logging.write("About to start saving to DB")
+    findres.save_as_block(dbcurs)
+    if verbose > 0:
+        logging.write("Save complete")
+    return len(tasks)
+
+
 # Shut up warning messages
 
 warnings.simplefilter('ignore', AstropyWarning)
@@ -40,7 +164,7 @@ warnings.simplefilter('ignore', UserWarning)
 
 searchpar = searchparam.load()
 parsearg = argparse.ArgumentParser(description='Find objects in image after finding target', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parsearg.add_argument('file', nargs=1, type=str, help='Image file')
+parsearg.add_argument('files', nargs='+', type=str, help='Image files')
 searchpar.argparse(parsearg)
 remdefaults.parseargs(parsearg, tempdir=False, inlib=False)
 parsearg.add_argument('--deleteold', action='store_true', help='Delete ones done already')
@@ -56,10 +180,14 @@ parsearg.add_argument('--trimright', type=int, default=0, help='Pixels to trim o
 parsearg.add_argument('--trimtop', type=int, default=0, help='Pixels to trim off top')
 parsearg.add_argument('--trimbottom', type=int, default=0, help='Pixels to trim off bottom')
 parsearg.add_argument('--maxproc', type=int, default=8, help='Maximum number of processes to run')
+parsearg.add_argument('--benchmark', action='store_true', help='Report objects per second searched')
+parsearg.add_argument('--prescreen', type=float, help='Screen out objects with nothing this many std devs above sky nearby before searching (approximate)')
+parsearg.add_argument('--prescreenshift', type=int, help='Maximum shift from predicted position when screening if not that of search parameters')
+parsearg.add_argument('--prescreenap', type=float, default=multifind.DEFAULT_APSIZE, help='Radius of disc summed when screening')
 logs.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
-infilename = resargs['file'][0]
+infilenames = resargs['files']
 remdefaults.getargs(resargs)
 searchpar.getargs(resargs)
 deleteold = resargs['deleteold']
@@ -78,6 +206,12 @@ trimright = resargs['trimright']
 trimtop = resargs['trimtop']
 logging = logs.getargs(resargs)
 maxproc = resargs['maxproc']
+benchmark = resargs['benchmark']
+prescreen = resargs['prescreen']
+prescreenshift = resargs['prescreenshift']
+if prescreenshift is None:
+    prescreenshift = multifind.search_shift(searchpar)
+prescreenap = resargs['prescreenap']
 
 # If we are saving stuff, do so and exit
 
@@ -89,84 +223,28 @@ if searchpar.saveparams:
 
 mydb, dbcurs = remdefaults.opendb(waitlock=True)
 
-logging.set_filename(infilename)
-
-try:
-    fitsfile = remfits.parse_filearg(infilename, dbcurs)
-    fitsfile.calc_skylevel(skylevstdp)
-except remfits.RemFitsErr as e:
-    logging.die(52, e.args[0])
-
-if filt is not None and fitsfile.filter not in filt:
-    logging.die(53, "is for filter", fitsfile.filter, "not in specified", filt)
+worker_findres = None
 
-try:
-    findres = find_results.FindResults(fitsfile)
-    findres.loaddb(dbcurs)
-except find_results.FindResultErr as e:
-    logging.die(14, "Could not load find results, error was", e.args[0])
+failures = totobjs = 0
+laststatus = 0
+batchstart = time.time()
 
-num_existing = findres.num_results()
-
-if num_existing == 0:
-    logging.die(15, "No results in findres file, expecting at least 1 for target")
-
-targfr = findres[0]
-
-if not targfr.istarget:
-    logging.die(17, "No target (should be first) in findres file")
-
-if num_existing > 1:
-    if not deleteold:
-        logging.die(18, "Already done, use --deleteold if needed")
-    if verbose > 0:
-        logging.write("Deleting {:d} old results".format(num_existing-1))
-    for fr in findres.results():
-        if not fr.istarget:
-            fr.delete(dbcurs)
-
-# Get objects in vicinity
-
-objlist = objdata.get_sky_region(dbcurs, fitsfile, maxvar)
-coordlist = [(obj.ra, obj.dec) for obj in objlist]
-pixlist = fitsfile.wcs.coords_to_pix(coordlist)
-maxrow = fitsfile.nrows - trimtop
-maxcol = fitsfile.ncolumns - trimright
-
-# Build new results list
-
-newfrlist = [targfr]
-notfound = newones = 0
-objpixes = list(zip(objlist, pixlist))
-
-while len(objpixes) != 0:
-    seg = objpixes[:maxproc]
-    objpixes = objpixes[maxproc:]
-    with Pool(min(len(seg), maxproc)) as p:
-        results = p.map(run_find, seg)
-        for r in results:
-            if r is None:
-                notfound += 1
-            else:
-                newfrlist.append(r)
-                newones += 1
-
-if notfound > 0  and  verbose > 0:
-    logging.write(notfound, "objects not found")
-
-if verbose > 0:
-    logging.write("{:d} objects found".format(newones))
-
-if newones+1 < findmin:
-    logging.die(60, "too few ({:d}) objects found need at least {:d}".format(len(newfrlist), findmin))
-
-findres.resultlist = newfrlist
-# print("Num existing = {:d} donealready = {:d} num in list = {:d}".format(num_existing, donealready, len(newfrlist)))
-findres.reorder()
-findres.relabel()
-findres.rekey()
-if verbose > 0:
-    logging.write("About to start saving to DB")
-findres.save_as_block(dbcurs)
-if verbose > 0:
-    logging.write("Save complete")
+for infilename in infilenames:
+    logging.set_filename(infilename)
+    try:
+        totobjs += process_file(infilename)
+    except FindMatchErr as e:
+        if len(infilenames) == 1:
+            logging.die(e.code, e.args[0])
+        logging.write(e.args[0])
+        failures += 1
+        laststatus = e.code
+
+logging.set_filename("")
+
+if benchmark and len(infilenames) > 1:
+    batchtime = time.time() - batchstart
+    logging.write("{:d} files {:d} objects in {:.3f} seconds {:.1f} objects/sec".format(len(infilenames), totobjs, batchtime, totobjs / max(batchtime, 1e-6)))
+
+if failures > 0:
+    logging.die(laststatus, failures, "files failed")
@@ -5,10 +5,68 @@
 import argparse
 import warnings
 import sys
+import os
+import os.path
+import time
+from multiprocessing import Pool
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import remdefaults
 import remfits
 import find_results
+import fastdetect
+
+ENGINES = ('findfast', 'ndimage')
+
+
+def ndimage_findfast(rstr, fitsfile, **kwargs):
+    """Replacement for FindResults.findfast setting the result list of rstr to the objects
+    detected in fitsfile by fastdetect brightest first, returning the number found"""
+    dets = fastdetect.detect(fitsfile.data, **kwargs)
+    rstr.resultlist = [fastdetect.set_result(find_results.FindResult(), dets, n, fitsfile.wcs) for n in range(len(dets))]
+    return len(dets)
+
+
+def find_file(infile, outfile, curs):
+    """Find objects in infile and save results to outfile, returning number found and time taken"""
+    starttime = time.time()
+    inputfile = remfits.parse_filearg(infile, curs)
+    rstr = find_results.FindResults(inputfile)
+
+    if engine == 'ndimage':
+        nfound = ndimage_findfast(rstr, inputfile, sign=signif, apsize=apsize, totsign=totsign, ignleft=ignleft, ignright=ignright, igntop=igntop, ignbottom=ignbottom)
+    else:
+        nfound = rstr.findfast(sign=signif, apsize=apsize, totsign=totsign, ignleft=ignleft, ignright=ignright, igntop=igntop, ignbottom=ignbottom)
+
+    if nfound != 0:
+        find_results.save_results_to_file(rstr, outfile, force)
+    return nfound, time.time() - starttime
+
+
+def init_worker():
+    """Give each worker process its own database connection"""
+    global dbcurs
+    mydb, dbcurs = remdefaults.opendb()
+
+
+def batch_find(infile):
+    """Find objects in one file of batch, returning (file, number found, time, error message or None)"""
+    try:
+        nfound, elapsed = find_file(infile, remdefaults.libfile(os.path.basename(infile)), dbcurs)
+    except (remfits.RemFitsErr, fastdetect.FastDetectErr, find_results.FindResultErr) as e:
+        return infile, 0, 0.0, e.args[0]
+    return infile, nfound, elapsed, None
+
+
+def image_files(args):
+    """Expand directories in list of arguments to the FITS files in them"""
+    result = []
+    for arg in args:
+        if os.path.isdir(arg):
+            result += sorted([os.path.join(arg, f) for f in os.listdir(arg) if f.endswith('.fits') or f.endswith('.fits.gz')])
+        else:
+            result.append(arg)
+    return result
+
 
 # Shut up warning messages
 
@@ -27,10 +85,17 @@ parsearg.add_argument('--ignleft', type=int, default=0, help='Amount on left to
 parsearg.add_argument('--ignright', type=int, default=0, help='Amount on right to ignore')
 parsearg.add_argument('--igntop', type=int, default=0, help='Amount on top to ignore')
 parsearg.add_argument('--ignbottom', type=int, default=0, help='Amount on bottom to ignore')
+parsearg.add_argument('--engine', type=str, default='findfast', choices=ENGINES, help='Detection method, library findfast or ndimage labelling')
+parsearg.add_argument('--batch', action='store_true', help='Arguments are image files or directories of them, results saved under each name')
+parsearg.add_argument('--maxproc', type=int, default=8, help='Maximum number of processes to run in batch mode')
+parsearg.add_argument('--timing', action='store_true', help='Report time taken for each image')
 
 resargs = vars(parsearg.parse_args())
 flist = resargs['files']
-if len(flist) == 1:
+batch = resargs['batch']
+if batch:
+    flist = image_files(flist)
+elif len(flist) == 1:
     infile = outfile = flist[0]
 else:
     try:
@@ -43,28 +108,49 @@ force = resargs['force']
 signif = resargs['significance']
 apsize = resargs['apsize']
 totsign = resargs['totsign']
-outfile = remdefaults.libfile(outfile)
 ignleft = resargs['ignleft']
 ignright = resargs['ignright']
 igntop = resargs['igntop']
 ignbottom = resargs['ignbottom']
+engine = resargs['engine']
+maxproc = resargs['maxproc']
+timing = resargs['timing']
+
+if batch:
+    if len(flist) == 0:
+        print("No image files found", file=sys.stderr)
+        sys.exit(50)
+    errors = 0
+    with Pool(min(len(flist), maxproc), initializer=init_worker) as pool:
+        for infile, nfound, elapsed, mess in pool.imap_unordered(batch_find, flist):
+            if mess is not None:
+                print(infile, "error was", mess, file=sys.stderr)
+                errors += 1
+            elif nfound == 0:
+                print(infile, "no results found", file=sys.stderr)
+                errors += 1
+            elif timing:
+                print("{:s}: {:d} objects {:.3f} seconds".format(infile, nfound, elapsed))
+    if errors > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+outfile = remdefaults.libfile(outfile)
 
 mydb, dbcurs = remdefaults.opendb()
 
 try:
-    inputfile = remfits.parse_filearg(infile, dbcurs)
-except remfits.RemFitsErr as e:
+    nfound, elapsed = find_file(infile, outfile, dbcurs)
+except (remfits.RemFitsErr, fastdetect.FastDetectErr) as e:
     print(e.args[0], file=sys.stderr)
     sys.exit(52)
+except find_results.FindResultErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(100)
 
-rstr = find_results.FindResults(inputfile)
-
-if rstr.findfast(sign=signif, apsize=apsize, totsign=totsign, ignleft=ignleft, ignright=ignright, igntop=igntop, ignbottom=ignbottom) == 0:
+if nfound == 0:
     print("No results found", file=sys.stderr)
     sys.exit(1)
 
-try:
-    find_results.save_results_to_file(rstr, outfile, force)
-except find_results.FindResultErr as e:
-    print(e.args[0], file=sys.stderr)
-    sys.exit(100)
+if timing:
+    print("{:s}: {:d} objects {:.3f} seconds".format(infile, nfound, elapsed))
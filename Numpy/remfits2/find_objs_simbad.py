@@ -17,6 +17,7 @@ import remdefaults
 import remfits
 import os.path
 import find_results
+import querycache
 
 # Shut up warning messages
 
@@ -28,11 +29,17 @@ parsearg = argparse.ArgumentParser(description='Put object names in find results
 parsearg.add_argument('file', nargs=1, type=str, help='Find results file')
 remdefaults.parseargs(parsearg, tempdir=False, database=False)
 parsearg.add_argument('--radius', type=float, default=2.0, help='Search radius in arcmin')
+querycache.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
 resfile, = resargs['file']
 remdefaults.getargs(resargs)
 radius = resargs['radius']
+try:
+    qcache = querycache.getargs(resargs)
+except querycache.QueryCacheErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(10)
 
 try:
     rstr = find_results.load_results_from_file(resfile)
@@ -46,10 +53,15 @@ sb = Simbad()
 
 changes = 0
 for r in rstr.results():
-    sres = sb.query_region(SkyCoord(ra=r.radeg * u.deg, dec=r.decdeg * u.deg), radius=radius * u.arcmin)
+    try:
+        sres = qcache.get("simbad", "region {:.7f} {:.7f}".format(r.radeg, r.decdeg), radius, None,
+                          lambda: sb.query_region(SkyCoord(ra=r.radeg * u.deg, dec=r.decdeg * u.deg), radius=radius * u.arcmin))
+    except querycache.QueryCacheErr as e:
+        print("Query cache error", e.args[0], file=sys.stderr)
+        sys.exit(101)
     if sres is None:
         continue
-    r.name = sres[0]['MAIN_ID'].decode()
+    r.name = querycache.str_column(sres['MAIN_ID'])[0]
     changes += 1
 
 if changes != 0:
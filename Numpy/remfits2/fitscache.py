@@ -0,0 +1,249 @@
+"""Local on-disk cache of FITS files held in the database.
+
+Entries are addressed by the SHA1 of the fitsgz column, the data being stored
+trimmed of zero or NaN padding as float32 in a .npy file which is memory-mapped
+when read back, with the header alongside as a FITS header string.
+
+A small index file for each fitsind gives the hash of its contents, so once a
+file has been seen, fetching it again involves neither the database nor
+decompression unless verification against the database is asked for.
+
+The least recently used entries are evicted when the total size of the cache
+exceeds the limit given. A running total of the size is kept as entries are
+added so the directory is only scanned when that goes over the limit, and then
+index files for contents no longer held are removed."""
+
+import os
+import os.path
+import tempfile
+import numpy as np
+from astropy.io import fits
+import remget
+import fitsops
+import trimarrays
+
+DEFAULT_CACHEDIR = "~/.remfitscache"
+DEFAULT_CACHESIZE = 4096  # Megabytes
+
+SHA1_QUERY = "SELECT SHA1(fitsgz) FROM fitsfile WHERE ind=%s"
+
+
+class FitsCacheErr(Exception):
+    """Throw if we have problems with the cache"""
+
+
+def content_hash(dbcurs, fitsind):
+    """Get hash of FITS file contents as held in the database"""
+    dbcurs.execute(SHA1_QUERY, (fitsind,))
+    rows = dbcurs.fetchall()
+    if len(rows) == 0 or rows[0][0] is None:
+        raise FitsCacheErr("Cannot find FITS file id " + str(fitsind))
+    hval = rows[0][0]
+    if isinstance(hval, bytes):
+        hval = hval.decode()
+    return hval.lower()
+
+
+def trim_data(data):
+    """Trim padding from data, NaNs if there are any, otherwise zeros, and convert to float32"""
+    data = data.astype(np.float32)
+    if np.isnan(data).any():
+        return trimarrays.trimnan(data)
+    return trimarrays.trimzeros(data)
+
+
+def fetch_fits(dbcurs, fitsind):
+    """Fetch FITS file from database and decode it, returning header and trimmed data"""
+    try:
+        hdr, data = fitsops.mem_get(remget.get_saved_fits(dbcurs, fitsind))
+    except remget.RemGetError as e:
+        raise FitsCacheErr("Cannot fetch FITS file id " + str(fitsind) + " error was " + e.args[0])
+    return hdr, trim_data(data)
+
+
+class FitsCache:
+    """Cache of decoded FITS files, counting hits and misses"""
+
+    def __init__(self, cachedir=DEFAULT_CACHEDIR, maxsize=DEFAULT_CACHESIZE, verify=False):
+        self.cachedir = os.path.expanduser(cachedir)
+        self.datadir = os.path.join(self.cachedir, "data")
+        self.indexdir = os.path.join(self.cachedir, "index")
+        self.maxsize = int(maxsize * 1024 * 1024)
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.pruned = 0
+        self.total = None
+        try:
+            os.makedirs(self.datadir, exist_ok=True)
+            os.makedirs(self.indexdir, exist_ok=True)
+        except OSError as e:
+            raise FitsCacheErr("Cannot create cache directory " + self.cachedir + " error was " + e.strerror)
+
+    def _index_file(self, fitsind):
+        """Get name of index file for fitsind"""
+        return os.path.join(self.indexdir, str(fitsind))
+
+    def _entry_files(self, hval):
+        """Get names of data and header files for hash"""
+        base = os.path.join(self.datadir, hval)
+        return base + ".npy", base + ".hdr"
+
+    def _write_atomic(self, fname, writefn):
+        """Write file via temporary file in the same directory and rename so readers never see partial files"""
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                writefn(fout)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise FitsCacheErr("Cannot write cache file " + fname + " error was " + e.strerror)
+
+    def lookup_hash(self, fitsind):
+        """Get hash recorded for fitsind or None if not known"""
+        try:
+            with open(self._index_file(fitsind)) as fin:
+                return fin.read().strip()
+        except OSError:
+            return None
+
+    def _load(self, hval):
+        """Load entry for hash, returning (hdr, data) or None if not there"""
+        dfile, hfile = self._entry_files(hval)
+        try:
+            with open(hfile) as fin:
+                hdr = fits.Header.fromstring(fin.read())
+            data = np.load(dfile, mmap_mode='r')
+            os.utime(dfile)
+        except (OSError, ValueError):
+            return None
+        return hdr, data
+
+    def _store(self, fitsind, hval, hdr, data):
+        """Save entry for hash and record it as the contents of fitsind"""
+        dfile, hfile = self._entry_files(hval)
+        self._write_atomic(dfile, lambda fout: np.save(fout, data))
+        self._write_atomic(hfile, lambda fout: fout.write(hdr.tostring().encode()))
+        self._write_atomic(self._index_file(fitsind), lambda fout: fout.write(hval.encode()))
+        if self.total is not None:
+            self.total += sum(os.path.getsize(fname) for fname in (dfile, hfile))
+
+    def get(self, dbcurs, fitsind):
+        """Get (hdr, data) for FITS file fitsind from the cache, fetching it from the database if need be.
+        The data is trimmed, float32 and read-only"""
+
+        hval = self.lookup_hash(fitsind)
+        if self.verify or hval is None:
+            dbhval = content_hash(dbcurs, fitsind)
+            if hval != dbhval:
+                hval = dbhval
+                self._write_atomic(self._index_file(fitsind), lambda fout: fout.write(hval.encode()))
+        entry = self._load(hval)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        hdr, data = fetch_fits(dbcurs, fitsind)
+        self._store(fitsind, hval, hdr, data)
+        entry = self._load(hval)
+        self.evict()
+        return entry
+
+    def invalidate(self, fitsind):
+        """Forget about fitsind, e.g. after updating it in the database.
+        The data is left for eviction as other files may have the same contents"""
+        try:
+            os.unlink(self._index_file(fitsind))
+        except FileNotFoundError:
+            pass
+
+    def scan(self):
+        """Get list of (mtime, size, hash) for entries in the cache and the total size"""
+        entries = []
+        total = 0
+        with os.scandir(self.datadir) as it:
+            for ent in it:
+                if not ent.name.endswith(".npy"):
+                    continue
+                hval = ent.name[:-4]
+                hfile = self._entry_files(hval)[1]
+                try:
+                    st = ent.stat()
+                    size = st.st_size + os.path.getsize(hfile)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, size, hval))
+                total += size
+        return entries, total
+
+    def prune_index(self, held):
+        """Remove index files giving hashes not in the set held"""
+        with os.scandir(self.indexdir) as it:
+            for ent in it:
+                try:
+                    with open(ent.path) as fin:
+                        hval = fin.read().strip()
+                    if hval not in held:
+                        os.unlink(ent.path)
+                        self.pruned += 1
+                except OSError:
+                    pass
+
+    def evict(self):
+        """Remove least recently used entries if the cache has gone over its size limit, with the index
+        files for them. The directory is scanned the first time and then only when the running
+        total of the size goes over the limit, in case other processes have evicted entries"""
+        if self.total is not None and self.total <= self.maxsize:
+            return
+        entries, self.total = self.scan()
+        if self.total <= self.maxsize:
+            return
+        entries.sort()
+        held = set(hval for mtime, size, hval in entries)
+        for mtime, size, hval in entries:
+            if self.total <= self.maxsize:
+                break
+            for fname in self._entry_files(hval):
+                try:
+                    os.unlink(fname)
+                except FileNotFoundError:
+                    pass
+            self.total -= size
+            held.discard(hval)
+            self.evicted += 1
+        self.prune_index(held)
+
+    def report(self):
+        """Return string reporting hits and misses"""
+        total = self.hits + self.misses
+        if total == 0:
+            return "No FITS cache lookups"
+        return "FITS cache {:d} hits {:d} misses ({:.1f}% hits) {:d} evicted {:d} index entries pruned".format(self.hits, self.misses, 100.0 * self.hits / total, self.evicted, self.pruned)
+
+
+def parseargs(argp):
+    """Add arguments for cache to argument parser"""
+    argp.add_argument('--cachedir', type=str, default=DEFAULT_CACHEDIR, help='Directory for cache of FITS files')
+    argp.add_argument('--cachesize', type=int, default=DEFAULT_CACHESIZE, help='Maximum size of FITS file cache in MB')
+    argp.add_argument('--nocache', action='store_true', help='Do not use FITS file cache')
+    argp.add_argument('--verifycache', action='store_true', help='Check cached FITS files against database')
+
+
+def getargs(resargs):
+    """Get cache from arguments, returning None if it is turned off"""
+    if resargs['nocache']:
+        return None
+    return FitsCache(resargs['cachedir'], resargs['cachesize'], resargs['verifycache'])
+
+
+def get_fits(cache, dbcurs, fitsind):
+    """Get (hdr, data) for FITS file fitsind via cache if we have one, otherwise direct from the database"""
+    if cache is None:
+        return fetch_fits(dbcurs, fitsind)
+    return cache.get(dbcurs, fitsind)
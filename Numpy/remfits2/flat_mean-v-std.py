@@ -27,7 +27,8 @@ import string
 import remgeom
 import dbops
 import remdefaults
-import dbremfitsobj
+import fitscache
+import imagestats
 import os
 import os.path
 import subprocess
@@ -101,6 +102,7 @@ rg = remgeom.load()
 parsearg = argparse.ArgumentParser(description='Plot std deviation versus mean of daily flats with trims', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 remdefaults.parseargs(parsearg, libdir=False, tempdir=False)
 parsetime.parseargs_daterange(parsearg)
+fitscache.parseargs(parsearg)
 parsearg.add_argument('--limits', type=str, help='Lower:upper limit of means')
 parsearg.add_argument('--trims', type=int, default=0, help='Amount to trim off each side')
 parsearg.add_argument('--cutlimit', type=str, default='all', choices=('all', 'limits', 'calclimits'), help='Point display and lreg calc, display all,')
@@ -120,6 +122,11 @@ rg.disp_argparse(parsearg)
 
 resargs = vars(parsearg.parse_args())
 remdefaults.getargs(resargs)
+try:
+    fcache = fitscache.getargs(resargs)
+except fitscache.FitsCacheErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(10)
 title = resargs['title']
 xlab = resargs['xlabel']
 ylab = resargs['ylabel']
@@ -186,17 +193,17 @@ stdds = []
 fitsinds = []
 for rows, cols, fitsind in dbrows:
     try:
-        ff = dbremfitsobj.getfits(dbcurs, fitsind)
-        fdat = ff[0].data[0:rows, 0:cols].astype(np.float32)
-        ff.close()
-        if trims > 0:
-            fdat = fdat[trims:-trims, trims:-trims]
-        means.append(fdat.mean())
-        stdds.append(fdat.std())
+        hdr, data = fitscache.get_fits(fcache, dbcurs, fitsind)
+        st = imagestats.image_stats(data[0:rows, 0:cols], trim=trims, median=None)
+        means.append(st.mean)
+        stdds.append(st.std)
         fitsinds.append(fitsind)
-    except dbremfitsobj.RemObjError as e:
+    except fitscache.FitsCacheErr as e:
         print("Error fetching", fitsind, "error was", e.args[0])
 
+if fcache is not None:
+    print(fcache.report(), file=sys.stderr)
+
 means = np.array(means)
 stdds = np.array(stdds)
 fitsinds = np.array(fitsinds)
@@ -5,11 +5,13 @@
 import sys
 import argparse
 import warnings
+import pymysql
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import remdefaults
 import remfits
 import obj_locations
 import objdata
+import skyregion
 import wcscoord
 
 # Shut up warning messages
@@ -61,8 +63,8 @@ ras = [c[0] for c in cornerradec]
 decs = [c[1] for c in cornerradec]
 
 try:
-    objlist = objdata.get_sky_region(dbcurs, target_name, inputfile.date, ras, decs)
-except objdata.ObjDataError as e:
+    objlist = skyregion.get_sky_region(dbcurs, ras, decs, inputfile.date, vicinity=target_name).objects()
+except pymysql.MySQLError as e:
     print("Search gave error", e.args[0], e.args[1], file=sys.stderr)
     sys.exit(54)
 
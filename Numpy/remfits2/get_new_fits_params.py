@@ -6,10 +6,10 @@ import sys
 import datetime
 import argparse
 import warnings
+import collections
+from multiprocessing import Pool
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 from astropy.time import Time
-import scipy.stats as ss
-import numpy as np
 import dateutil.relativedelta
 import remdefaults
 import remget
@@ -19,6 +19,7 @@ import trimarrays
 import mydateutil
 import wcscoord
 import logs
+import imagestats
 
 # Shut up warning messages
 
@@ -26,6 +27,14 @@ warnings.simplefilter('ignore', AstropyWarning)
 warnings.simplefilter('ignore', AstropyUserWarning)
 warnings.simplefilter('ignore', UserWarning)
 
+OBS_UPDATE = "UPDATE obsinf SET gain=%s,orient=%s,airmass=%s,seeing=COALESCE(%s,seeing),moonphase=%s,moondist=%s," \
+             "nrows=%s,ncols=%s,startx=%s,starty=%s,minv=%s,maxv=%s,sidet=%s,median=%s,mean=%s,std=%s,skew=%s,kurt=%s WHERE obsind=%s"
+IFORB_UPDATE = "UPDATE iforbinf SET gain=%s,nrows=%s,ncols=%s,startx=%s,starty=%s,minv=%s,maxv=%s,sidet=%s," \
+               "median=%s,mean=%s,std=%s,skew=%s,kurt=%s WHERE iforbind=%s"
+FORB_UPDATE = "UPDATE forbinf SET gain=%s,nrows=%s,ncols=%s,startx=%s,starty=%s WHERE filter=%s AND typ=%s AND year=%s AND month=%s"
+FITS_DIMS_UPDATE = "UPDATE fitsfile SET nrows=%s,ncols=%s,startx=%s,starty=%s WHERE ind=%s"
+FITS_GZ_UPDATE = "UPDATE fitsfile SET fitsgz=%s WHERE ind=%s"
+
 
 def rejectmast(cu, mtyp, myear, mmonth, mfilter, mreason):
     """Set master file to rejected for various reasons"""
@@ -33,6 +42,214 @@ def rejectmast(cu, mtyp, myear, mmonth, mfilter, mreason):
     cu.connection.commit()
 
 
+def frame_stats(fdat, nzfdat):
+    """Get min and max of non-zero pixels and median, mean, std dev, skew and kurtosis
+    of the trimmed non-zero area"""
+
+    minv, maxv = imagestats.nonzero_range(fdat)
+    st = imagestats.image_stats(nzfdat, trim=realtrimsides, median=median_method)
+    return minv, maxv, st.median, st.mean, st.std, st.skew, st.kurt
+
+
+def check_fits(ffmem, date_obs, exptime):
+    """Decode FITS file and check date and exposure time, return header, data and
+    rejection reason or None"""
+
+    ffhdr, fdat = fitsops.mem_get(ffmem)
+    if ffhdr is None:
+        return None, None, "Cannot read FITS file"
+    fdate = Time(ffhdr['DATE-OBS']).datetime
+    if not mydateutil.sametime(fdate, date_obs):
+        return None, None, "FITS date of " + mydateutil.mysql_datetime(fdate) + " does not agree"
+    fexptime = ffhdr['EXPTIME']
+    if fexptime != exptime:
+        return None, None, f"FITS exposure time of {fexptime} does not agree"
+    return ffhdr, fdat, None
+
+
+def new_fitsgz(ffhdr, fdat, startx, starty, fitscols, fitsrows):
+    """Return FITS file with dimensions put in the header if they were missing, otherwise None"""
+    if remfits.check_has_dims(ffhdr):
+        return None
+    remfits.set_dims_in_hdr(ffhdr, startx, starty, fitscols, fitsrows)
+    return fitsops.mem_makefits(ffhdr, fdat)
+
+
+def size_reject(fitsrows, fitscols, rrows, rcols):
+    """Give reason for rejection if size not as expected, otherwise None"""
+    if rrows != fitsrows:
+        return f"*** Height {fitsrows} of FITS not {rrows} as expected"
+    if rcols != fitscols:
+        return f"*** Width {fitscols} of FITS not {rcols} as expected"
+    return None
+
+
+def obs_params(row, ffmem):
+    """Work out parameters for observation, run in worker process.
+
+    Return rejection reason before update, update parameters, new FITS file or None
+    and rejection reason after update"""
+
+    obsind, fitsind, exptime, ofilter, date_obs, gain, dithID, ffname = row
+    ffhdr, fdat, reason = check_fits(ffmem, date_obs, exptime)
+    if reason is not None:
+        return reason, None, None, None
+
+    fgain = ffhdr['GAIN']
+    fairmass = ffhdr['AIRMASS']
+
+    if dithID != 0:
+        moonphase = moondist = -1000.0
+        sideexpected = 512
+    else:
+        moonphase = ffhdr['MOONPHAS']
+        moondist = ffhdr['MOONDIST']
+        sideexpected = 1024
+
+    sidesize = fdat.shape[0]
+    if sidesize != sideexpected:
+        return f"FITS has size of {sidesize} not {sideexpected} as expected", None, None, None
+
+    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
+    nzfdat = trimarrays.trimzeros(fdat)
+    fitsrows, fitscols = nzfdat.shape
+
+    w = wcscoord.wcscoord(ffhdr)
+    cornerpix = ((0, 0), (fitscols - 1, fitsrows - 1))
+    ((blra, bldec), (trra, trdec)) = w.pix_to_coords(cornerpix)
+    if trra < blra:
+        if trdec > bldec:
+            orient = 0
+        else:
+            orient = 1
+    else:
+        if trdec > bldec:
+            orient = 3
+        else:
+            orient = 2
+    try:
+        fseeing = ffhdr['SEEING']
+    except KeyError:
+        fseeing = None
+
+    minv, maxv, median, mean, std, skew, kurt = frame_stats(fdat, nzfdat)
+    params = (fgain, orient, fairmass, fseeing, moonphase, moondist, fitsrows, fitscols, startx, starty,
+              minv, maxv, realtrimsides, median, mean, std, skew, kurt, obsind)
+
+    newgz = None
+    if fitsind != 0 and dithID == 0:
+        newgz = new_fitsgz(ffhdr, fdat, startx, starty, fitscols, fitsrows)
+
+    return None, params, newgz, size_reject(fitsrows, fitscols, rrows, rcols)
+
+
+def forb_params(row, ffmem):
+    """Work out parameters for master flat or bias, run in worker process"""
+
+    year, month, ofilter, typ, fitsind = row
+
+    # Manufacture end of month out of year and month
+
+    date_obs = datetime.datetime(year, month, 15, 23, 59, 0) + dateutil.relativedelta.relativedelta(day=31)
+
+    ffhdr, fdat = fitsops.mem_get(ffmem)
+    fgain = ffhdr['GAIN']
+
+    if typ == 'flat':
+        nzfdat = trimarrays.trimnan(fdat)
+    else:
+        nzfdat = trimarrays.trimzeros(fdat)
+
+    fitsrows, fitscols = nzfdat.shape
+    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
+    params = (fgain, fitsrows, fitscols, startx, starty, ofilter, typ, year, month)
+    return None, params, new_fitsgz(ffhdr, fdat, startx, starty, fitscols, fitsrows), size_reject(fitsrows, fitscols, rrows, rcols)
+
+
+def iforb_params(row, ffmem):
+    """Work out parameters for individual flat or bias, run in worker process"""
+
+    fitsind, iforbind, typ, gain, exptime, ofilter, date_obs = row
+    ffhdr, fdat, reason = check_fits(ffmem, date_obs, exptime)
+    if reason is not None:
+        return reason, None, None, None
+
+    fgain = ffhdr['GAIN']
+    nzfdat = trimarrays.trimzeros(fdat)
+    fitsrows, fitscols = nzfdat.shape
+    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
+    minv, maxv, median, mean, std, skew, kurt = frame_stats(fdat, nzfdat)
+    params = (fgain, fitsrows, fitscols, startx, starty, minv, maxv, realtrimsides, median, mean, std, skew, kurt, iforbind)
+    return None, params, new_fitsgz(ffhdr, fdat, startx, starty, fitscols, fitsrows), size_reject(fitsrows, fitscols, rrows, rcols)
+
+
+def pipeline(pool, rows, fetchfn, workfn):
+    """Fetch FITS files for rows in this process, where we have the database connection, while the
+    workers decode them and work out the parameters. At most prefetch files are in hand at once.
+
+    Yield row and result of workfn or row and rejection reason if the fetch failed, in order of rows"""
+
+    inflight = collections.deque()
+    for row in rows:
+        try:
+            inflight.append((row, pool.apply_async(workfn, (row, fetchfn(row)))))
+        except remget.RemGetError as e:
+            inflight.append((row, e.args[0]))
+        while len(inflight) >= prefetch:
+            row, res = inflight.popleft()
+            if isinstance(res, str):
+                yield row, (res, None, None, None)
+            else:
+                yield row, res.get()
+    while len(inflight) != 0:
+        row, res = inflight.popleft()
+        if isinstance(res, str):
+            yield row, (res, None, None, None)
+        else:
+            yield row, res.get()
+
+
+class BatchUpdater:
+    """Accumulate parameterised updates and run them with executemany every so many rows,
+    applying any rejections which must come after the updates and committing"""
+
+    def __init__(self, dbase, dbcurs, commitevery):
+        self.dbase = dbase
+        self.dbcurs = dbcurs
+        self.commitevery = commitevery
+        self.pending = dict()
+        self.postrejects = []
+        self.nrows = 0
+
+    def add(self, stmt, params):
+        """Add update to be done"""
+        try:
+            self.pending[stmt].append(params)
+        except KeyError:
+            self.pending[stmt] = [params]
+
+    def postreject(self, rejfn, *args, **kwargs):
+        """Add rejection to be done after the updates"""
+        self.postrejects.append((rejfn, args, kwargs))
+
+    def endrow(self):
+        """Note end of row, flushing if we have enough"""
+        self.nrows += 1
+        if self.nrows >= self.commitevery:
+            self.flush()
+
+    def flush(self):
+        """Run pending updates and rejections and commit"""
+        for stmt, plist in self.pending.items():
+            self.dbcurs.executemany(stmt, plist)
+        for rejfn, args, kwargs in self.postrejects:
+            rejfn(*args, **kwargs)
+        self.dbase.commit()
+        self.pending = dict()
+        self.postrejects = []
+        self.nrows = 0
+
+
 parsearg = argparse.ArgumentParser(description='Update database fields from newly-loaded FITS files', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 remdefaults.parseargs(parsearg, libdir=False, tempdir=False)
 logs.parseargs(parsearg)
@@ -40,6 +257,10 @@ parsearg.add_argument('--trimsides', type=int, default=0, help='Amount to trip o
 parsearg.add_argument('--remir', action='store_true', help='Include REMIR files (not yet fully implemented')
 parsearg.add_argument('--hasfile', action='store_false', help='Restrict to files we have loaded')
 parsearg.add_argument('--inclreject', action='store_true', help='Include files already rejected')
+parsearg.add_argument('--median', type=str, default='exact', choices=imagestats.MEDIAN_METHODS, help='Exact median or approximate from histogram')
+parsearg.add_argument('--maxproc', type=int, default=8, help='Maximum number of processes to run')
+parsearg.add_argument('--prefetch', type=int, default=32, help='Maximum number of FITS files to have in hand at once')
+parsearg.add_argument('--commitevery', type=int, default=100, help='Number of rows to update between commits')
 parsearg.add_argument('--verbose', action='count', help='Be increasingly verbose')
 resargs = vars(parsearg.parse_args())
 remdefaults.getargs(resargs)
@@ -47,6 +268,10 @@ logging = logs.getargs(resargs)
 trimsides = resargs['trimsides']
 verbose = resargs['verbose']
 inclrej = resargs['inclreject']
+median_method = resargs['median']
+maxproc = resargs['maxproc']
+prefetch = max(resargs['prefetch'], 1)
+commitevery = max(resargs['commitevery'], 1)
 
 fieldselect = []
 if not inclrej:
@@ -72,6 +297,11 @@ fieldselect.append('(' + " OR ".join(orfields) + ')')
 
 realtrimsides = max(trimsides, 0)
 
+# Workers are forked here so they inherit the settings above
+
+pool = Pool(maxproc)
+starttime = datetime.datetime.now()
+
 dbase, dbcurs = remdefaults.opendb()
 dbcurs.execute("SELECT obsind,ind,exptime,filter,date_obs,gain,dithID,ffname FROM obsinf WHERE " + " AND ".join(fieldselect))
 rows = dbcurs.fetchall()
@@ -80,127 +310,47 @@ dims_added = 0
 nfiles = 0
 nreject = 0
 nrows = len(rows)
+updater = BatchUpdater(dbase, dbcurs, commitevery)
 
-for obsind, fitsind, exptime, ofilter, date_obs, gain, dithID, ffname in rows:
-
-    try:
-        if fitsind == 0:
-            ffmem = remget.get_obs(ffname, dithID != 0)
-        else:
-            ffmem = remget.get_saved_fits(dbcurs, fitsind)
-    except remget.RemGetError as e:
-        remget.set_rejection(dbcurs, obsind, e.args[0])
-        nreject += 1
-        continue
 
-    ffhdr, fdat = fitsops.mem_get(ffmem)
-    if ffhdr is None:
-        remget.set_rejection(dbcurs, obsind, "Cannot read FITS file")
-        nreject += 1
-        continue
+def fetch_obs(row):
+    """Fetch FITS file for observation row"""
+    obsind, fitsind, exptime, ofilter, date_obs, gain, dithID, ffname = row
+    if fitsind == 0:
+        return remget.get_obs(ffname, dithID != 0)
+    return remget.get_saved_fits(dbcurs, fitsind)
 
-    fdate = Time(ffhdr['DATE-OBS']).datetime
-    if not mydateutil.sametime(fdate, date_obs):
-        remget.set_rejection(dbcurs, obsind, "FITS date of " + mydateutil.mysql_datetime(fdate) + " does not agree")
-        nreject += 1
-        continue
 
-    fexptime = ffhdr['EXPTIME']
-    if fexptime != exptime:
-        remget.set_rejection(dbcurs, obsind, f"FITS exposure time of {fexptime} does not agree" % fexptime)
+for row, (reason, params, newgz, postreason) in pipeline(pool, rows, fetch_obs, obs_params):
+    obsind, fitsind, exptime, ofilter, date_obs, gain, dithID, ffname = row
+    if reason is not None:
+        remget.set_rejection(dbcurs, obsind, reason)
         nreject += 1
         continue
 
-    fgain = ffhdr['GAIN']
-    fairmass = ffhdr['AIRMASS']
-
-    if dithID != 0:
-        moonphase = moondist = -1000.0
-        sideexpected = 512
-    else:
-        moonphase = ffhdr['MOONPHAS']
-        moondist = ffhdr['MOONDIST']
-        sideexpected = 1024
-
-    sidesize = fdat.shape[0]
-    if sidesize != sideexpected:
-        remget.set_rejection(dbcurs, obsind, f"FITS has size of {sidesize} not {sideexpected} as expected")
-        nreject += 1
-        continue
-
-    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
-    nzfdat = trimarrays.trimzeros(fdat)
-    fitsrows, fitscols = nzfdat.shape
-
-    sqq = fdat.flatten()
-    sqq = sqq[sqq != 0]
-    tsfdat = nzfdat
-    if realtrimsides > 0:
-        tsfdat = nzfdat[realtrimsides:-realtrimsides, realtrimsides:-realtrimsides]
-
-    w = wcscoord.wcscoord(ffhdr)
-    cornerpix = ((0, 0), (fitscols - 1, fitsrows - 1))
-    ((blra, bldec), (trra, trdec)) = w.pix_to_coords(cornerpix)
-    if trra < blra:
-        if trdec > bldec:
-            orient = 0
-        else:
-            orient = 1
-    else:
-        if trdec > bldec:
-            orient = 3
-        else:
-            orient = 2
-    updfields = []
-    updfields.append(f"gain={fgain}")
-    updfields.append(f"orient={orient}")
-    updfields.append(f"airmass={fairmass}")
-    try:
-        fseeing = ffhdr['SEEING']
-        updfields.append(f"seeing={fseeing}")
-    except KeyError:
-        pass
-    updfields.append(f"moonphase={moonphase}")
-    updfields.append(f"moondist={moondist}")
-    updfields.append(f"nrows={fitsrows}")
-    updfields.append(f"ncols={fitscols}")
-    updfields.append(f"startx={startx}")
-    updfields.append(f"starty={starty}")
-    updfields.append(f"minv={sqq.min()}")
-    updfields.append(f"maxv={sqq.max()}")
-    updfields.append(f"sidet={realtrimsides}")
-    updfields.append(f"median={np.median(tsfdat)}")
-    updfields.append(f"mean={tsfdat.mean()}")
-    updfields.append(f"std={tsfdat.std()}")
-    updfields.append(f"skew={ss.skew(tsfdat, axis=None)}")
-    updfields.append(f"kurt={ss.kurtosis(tsfdat, axis=None)}")
-    dbcurs.execute("UPDATE obsinf SET " + ",".join(updfields) + f" WHERE obsind={obsind}")
+    updater.add(OBS_UPDATE, params)
     if fitsind != 0:
-        dbcurs.execute(f"UPDATE fitsfile SET nrows={fitsrows},ncols={fitscols},startx={startx},starty={starty} WHERE ind={fitsind}")
-        if dithID == 0 and not remfits.check_has_dims(ffhdr):
-            remfits.set_dims_in_hdr(ffhdr, startx, starty, fitscols, fitsrows)
-            dbcurs.execute(f"UPDATE fitsfile SET fitsgz=%s WHERE ind={fitsind}", fitsops.mem_makefits(ffhdr, fdat))
+        updater.add(FITS_DIMS_UPDATE, params[6:10] + (fitsind, ))
+        if newgz is not None:
+            updater.add(FITS_GZ_UPDATE, (newgz, fitsind))
             dims_added += 1
 
     # Do this check after we've updated the fields
-    if rrows != fitsrows:
-        remget.set_rejection(dbcurs, obsind, f"*** Height {fitsrows} of FITS not {rrows} as expected")
-        nreject += 1
-        continue
-    if rcols != fitscols:
-        remget.set_rejection(dbcurs, obsind, f"*** Width {fitscols} of FITS not {rcols} as expected")
+    if postreason is not None:
+        updater.postreject(remget.set_rejection, dbcurs, obsind, postreason)
         nreject += 1
-        continue
-
-    dbase.commit()
-    nfiles += 1
-    if verbose:
+    else:
+        nfiles += 1
+    updater.endrow()
+    if verbose and postreason is None:
         if verbose == 1:
             if nfiles % 10 == 0:
                 logging.write(f"Processed {nfiles} observations out of {nrows}")
         else:
             logging.write(f"Processed observation dated {date_obs.strftime('%d/%m/%Y %H:%M:%S')} filter {ofilter} out of {nrows} obs")
 
+updater.flush()
+
 # Repeat for master flats and biases
 
 fieldselect = []
@@ -225,58 +375,35 @@ rows = dbcurs.fetchall()
 nmfb = 0
 nrows = len(rows)
 
-for year, month, ofilter, typ, fitsind in rows:
-
-    # Manufacture end of month out of year and month
-
-    date_obs = datetime.datetime(year, month, 15, 23, 59, 0) + dateutil.relativedelta.relativedelta(day=31)
-
-    try:
-        ffmem = remget.get_saved_fits(dbcurs, fitsind)
-    except remget.RemGetError as e:
-        rejectmast(dbcurs, typ, year, month, ofilter, e.args[0])
+for row, (reason, params, newgz, postreason) in pipeline(pool, rows, lambda r: remget.get_saved_fits(dbcurs, r[4]), forb_params):
+    year, month, ofilter, typ, fitsind = row
+    if reason is not None:
+        rejectmast(dbcurs, typ, year, month, ofilter, reason)
         nreject += 1
         continue
 
-    ffhdr, fdat = fitsops.mem_get(ffmem)
-    fgain = ffhdr['GAIN']
-
-    if typ == 'flat':
-        nzfdat = trimarrays.trimnan(fdat)
-    else:
-        nzfdat = trimarrays.trimzeros(fdat)
-
-    fitsrows, fitscols = nzfdat.shape
-    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
-
-    dbcurs.execute(f"UPDATE forbinf SET gain={fgain},nrows={fitsrows},ncols={fitscols},startx={startx},starty={starty} WHERE filter='{ofilter}' AND typ='{typ}' AND year={year} AND month={month}")
-    dbcurs.execute(f"UPDATE fitsfile SET nrows={fitsrows},ncols={fitscols},startx={startx},starty={starty} WHERE ind={fitsind}")
-
-    if not remfits.check_has_dims(ffhdr):
-        remfits.set_dims_in_hdr(ffhdr, startx, starty, fitscols, fitsrows)
-        dbcurs.execute(f"UPDATE fitsfile SET fitsgz=%s WHERE ind={fitsind}", fitsops.mem_makefits(ffhdr, fdat))
+    updater.add(FORB_UPDATE, params)
+    updater.add(FITS_DIMS_UPDATE, params[1:5] + (fitsind, ))
+    if newgz is not None:
+        updater.add(FITS_GZ_UPDATE, (newgz, fitsind))
         dims_added += 1
 
     # Do this check after we've updated the fields
 
-    if rrows != fitsrows:
-        rejectmast(dbcurs, typ, year, month, ofilter, f"*** Height {fitsrows} of FITS not {rrows} as expected")
-        nreject += 1
-        continue
-    if rcols != fitscols:
-        rejectmast(dbcurs, typ, year, month, ofilter, f"*** Width {fitscols} of FITS not {rcols} as expected" % (fitscols, rcols))
+    if postreason is not None:
+        updater.postreject(rejectmast, dbcurs, typ, year, month, ofilter, postreason)
         nreject += 1
-        continue
-
-    dbase.commit()
-    nmfb += 1
-    if verbose:
+    else:
+        nmfb += 1
+    updater.endrow()
+    if verbose and postreason is None:
         if verbose == 1:
             if nmfb % 10 == 0:
                 logging.write(f"Processed {nmfb} master files out of {nrows}")
         else:
             logging.write(f"Processed master file for {year}/{month} filter {ofilter} out of {nrows}")
 
+updater.flush()
 
 # Finally indiviaul flat and bias
 
@@ -302,89 +429,41 @@ rows = dbcurs.fetchall()
 nifb = 0
 nrows = len(rows)
 
-for fitsind, iforbind, typ, gain, exptime, ofilter, date_obs in rows:
-
-    try:
-        ffmem = remget.get_saved_fits(dbcurs, fitsind)
-    except remget.RemGetError as e:
-        remget.set_rejection(dbcurs, iforbind, e.args[0], table='iforbinf', column='iforbind')
-        nreject += 1
-        continue
-
-    ffhdr, fdat = fitsops.mem_get(ffmem)
-    if ffhdr is None:
-        remget.set_rejection(dbcurs, iforbind, "Cannot read FITS file", table='iforbinf', column='iforbind')
-        nreject += 1
-        continue
-
-    fdate = Time(ffhdr['DATE-OBS']).datetime
-    if not mydateutil.sametime(fdate, date_obs):
-        remget.set_rejection(dbcurs, iforbind, "FITS date of " + mydateutil.mysql_datetime(fdate) + " does not agree", table='iforbinf', column='iforbind')
+for row, (reason, params, newgz, postreason) in pipeline(pool, rows, lambda r: remget.get_saved_fits(dbcurs, r[0]), iforb_params):
+    fitsind, iforbind, typ, gain, exptime, ofilter, date_obs = row
+    if reason is not None:
+        remget.set_rejection(dbcurs, iforbind, reason, table='iforbinf', column='iforbind')
         nreject += 1
         continue
 
-    fexptime = ffhdr['EXPTIME']
-    if fexptime != exptime:
-        remget.set_rejection(dbcurs, iforbind, f"FITS exposure time of {fexptime} does not agree", table='iforbinf', column='iforbind')
-        nreject += 1
-        continue
-
-    fgain = ffhdr['GAIN']
-
-    sqq = fdat.flatten()
-    sqq = sqq[sqq != 0]
-    nzfdat = trimarrays.trimzeros(fdat)
-    fitsrows, fitscols = nzfdat.shape
-    tsfdat = nzfdat
-    if realtrimsides > 0:
-        tsfdat = nzfdat[realtrimsides:-realtrimsides, realtrimsides:-realtrimsides]
-
-    startx, starty, rcols, rrows = remdefaults.get_geom(date_obs, ofilter)
-
-    updfields = []
-    updfields.append(f"gain={fgain}")
-    updfields.append(f"nrows={fitsrows}")
-    updfields.append(f"ncols={fitscols}")
-    updfields.append(f"startx={startx}")
-    updfields.append(f"starty={starty}")
-    updfields.append(f"minv={sqq.min()}")
-    updfields.append(f"maxv={sqq.max()}")
-    updfields.append(f"sidet={realtrimsides}")
-    updfields.append(f"median={np.median(tsfdat)}")
-    updfields.append(f"mean={tsfdat.mean()}")
-    updfields.append(f"std={tsfdat.std()}")
-    updfields.append(f"skew={ss.skew(tsfdat, axis=None)}")
-    updfields.append(f"kurt={ss.kurtosis(tsfdat, axis=None)}")
-    dbcurs.execute("UPDATE iforbinf SET " + ",".join(updfields) + f" WHERE iforbind={iforbind}")
-    dbcurs.execute(f"UPDATE fitsfile SET nrows={fitsrows},ncols={fitscols},startx={startx},starty={starty} WHERE ind={fitsind}")
+    updater.add(IFORB_UPDATE, params)
+    updater.add(FITS_DIMS_UPDATE, params[1:5] + (fitsind, ))
 
     # Possibly update FITS file
 
-    if not remfits.check_has_dims(ffhdr):
-        remfits.set_dims_in_hdr(ffhdr, startx, starty, fitscols, fitsrows)
-        dbcurs.execute(f"UPDATE fitsfile SET fitsgz=%s WHERE ind={fitsind}", fitsops.mem_makefits(ffhdr, fdat))
+    if newgz is not None:
+        updater.add(FITS_GZ_UPDATE, (newgz, fitsind))
         dims_added += 1
 
     # Do this check after we've put other stuff in
 
-    if rrows != fitsrows:
-        remget.set_rejection(dbcurs, iforbind, f"*** Height {fitsrows} of FITS not {rrows} as expected", table='iforbinf', column='iforbind')
-        nreject += 1
-        continue
-    if rcols != fitscols:
-        remget.set_rejection(dbcurs, iforbind, f"*** Width {fitscols} of FITS not {rcols} as expected", table='iforbinf', column='iforbind')
+    if postreason is not None:
+        updater.postreject(remget.set_rejection, dbcurs, iforbind, postreason, table='iforbinf', column='iforbind')
         nreject += 1
-        continue
-
-    dbase.commit()
-    nifb += 1
-    if verbose:
+    else:
+        nifb += 1
+    updater.endrow()
+    if verbose and postreason is None:
         if verbose == 1:
             if nifb % 10 == 0:
                 logging.write(f"Processed {nifb} flat/bias files out of {nrows}")
         else:
             logging.write(f"Processed individual {typ} file dated {date_obs.strftime('%d/%m/%Y %H:%M:%S')} filter {ofilter} out of {nrows}")
 
+updater.flush()
+pool.close()
+pool.join()
+
 if nreject + nfiles + nmfb + nifb + dims_added == 0:
     print("Nothing needed to be adjusted", file=sys.stderr)
 else:
@@ -398,3 +477,7 @@ else:
         print(dims_added, "Dimensions added to FITS files", file=sys.stderr)
     if nreject > 0:
         print(nreject, "FITS files rejected", file=sys.stderr)
+    if verbose:
+        elapsed = (datetime.datetime.now() - starttime).total_seconds()
+        ntotal = nfiles + nmfb + nifb + nreject
+        print("{:d} files in {:.2f} seconds {:.2f}/s".format(ntotal, elapsed, ntotal / max(elapsed, 1e-6)), file=sys.stderr)
@@ -10,6 +10,7 @@ from astropy.coordinates import SkyCoord
 import astropy.units as u
 import remdefaults
 import objdata
+import querycache
 
 Gaia.MAIN_GAIA_TABLE = "gaiadr3.gaia_source"
 
@@ -19,7 +20,9 @@ parsearg.add_argument('--reset', action='store_true', help='Reset any object alr
 parsearg.add_argument('--vvalue', type=float, default=1.0, help='Value to set variability to')
 parsearg.add_argument('--radius', type=float, default=0.5, help='Radius around object in degrees')
 parsearg.add_argument('--nresults', type=int, default=10000, help='Search limit for GAIA')
+parsearg.add_argument('--epoch', type=str, help='Date (YYYY-MM-DD) to move target to for search, default today')
 remdefaults.parseargs(parsearg, tempdir=False, database=False)
+querycache.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
 targname, = resargs['target']
@@ -28,6 +31,19 @@ resetv = resargs['reset']
 vvalue = resargs['vvalue']
 radius = resargs['radius']
 Gaia.ROW_LIMIT = resargs['nresults']
+epoch = resargs['epoch']
+if epoch is None:
+    epoch = datetime.date.today().isoformat()
+try:
+    epochdate = datetime.datetime.strptime(epoch, "%Y-%m-%d")
+except ValueError:
+    print("Cannot understand epoch", epoch, file=sys.stderr)
+    sys.exit(10)
+try:
+    qcache = querycache.getargs(resargs)
+except querycache.QueryCacheErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(10)
 
 mydb, mycursor = remdefaults.opendb()
 
@@ -38,13 +54,16 @@ except objdata.ObjDataError as e:
     print("Problem with target", targname, " ".join(e.args), file=sys.stderr)
     sys.exit(20)
 
-objdat.apply_motion(datetime.datetime.now())
+objdat.apply_motion(epochdate)
 
-j = Gaia.cone_search_async(SkyCoord(ra=objdat.ra, dec=objdat.dec, unit=(u.deg, u.deg)), u.Quantity(radius, u.deg))
-
-gaia_results = j.get_results()
-desigs = gaia_results['DESIGNATION']
-photvar = gaia_results['phot_variable_flag']
+try:
+    gaia_results = qcache.get("gaia " + Gaia.MAIN_GAIA_TABLE + " limit " + str(Gaia.ROW_LIMIT), "cone " + objdat.objname, radius, epoch,
+                              lambda: Gaia.cone_search_async(SkyCoord(ra=objdat.ra, dec=objdat.dec, unit=(u.deg, u.deg)), u.Quantity(radius, u.deg)).get_results())
+except querycache.QueryCacheErr as e:
+    print("Query cache error", e.args[0], file=sys.stderr)
+    sys.exit(101)
+desigs = querycache.str_column(gaia_results['DESIGNATION'])
+photvar = querycache.str_column(gaia_results['phot_variable_flag'])
 
 if len(desigs) >= Gaia.ROW_LIMIT:
     print("Warning may be others outside limit of", Gaia.ROW_LIMIT, file=sys.stderr)
@@ -15,6 +15,8 @@ import miscutils
 import math
 import remdefaults
 import objdata
+import skyregion
+import querycache
 import re
 
 multispace = re.compile('\s{2,}')
@@ -23,21 +25,31 @@ numspacelet = re.compile('(?<=\d)\s+(?=[a-zA-Z])')
 namepref = re.compile('NAME\s+')
 
 
-def stripit(name):
-    """Strip spaces etc off name"""
-    return namepref.sub("", letspacenum.sub("", numspacelet.sub("", multispace.sub(" ", name.strip()))))
+namesep = '\x00'
+aroundsep = re.compile('\s*([|\x00])\s*')
 
 
-def parse_aliases(value):
-    """Return a list of aliases as returned by Simbad
+def tidy_names(names):
+    """Do the regex substitutions to a list of names all at once by joining them together
+    with separators the substitutions never cross"""
+    joined = aroundsep.sub(r'\1', namesep.join(names)).strip()
+    return letspacenum.sub("", numspacelet.sub("", multispace.sub(" ", joined))).split(namesep)
+
+
+def stripit(names):
+    """Strip spaces etc off list of names"""
+    return [namepref.sub("", n) for n in tidy_names(names)]
+
+
+def parse_aliases(values):
+    """Return a list of sets of aliases for each of values as returned by Simbad
      Remove spaces where appropriate"""
 
     results = []
-    for a in value.split('|'):
-         a = letspacenum.sub("", numspacelet.sub("", multispace.sub(" ", a.strip())))
-         results.append(a)
-         results.append(namepref.sub("", a))
-    return set(results)
+    for value in tidy_names(values):
+        aliases = value.split('|')
+        results.append(set(aliases) | set(namepref.sub("", a) for a in aliases))
+    return results
 
 
 class parse_simbad_result(object):
@@ -79,54 +91,62 @@ class parse_simbad_result(object):
 
 
 def parse_sbresult(sbres):
-    """Parse results and return is list of parse_simbad_results"""
-    main_ids = [stripit(p) for p in sbres['MAIN_ID'].iter_str_vals()]
-    ids = [p for p in sbres['IDS'].iter_str_vals()]
-    types = [p for p in sbres['OTYPE'].iter_str_vals()]
-    dists = sbres['Distance_distance']
-    distus = sbres['Distance_unit']
-    rvs = sbres['RV_VALUE']
-    ras = sbres['RA']
-    decs = sbres['DEC']
-    rapms = sbres['PMRA']
-    decpms = sbres['PMDEC']
+    """Parse results and return is list of parse_simbad_results, converting each column all at once"""
+    main_ids = stripit(list(querycache.str_column(sbres['MAIN_ID'])))
+    names = [m | i for m, i in zip(parse_aliases(main_ids), parse_aliases(list(querycache.str_column(sbres['IDS']))))]
+    types = querycache.str_column(sbres['OTYPE'])
+    keep = ~(np.char.startswith(np.char.lower(types), 'planet') | np.char.startswith(np.char.upper(types), 'IR'))
+
+    # Distance units vary by object so convert each lot with the same unit together
+
+    dists = querycache.float_column(sbres['Distance_distance'])
+    distus = querycache.str_column(sbres['Distance_unit'])
+    for unit in np.unique(distus[np.isfinite(dists)]):
+        sel = np.isfinite(dists) & (distus == unit)
+        dists[sel] = u.Quantity(dists[sel], unit=unit).to_value(u.lightyear)
+    rvs = querycache.float_column(sbres['RV_VALUE'], "km/s")
+    ras = Angle(querycache.str_column(sbres['RA']), u.hour).deg
+    decs = Angle(querycache.str_column(sbres['DEC']), u.deg).deg
+    rapms = querycache.float_column(sbres['PMRA'], 'mas/yr')
+    decpms = querycache.float_column(sbres['PMDEC'], 'mas/yr')
     fluxes = dict()
     for f in objdata.Possible_filters:
         if f != 'z':
-            fluxes[f] = sbres['FLUX_' + f.upper()]
+            fluxes[f] = querycache.float_column(sbres['FLUX_' + f.upper()])
 
     result = []
-    for obj in range(0, len(main_ids)):
+    for obj in np.flatnonzero(keep):
         p = parse_simbad_result()
         p.mainname = main_ids[obj]  # In case we need it
-        p.names = parse_aliases(main_ids[obj]) | parse_aliases(ids[obj])
+        p.names = names[obj]
         p.otype = types[obj]
-        if p.otype.lower().startswith('planet') or p.otype.upper().startswith('IR'):
-            continue
-        dist = float(dists[obj])
-        if not math.isnan(dist):
-            p.dist = u.Quantity(dist, unit=distus[obj]).to_value(u.lightyear)
-        rv = float(rvs[obj])
-        if not math.isnan(rv):
-            p.rv = u.Quantity(rv, unit=rvs.unit).to_value("km/s")
-        p.ra = Angle(ras[obj], u.hour).deg
-        p.dec = Angle(decs[obj], u.deg).deg
-        rapm = float(rapms[obj])
-        if not math.isnan(rapm):
-            p.rapm = u.Quantity(rapm, unit=rapms.unit).to_value('mas/yr')
-        decpm = float(decpms[obj])
-        if not math.isnan(decpm):
-            p.decpm = u.Quantity(decpm, unit=decpms.unit).to_value('mas/yr')
-        for f in objdata.Possible_filters:
-            if f == 'z':
-                continue
-            flux = fluxes[f][obj]
-            if not math.isnan(flux):
-                p.fluxes[f] = flux
+        if not math.isnan(dists[obj]):
+            p.dist = float(dists[obj])
+        if not math.isnan(rvs[obj]):
+            p.rv = float(rvs[obj])
+        p.ra = float(ras[obj])
+        p.dec = float(decs[obj])
+        if not math.isnan(rapms[obj]):
+            p.rapm = float(rapms[obj])
+        if not math.isnan(decpms[obj]):
+            p.decpm = float(decpms[obj])
+        for f, fvals in fluxes.items():
+            if not math.isnan(fvals[obj]):
+                p.fluxes[f] = float(fvals[obj])
         result.append(p)
     return  result
 
 
+def sb_query(query, radius, fetch):
+    """Run Simbad query via query cache"""
+
+    try:
+        return qcache.get(sbservice, query, radius, None, fetch)
+    except querycache.QueryCacheErr as e:
+        print("Query cache error", e.args[0], file=sys.stderr)
+        sys.exit(101)
+
+
 def add_alias_set(obj, alist):
     """Add set of aliases we just read"""
 
@@ -188,6 +208,8 @@ def add_new_object(fobj, mainname, target, dispname=None):
     obj.vicinity = target
     try:
         obj.put(dbcurs)
+        if obj.ra is not None and obj.dec is not None:
+            skyregion.set_object_cell(dbcurs, obj.objname, obj.ra, obj.dec)
     except objdata.ObjDataError as e:
         print("Unexpected error adding new object", obj.objname, "for target", target, e.args[0], e.args[1], file=sys.stderr)
         sys.exit(251)
@@ -215,6 +237,7 @@ parsearg.add_argument('--addalias', type=str, help='Add alias of given name')
 parsearg.add_argument('--remove', action='store_true', help='Remove the given alias')
 parsearg.add_argument('--source', type=str, default='By Hand', help='Source description when adding alias')
 parsearg.add_argument('--verbose', action='store_true', help='Give accound of actions"')
+querycache.parseargs(parsearg)
 
 resargs = vars(parsearg.parse_args())
 target = resargs['target'][0]
@@ -227,6 +250,11 @@ remove = resargs['remove']
 addalias = resargs['addalias']
 source = resargs['source']
 verbose = resargs['verbose']
+try:
+    qcache = querycache.getargs(resargs)
+except querycache.QueryCacheErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(10)
 
 if delete:
     shouldexist = True
@@ -306,6 +334,7 @@ sb.add_votable_fields('rv_value', 'pm', 'otype', 'distance', 'ids')
 for f in objdata.Possible_filters:
     if f != 'z':
         sb.add_votable_fields('flux(' + f.upper() + ')')
+sbservice = "simbad " + ",".join(sb.get_votable_fields())
 
 if addalias is not None:
     try:
@@ -318,7 +347,7 @@ if addalias is not None:
     except objdata.ObjDataError:
         pass
     try:
-        tobj.add_alias(dbcurs, addalias, source, sb.query_object(addalias) is not None)
+        tobj.add_alias(dbcurs, addalias, source, sb_query("object " + addalias, None, lambda: sb.query_object(addalias)) is not None)
     except objdata.ObjDataError as e:
         print("Problem with alias", addalias, e.args[0], e.args[1], file=sys.stderr)
         sys.exit(252)
@@ -327,7 +356,7 @@ if addalias is not None:
     dbase.commit()
     sys.exit(0)
 
-targ_sbq = sb.query_object(target)
+targ_sbq = sb_query("object " + target, None, lambda: sb.query_object(target))
 if targ_sbq is None:
     print("Cannot find", target, "in Simbad", file=sys.stderr)
     sys.exit(100)
@@ -353,7 +382,7 @@ if update:
 else:
     add_new_object(targres, target, target, displayname)
 
-reglist_sbq = sb.query_region(target, radius=radius * u.arcmin)
+reglist_sbq = sb_query("region " + target, radius, lambda: sb.query_region(target, radius=radius * u.arcmin))
 if reglist_sbq is None or len(reglist_sbq) == 0:
     print("Could not find in target radius", target, file=sys.stderr)
     sys.exit(10)
@@ -0,0 +1,125 @@
+"""Find plotted points near the mouse and show popups without redrawing the figure.
+
+Point positions are held in a KD-tree, in axes coordinates (0 to 1 across
+each axis) if the distance given is a fraction of the axes, or data
+coordinates otherwise. The tree is only rebuilt when the axis limits change
+on zoom or pan rather than for each mouse movement.
+
+Popups are drawn by copying the figure without them after each full draw and
+blitting the popup over that copy, falling back to draw_idle for backends
+which cannot blit."""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class HoverPicker:
+    """Find points on axes near to mouse events"""
+
+    def __init__(self, ax, points, maxdist, normalised=True):
+        self.ax = ax
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.maxdist = maxdist
+        self.normalised = normalised
+        self.tree = None
+        self.base = np.zeros(2)
+        self.scale = np.ones(2)
+        if normalised:
+            ax.callbacks.connect('xlim_changed', self.limits_changed)
+            ax.callbacks.connect('ylim_changed', self.limits_changed)
+
+    def limits_changed(self, ax):
+        """Note that the tree has to be rebuilt after zoom or pan"""
+        self.tree = None
+
+    def get_tree(self):
+        """Get KD-tree of points, rebuilding if needed"""
+        if self.tree is None:
+            if self.normalised:
+                xlo, xhi = self.ax.get_xlim()
+                ylo, yhi = self.ax.get_ylim()
+                self.base = np.array((xlo, ylo))
+                self.scale = np.array((xhi - xlo, yhi - ylo))
+            self.tree = cKDTree((self.points - self.base) / self.scale)
+        return self.tree
+
+    def event_pos(self, event):
+        """Get position of event in tree coordinates or None if not in our axes"""
+        if event.inaxes is not self.ax or event.xdata is None or event.ydata is None:
+            return None
+        return (np.array((event.xdata, event.ydata)) - self.base) / self.scale
+
+    def nearest(self, event):
+        """Get index of point nearest to event if within maxdist, otherwise None"""
+        if self.points.shape[0] == 0:
+            return None
+        tree = self.get_tree()
+        pos = self.event_pos(event)
+        if pos is None:
+            return None
+        dist, ind = tree.query(pos, distance_upper_bound=self.maxdist)
+        if not np.isfinite(dist):
+            return None
+        return int(ind)
+
+    def within(self, event):
+        """Get indices of points within maxdist of event, closest first"""
+        if self.points.shape[0] == 0:
+            return []
+        tree = self.get_tree()
+        pos = self.event_pos(event)
+        if pos is None:
+            return []
+        inds = np.array(tree.query_ball_point(pos, self.maxdist), dtype=np.int64)
+        if inds.size == 0:
+            return []
+        dists = np.hypot(*((self.points[inds] - self.base) / self.scale - pos).T)
+        return inds[np.argsort(dists, kind='stable')].tolist()
+
+
+class BlitPopup:
+    """Show and hide a popup annotation by blitting it over a saved copy of the figure"""
+
+    def __init__(self, fig, annot):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.annot = annot
+        self.background = None
+        self.current = None
+        self.useblit = getattr(self.canvas, 'supports_blit', False)
+        if self.useblit:
+            annot.set_animated(True)
+            self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        """Save copy of figure without the popup after a full draw"""
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        if self.annot.get_visible():
+            self.fig.draw_artist(self.annot)
+
+    def refresh(self):
+        """Put the popup on the screen as it is now"""
+        if not self.useblit or self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        if self.annot.get_visible():
+            self.fig.draw_artist(self.annot)
+        self.canvas.blit(self.fig.bbox)
+
+    def show(self, key, text, xy):
+        """Show popup with text at xy, doing nothing if it is already showing for key"""
+        if key == self.current and self.annot.get_visible() and xy == tuple(self.annot.xy):
+            return
+        self.current = key
+        self.annot.set_text(text)
+        self.annot.xy = xy
+        self.annot.set_visible(True)
+        self.refresh()
+
+    def hide(self):
+        """Hide popup if showing"""
+        self.current = None
+        if self.annot.get_visible():
+            self.annot.set_visible(False)
+            self.refresh()
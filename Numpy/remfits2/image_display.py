@@ -21,38 +21,38 @@ import remfits
 import col_from_file
 import find_results
 import logs
+import hoverpick
 
 
 class figuredata:
     """Remember image file and find results data for display"""
 
-    def __init__(self, fitsfilename, fitsfile, annot, findr=None):
+    def __init__(self, fig, fitsfilename, fitsfile, annot, findr=None):
         self.fitsfilename = fitsfilename
         self.fitsfile = fitsfile
         self.findres = findr
-        self.carray = None
+        self.picker = None
         self.labs = None
         if findr:
             car = []
             labs = []
             for r in findr.results():
                 if not r.hide:
-                    car.append(complex(r.col, r.row))
+                    car.append((r.col, r.row))
                     labs.append(r.label)
-            self.carray = np.array(car)
+            self.picker = hoverpick.HoverPicker(fig.axes[0], car, tagdist, normalised=False)
             self.labs = labs
         self.annot = annot
+        self.popup = hoverpick.BlitPopup(fig, annot)
 
     def results_in_area(self, event):
         """Get results in area closest to given event row and column"""
         if self.findres is None or event.xdata is None or event.ydata is None:
             return  None
-        dists = np.abs(self.carray - complex(event.xdata, event.ydata))
-        asrt = np.argsort(dists)
-        asrt = asrt[dists[asrt] <= tagdist]
-        if asrt.size == 0:
+        inds = self.picker.within(event)
+        if len(inds) == 0:
             return  None
-        return  [self.findres[self.labs[a]] for a in asrt]
+        return  [self.findres[self.labs[a]] for a in inds]
 
     def result_closest_to(self, event):
         """Get result closest to given event row and column"""
@@ -81,7 +81,7 @@ def setfig(fig, fitsfilename, fitsfile, findr=None):
     annot.set_visible(False)
     canv.mpl_connect('motion_notify_event', hover)
     canv.mpl_connect('button_press_event', button_press)
-    figdict[fig.number] = figuredata(fitsfilename, fitsfile, annot, findr)
+    figdict[fig.number] = figuredata(fig, fitsfilename, fitsfile, annot, findr)
 
 
 def hover(event):
@@ -90,12 +90,9 @@ def hover(event):
     fd = findfig(event)
     if fd is None:
         return
-    vis = fd.annot.get_visible()
     objr = fd.result_closest_to(event)
     if objr is None:
-        if vis:
-            fd.annot.set_visible(False)
-            event.canvas.draw_idle()
+        fd.popup.hide()
         return
     dispn = "(not known)"
     if objr.obj is not None:
@@ -109,11 +106,7 @@ def hover(event):
                 atxt += " "
         if objr.adus > 0.0:
             atxt += "adus: {:.1f} ap: {:.4g}".format(objr.adus, objr.apsize)
-    fd.annot.set_text(atxt)
-    # fd.annot.get_bbox_patch().set_alpha(0.4)
-    fd.annot.xy = (objr.col, objr.row)
-    fd.annot.set_visible(True)
-    event.canvas.draw_idle()
+    fd.popup.show(objr.label, atxt, (objr.col, objr.row))
 
 
 def button_press(event):
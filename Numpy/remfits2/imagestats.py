@@ -0,0 +1,154 @@
+"""Statistics of image arrays computed in one pass over the data.
+
+The data is taken a band of rows at a time and the moments for each band merged
+into the running totals (Pebay's formulae for combining central moments), so
+only one band at a time is converted to float64 and nothing of the size of the
+whole image is copied unless an exact median is asked for."""
+
+import numpy as np
+
+DEFAULT_BANDROWS = 64
+DEFAULT_NBINS = 4096
+
+MEDIAN_METHODS = ('exact', 'hist')
+
+
+class ImageStatsErr(Exception):
+    """Throw if we have problems computing statistics"""
+
+
+class ImageStats:
+    """Statistics of an image or part of one, results as per numpy and scipy.stats
+    (population std dev, biased skew and Fisher kurtosis)"""
+
+    def __init__(self):
+        self.npix = 0
+        self.minv = self.maxv = np.nan
+        self.median = np.nan
+        self.mean = np.nan
+        self.std = np.nan
+        self.skew = np.nan
+        self.kurt = np.nan
+        self.m2 = self.m3 = self.m4 = 0.0
+
+    def merge(self, vals):
+        """Merge one band of values (1-d float64 array) into the running moments"""
+        nb = vals.size
+        if nb == 0:
+            return
+        meanb = vals.mean()
+        devs = vals - meanb
+        devsq = devs * devs
+        m2b = devsq.sum()
+        m3b = np.dot(devsq, devs)
+        m4b = np.dot(devsq, devsq)
+        vmin = vals.min()
+        vmax = vals.max()
+        na = self.npix
+        if na == 0:
+            self.npix = nb
+            self.mean = meanb
+            self.m2 = m2b
+            self.m3 = m3b
+            self.m4 = m4b
+            self.minv = vmin
+            self.maxv = vmax
+            return
+        n = na + nb
+        delta = meanb - self.mean
+        dn = delta / n
+        self.m4 += m4b + delta * dn ** 3 * na * nb * (na * na - na * nb + nb * nb) + \
+            6.0 * dn * dn * (na * na * m2b + nb * nb * self.m2) + 4.0 * dn * (na * m3b - nb * self.m3)
+        self.m3 += m3b + delta * dn * dn * na * nb * (na - nb) + 3.0 * dn * (na * m2b - nb * self.m2)
+        self.m2 += m2b + delta * dn * na * nb
+        self.mean += dn * nb
+        self.npix = n
+        self.minv = min(self.minv, vmin)
+        self.maxv = max(self.maxv, vmax)
+
+    def finish(self):
+        """Work out std dev, skew and kurtosis from the moments"""
+        if self.npix == 0:
+            return
+        self.mean = float(self.mean)
+        self.minv = float(self.minv)
+        self.maxv = float(self.maxv)
+        self.std = float(np.sqrt(self.m2 / self.npix))
+        if self.m2 > 0.0:
+            self.skew = float(np.sqrt(self.npix) * self.m3 / self.m2 ** 1.5)
+            self.kurt = float(self.npix * self.m4 / self.m2 ** 2 - 3.0)
+
+
+def trim_region(fdat, trim=0):
+    """Return view of fdat with trim pixels taken off each edge"""
+    if trim > 0:
+        return fdat[trim:-trim, trim:-trim]
+    return fdat
+
+
+def nonzero_range(fdat):
+    """Return minimum and maximum of non-zero pixels of fdat without copying it"""
+    nonzero = fdat != 0
+    if not nonzero.any():
+        return np.nan, np.nan
+    if np.issubdtype(fdat.dtype, np.integer):
+        lims = np.iinfo(fdat.dtype)
+    else:
+        lims = np.finfo(fdat.dtype)
+    return float(np.min(fdat, where=nonzero, initial=lims.max)), float(np.max(fdat, where=nonzero, initial=lims.min))
+
+
+def band_values(region, mask, startrow, endrow):
+    """Get values from a band of rows as 1-d float64 array leaving out masked pixels"""
+    band = region[startrow:endrow]
+    if mask is not None:
+        band = band[~mask[startrow:endrow]]
+    return band.astype(np.float64).ravel()
+
+
+def hist_median(region, mask, minv, maxv, npix, nbins=DEFAULT_NBINS, bandrows=DEFAULT_BANDROWS):
+    """Approximate median from histogram of values, interpolating within the bin containing it"""
+    if maxv <= minv:
+        return float(minv)
+    counts = np.zeros(nbins, dtype=np.int64)
+    for startrow in range(0, region.shape[0], bandrows):
+        vals = band_values(region, mask, startrow, startrow + bandrows)
+        counts += np.histogram(vals, bins=nbins, range=(minv, maxv))[0]
+    cumcounts = np.cumsum(counts)
+    half = npix / 2.0
+    binnum = np.searchsorted(cumcounts, half)
+    below = cumcounts[binnum - 1] if binnum > 0 else 0
+    binwidth = (maxv - minv) / nbins
+    return float(minv + binwidth * (binnum + (half - below) / max(counts[binnum], 1)))
+
+
+def image_stats(fdat, trim=0, mask=None, median='exact', nbins=DEFAULT_NBINS, bandrows=DEFAULT_BANDROWS):
+    """Compute statistics of fdat, trimming trim pixels off each edge and leaving out pixels where
+    mask (same shape as fdat) is True.
+
+    median may be 'exact', 'hist' for an approximation from a histogram of nbins bins, or None to skip it.
+
+    Return ImageStats structure"""
+
+    if mask is not None and mask.shape != fdat.shape:
+        raise ImageStatsErr("Mask shape " + str(mask.shape) + " does not match data shape " + str(fdat.shape))
+    if median is not None and median not in MEDIAN_METHODS:
+        raise ImageStatsErr("Unknown median method " + median)
+    region = trim_region(fdat, trim)
+    if mask is not None:
+        mask = trim_region(mask, trim)
+
+    result = ImageStats()
+    for startrow in range(0, region.shape[0], bandrows):
+        result.merge(band_values(region, mask, startrow, startrow + bandrows))
+    result.finish()
+
+    if result.npix == 0 or median is None:
+        return result
+    if median == 'hist':
+        result.median = hist_median(region, mask, result.minv, result.maxv, result.npix, nbins, bandrows)
+    elif mask is None:
+        result.median = float(np.median(region))
+    else:
+        result.median = float(np.median(region[~mask]))
+    return result
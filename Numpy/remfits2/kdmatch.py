@@ -0,0 +1,110 @@
+"""Match catalogue object locations to find results using a KD-tree.
+
+Positions are taken in pixels on the image, which is the tangent plane
+projection given by the WCS, and the threshold converted from arcsec using the
+pixel scale at the centre of the image.
+
+Only the pairs within the threshold are found, via the KD-tree, and then either
+assigned greedily, closest first, or by the Hungarian algorithm separately in
+each group of locations and find results linked by such pairs, so no full
+matrix of distances is ever formed."""
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
+
+MATCH_METHODS = ('greedy', 'hungarian')
+
+
+class KdMatchErr(Exception):
+    """Throw if we have problems matching"""
+
+
+def pixel_scale(wcs, ncols, nrows):
+    """Get size of pixel in arcsec at centre of image from WCS"""
+    col = ncols / 2.0
+    row = nrows / 2.0
+    ra0, dec0 = wcs.colrow_to_coords(col, row)
+    ra1, dec1 = wcs.colrow_to_coords(col + 1.0, row + 1.0)
+    dra = (ra1 - ra0) * np.cos(np.radians((dec0 + dec1) / 2.0))
+    return 3600.0 * np.hypot(dra, dec1 - dec0) / np.sqrt(2.0)
+
+
+def close_pairs(locpos, findpos, maxdist):
+    """Find all pairs of locations and find results within maxdist of each other.
+
+    Return arrays of location indices, find result indices and distances"""
+    if len(locpos) == 0 or len(findpos) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    pairs = cKDTree(locpos).sparse_distance_matrix(cKDTree(findpos), maxdist, output_type='coo_matrix')
+    return pairs.row.astype(np.int64), pairs.col.astype(np.int64), pairs.data
+
+
+def greedy_assign(locinds, findinds, dists):
+    """Assign pairs closest first never using a location or find result twice"""
+    result = []
+    usedloc = set()
+    usedfind = set()
+    for n in np.argsort(dists, kind='stable'):
+        li = locinds[n]
+        fi = findinds[n]
+        if li in usedloc or fi in usedfind:
+            continue
+        usedloc.add(li)
+        usedfind.add(fi)
+        result.append((int(li), int(fi), float(dists[n])))
+    return result
+
+
+def hungarian_assign(locinds, findinds, dists, nlocs, nfinds):
+    """Assign pairs to maximise number of matches and then minimise total distance, doing each
+    connected group of pairs separately"""
+    graph = coo_matrix((np.ones(dists.size), (locinds, findinds + nlocs)), shape=(nlocs + nfinds, nlocs + nfinds))
+    ncomp, comp = connected_components(graph, directed=False)
+    pcomp = comp[locinds]
+    result = []
+    for c in np.unique(pcomp):
+        sel = pcomp == c
+        li = locinds[sel]
+        fi = findinds[sel]
+        d = dists[sel]
+        ulocs, lrow = np.unique(li, return_inverse=True)
+        ufinds, fcol = np.unique(fi, return_inverse=True)
+
+        # Pairs beyond the threshold cost more than any set of real pairs so we get the most matches
+
+        big = d.sum() + 1.0
+        cost = np.full((ulocs.size, ufinds.size), big)
+        cost[lrow, fcol] = d
+        rows, cols = linear_sum_assignment(cost)
+        for r, cl in zip(rows, cols):
+            if cost[r, cl] < big:
+                result.append((int(ulocs[r]), int(ufinds[cl]), float(cost[r, cl])))
+    return result
+
+
+def match_positions(locpos, findpos, maxdist, method='greedy'):
+    """Match (col, row) positions in locpos to those in findpos within maxdist.
+
+    Return list of (location index, find result index, distance) sorted by location index"""
+    if method not in MATCH_METHODS:
+        raise KdMatchErr("Unknown match method " + method)
+    locpos = np.asarray(locpos, dtype=np.float64).reshape(-1, 2)
+    findpos = np.asarray(findpos, dtype=np.float64).reshape(-1, 2)
+    locinds, findinds, dists = close_pairs(locpos, findpos, maxdist)
+    if method == 'greedy':
+        result = greedy_assign(locinds, findinds, dists)
+    else:
+        result = hungarian_assign(locinds, findinds, dists, len(locpos), len(findpos))
+    return sorted(result)
+
+
+def allocate_locs(locations, findres, threshold, scale, method='greedy'):
+    """Match object locations to find results within threshold arcsec given pixel scale in arcsec.
+
+    Return list of (location index, find result index, distance in arcsec) as for match_finds.allocate_locs"""
+    locpos = [(l.col, l.row) for l in locations.resultlist]
+    findpos = [(f.col, f.row) for f in findres.resultlist]
+    return [(li, fi, d * scale) for li, fi, d in match_positions(locpos, findpos, threshold / scale, method)]
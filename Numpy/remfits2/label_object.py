@@ -7,6 +7,7 @@ import sys
 import remdefaults
 import objdata
 import vicinity
+import skyregion
 
 parsearg = argparse.ArgumentParser(description='Apply lable to object at given position', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parsearg.add_argument('coords', nargs=2, type=float, help='RA and DEC of object in degrees')
@@ -74,6 +75,8 @@ if len(matchreg) != 0:
         updfields.append("radeg={:.8e}".format(radeg))
     if decdeg != exist_dec:
         updfields.append("decdeg={:.8e}".format(decdeg))
+    if radeg != exist_ra or decdeg != exist_dec:
+        updfields.append("skycell={:d}".format(int(skyregion.cell_index(radeg, decdeg))))
     if pmra is not None:
         updfields.append("rapm={:.8e}".format(pmra))
     if pmdec is not None:
@@ -135,6 +138,9 @@ addvalues.append("{:.8e}".format(radeg))
 
 addfields.append("decdeg")
 addvalues.append("{:.8e}".format(decdeg))
+
+addfields.append("skycell")
+addvalues.append("{:d}".format(int(skyregion.cell_index(radeg, decdeg))))
 if pmra is not None:
     addfields.append("rapm")
     addvalues.append("{:.8e}".format(pmra))
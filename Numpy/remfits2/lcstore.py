@@ -0,0 +1,133 @@
+"""Store of light curve data for each vicinity kept as NumPy arrays.
+
+Each vicinity has one .npy file holding a structured array with a record for
+each object in each observation taken from aducalc and obsinf, joined through
+findresult and leaving out hidden results as the light curve scripts reading the
+database do, sorted by object, filter and date, so everything for one object
+(and filter) is a contiguous slice of the file, which is opened memory-mapped
+and read only as needed.
+
+Files are updated by adding observations not yet in them, or replacing ones
+asked for, and written to a temporary file and renamed so a reader never sees
+a partly-written store."""
+
+import os
+import os.path
+import re
+import tempfile
+import numpy as np
+
+DEFAULT_STOREDIR = "~/.remlcstore"
+
+LC_DTYPE = np.dtype([('objind', np.int64), ('filter', 'U1'), ('bjd', np.float64), ('obsind', np.int64),
+                     ('dateobs', 'datetime64[s]'), ('adus', np.float64), ('aduerr', np.float64),
+                     ('sky', np.float64), ('skystd', np.float64), ('apsize', np.float64)])
+
+OBSINDS_QUERY = "SELECT obsind FROM obsinf WHERE object=%s AND rejreason IS NULL"
+ROWS_QUERY = "SELECT findresult.objind,obsinf.filter,bjdobs,obsinf.obsind,date_obs,aducount,aduerr,skylevel,skystd,aducalc.apsize " \
+             "FROM obsinf INNER JOIN findresult ON obsinf.obsind=findresult.obsind " \
+             "INNER JOIN aducalc ON findresult.ind=aducalc.frind WHERE findresult.hide=0 AND obsinf.obsind IN ({:s})"
+
+QUERY_CHUNK = 1000  # Obsinds in one IN list
+
+
+class LcStoreErr(Exception):
+    """Throw if we have problems with the light curve store"""
+
+
+def store_file(storedir, vicinity):
+    """Get the name of the store file for vicinity"""
+    return os.path.join(os.path.expanduser(storedir), re.sub(r'[^\w.+-]', '_', vicinity) + ".npy")
+
+
+def load(vicinity, storedir=DEFAULT_STOREDIR):
+    """Open store for vicinity memory-mapped, giving empty array if there isn't one yet"""
+    fname = store_file(storedir, vicinity)
+    try:
+        table = np.load(fname, mmap_mode='r')
+    except FileNotFoundError:
+        return np.zeros(0, dtype=LC_DTYPE)
+    except (OSError, ValueError) as e:
+        raise LcStoreErr("Cannot read light curve store " + fname + " error was " + str(e))
+    if table.dtype != LC_DTYPE:
+        raise LcStoreErr("Light curve store " + fname + " has unexpected format, please rebuild")
+    return table
+
+
+def save(table, vicinity, storedir=DEFAULT_STOREDIR):
+    """Save table as store for vicinity sorted by object, filter and date"""
+    fname = store_file(storedir, vicinity)
+    dname = os.path.dirname(fname)
+    os.makedirs(dname, exist_ok=True)
+    table = table[np.lexsort((table['bjd'], table['filter'], table['objind']))]
+    fd, tmpname = tempfile.mkstemp(suffix=".npy", dir=dname)
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            np.save(outf, table)
+        os.replace(tmpname, fname)
+    except OSError as e:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise LcStoreErr("Cannot write light curve store " + fname + " error was " + str(e))
+
+
+def fetch_rows(dbcurs, obsinds):
+    """Get records for the given obsinds from aducalc, findresult and obsinf"""
+    obsinds = [int(o) for o in obsinds]
+    dbrows = []
+    for n in range(0, len(obsinds), QUERY_CHUNK):
+        chunk = obsinds[n:n + QUERY_CHUNK]
+        dbcurs.execute(ROWS_QUERY.format(",".join(["%s"] * len(chunk))), chunk)
+        dbrows += dbcurs.fetchall()
+    result = np.zeros(len(dbrows), dtype=LC_DTYPE)
+    if len(dbrows) == 0:
+        return result
+    objind, filt, bjd, obsind, dateobs, adus, aduerr, sky, skystd, apsize = zip(*dbrows)
+    result['objind'] = objind
+    result['filter'] = filt
+    result['obsind'] = obsind
+    result['dateobs'] = np.array(dateobs, dtype='datetime64[s]')
+    for field, vals in (('bjd', bjd), ('adus', adus), ('aduerr', aduerr), ('sky', sky), ('skystd', skystd), ('apsize', apsize)):
+        result[field] = np.array([np.nan if v is None else v for v in vals], dtype=np.float64)
+    return result
+
+
+def update(dbcurs, vicinity, redo=None, rebuild=False, storedir=DEFAULT_STOREDIR):
+    """Add observations of vicinity not in the store yet, also replacing any in redo.
+
+    Return number of observations fetched"""
+    if rebuild:
+        table = np.zeros(0, dtype=LC_DTYPE)
+    else:
+        table = np.array(load(vicinity, storedir))
+    dbcurs.execute(OBSINDS_QUERY, vicinity)
+    wanted = np.array([r[0] for r in dbcurs.fetchall()], dtype=np.int64)
+    fetch = np.setdiff1d(wanted, table['obsind'])
+    if redo is not None:
+        redo = np.intersect1d(np.asarray(redo, dtype=np.int64), wanted)
+        fetch = np.union1d(fetch, redo)
+
+    # Drop ones being refetched and any rejected since they went in
+
+    keep = np.isin(table['obsind'], wanted) & ~np.isin(table['obsind'], fetch)
+    if fetch.size == 0 and keep.all():
+        return 0
+    table = table[keep]
+    save(np.concatenate((table, fetch_rows(dbcurs, fetch))), vicinity, storedir)
+    return fetch.size
+
+
+def object_rows(table, objind, filters=None):
+    """Get the records for one object, optionally only in given filters, sorted by filter and date"""
+    first, last = np.searchsorted(table['objind'], [objind, objind + 1])
+    result = table[first:last]
+    if filters is not None:
+        result = result[np.isin(result['filter'], list(filters))]
+    return result
+
+
+def obsind_rows(table, obsinds):
+    """Get the records for the given observations"""
+    return table[np.isin(table['obsind'], np.asarray(obsinds, dtype=np.int64))]
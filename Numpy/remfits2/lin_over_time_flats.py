@@ -19,7 +19,8 @@ import string
 import remgeom
 import dbops
 import remdefaults
-import dbremfitsobj
+import fitscache
+import imagestats
 import os
 import os.path
 import subprocess
@@ -33,6 +34,7 @@ rg = remgeom.load()
 parsearg = argparse.ArgumentParser(description='Plot linearity over time of daily flats with trims', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 remdefaults.parseargs(parsearg, libdir=False, tempdir=False)
 parsetime.parseargs_daterange(parsearg)
+fitscache.parseargs(parsearg)
 parsearg.add_argument('--limits', type=str, help='Lower:upper limit of means')
 parsearg.add_argument('--trims', type=int, default=0, help='Amount to trim off each side')
 parsearg.add_argument('--clipstd', type=float, help='Clip std devs this multiple different from std dev of std devs')
@@ -47,6 +49,11 @@ rg.disp_argparse(parsearg)
 
 resargs = vars(parsearg.parse_args())
 remdefaults.getargs(resargs)
+try:
+    fcache = fitscache.getargs(resargs)
+except fitscache.FitsCacheErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(10)
 title = resargs['title']
 xlab = resargs['xlabel']
 ylab = resargs['ylabel']
@@ -92,18 +99,18 @@ fitsinds = []
 dates = []
 for rows, cols, fitsind, dobs in dbrows:
     try:
-        ff = dbremfitsobj.getfits(dbcurs, fitsind)
-        fdat = ff[0].data[0:rows, 0:cols].astype(np.float32)
-        ff.close()
-        if trims > 0:
-            fdat = fdat[trims:-trims, trims:-trims]
-        means.append(fdat.mean())
-        stdds.append(fdat.std())
+        hdr, data = fitscache.get_fits(fcache, dbcurs, fitsind)
+        st = imagestats.image_stats(data[0:rows, 0:cols], trim=trims, median=None)
+        means.append(st.mean)
+        stdds.append(st.std)
         fitsinds.append(fitsind)
         dates.append(dobs)
-    except dbremfitsobj.RemObjError as e:
+    except fitscache.FitsCacheErr as e:
         print("Error fetching", fitsind, "error was", e.args[0])
 
+if fcache is not None:
+    print(fcache.report(), file=sys.stderr)
+
 means = np.array(means)
 stdds = np.array(stdds)
 fitsinds = np.array(fitsinds)
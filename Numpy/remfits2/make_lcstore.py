@@ -0,0 +1,40 @@
+#!  /usr/bin/env python3
+
+"""Create or bring up to date light curve store for vicinities"""
+
+import argparse
+import sys
+import remdefaults
+import lcstore
+
+parsearg = argparse.ArgumentParser(description='Add new observations from aducalc to light curve store', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parsearg.add_argument('vicinities', nargs='+', type=str, help='Vicinities (target objects) to do')
+remdefaults.parseargs(parsearg, tempdir=False, inlib=False)
+parsearg.add_argument('--storedir', type=str, default=lcstore.DEFAULT_STOREDIR, help='Directory for light curve store')
+parsearg.add_argument('--redo', type=int, nargs='*', help='Obsinds to fetch again, e.g. after recalculating ADUs or hiding results')
+parsearg.add_argument('--rebuild', action='store_true', help='Rebuild store from scratch')
+parsearg.add_argument('--verbose', action='store_true', help='Report number of observations added')
+
+resargs = vars(parsearg.parse_args())
+vicinities = resargs['vicinities']
+remdefaults.getargs(resargs)
+storedir = resargs['storedir']
+redo = resargs['redo']
+rebuild = resargs['rebuild']
+verbose = resargs['verbose']
+
+mydb, dbcurs = remdefaults.opendb()
+
+errors = 0
+for vicinity in vicinities:
+    try:
+        nobs = lcstore.update(dbcurs, vicinity, redo=redo, rebuild=rebuild, storedir=storedir)
+    except lcstore.LcStoreErr as e:
+        print(vicinity, e.args[0], file=sys.stderr)
+        errors += 1
+        continue
+    if verbose:
+        print(vicinity, nobs, "observations added", file=sys.stderr)
+
+if errors > 0:
+    sys.exit(10)
@@ -14,6 +14,7 @@ import numpy as np
 import remdefaults
 import remfits
 import col_from_file
+import combine_frames
 
 # Shut up warning messages
 
@@ -24,12 +25,15 @@ warnings.simplefilter('ignore', UserWarning)
 parsearg = argparse.ArgumentParser(description='Create master bias file ', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parsearg.add_argument('iforbinds', nargs='*', type=str, help='Filenames or iforbinds to process, otherwise use stdin')
 parsearg.add_argument('--colnum', type=int, default=0, help='Column to use from stdin')
-remdefaults.parseargs(parsearg, libdir=False, tempdir=False)
+remdefaults.parseargs(parsearg, libdir=False)
 parsearg.add_argument('--outfile', type=str, required=True, help='Output FITS file')
 parsearg.add_argument('--filter', type=str, help='Specify filter otherwise deduced from files')
 parsearg.add_argument('--stoperr', action='store_true', help='Stop processing if any files rejected')
 parsearg.add_argument('--force', action='store_true', help='Force overwrite of existing file')
 parsearg.add_argument('--usemean', action='store_true', help='Use mean of values rather than median')
+combine_frames.parseargs(parsearg, methods=('median', 'mean', 'sigclip', 'minmax'))
+parsearg.add_argument('--memlimit', type=float, default=combine_frames.DEFAULT_MEMLIMIT, help='Memory in MB to use for each band of rows combined')
+parsearg.add_argument('--verbose', action='store_true', help='Report peak memory and throughput')
 parsearg.add_argument('--baseid', type=int, help='ID to use for constructing FITS file if possible')
 
 resargs = vars(parsearg.parse_args())
@@ -40,6 +44,12 @@ filter_name = resargs['filter']
 stoperr = resargs['stoperr']
 force = resargs['force']
 usemean = resargs['usemean']
+cparams = combine_frames.getargs(resargs)
+memlimit = resargs['memlimit']
+verbose = resargs['verbose']
+tmpdir = remdefaults.get_tmpdir()
+if usemean:
+    cparams.method = 'mean'
 baseid = resargs['baseid']
 
 if os.path.exists(outfile) and not force:
@@ -65,12 +75,14 @@ if baseid is None or baseid not in sfiles:
 
 files = sorted(list(sfiles))
 
-# Save all the remfits structs in ffiles
+# Save all the remfits structs in ffiles, but move the data into a disk-backed
+# stack as we go so that we only have one frame in memory at once
 
 ffiles = []
 dims = None
 basef = None
 errors = 0
+stack = None
 
 for file in files:
     try:
@@ -91,16 +103,25 @@ for file in files:
         continue
     if dims is None:
         dims = rf.dimscr()
+        try:
+            stack = combine_frames.FrameStack(len(files), rf.data.shape, tmpdir=tmpdir)
+        except combine_frames.CombineErr as e:
+            print(e.args[0], file=sys.stderr)
+            sys.exit(52)
     elif dims != rf.dimscr():
         print("Dimensions of", file, "filter", rf.filter, "are", rf.dimscr(), "whereas previous are", dims, file=sys.stderr)
         errors += 1
         continue
     if file == baseid:
         basef = rf
+    stack.add(rf.data)
+    rf.data = None
     ffiles.append(rf)
 
 if (errors > 0  and  stoperr) or len(ffiles) == 0:
     print("Stopping due to", errors, "-", len(ffiles), "files loaded", file=sys.stderr)
+    if stack is not None:
+        stack.close()
     sys.exit(100)
 
 # If we lost the indication, then just reset to first one
@@ -111,19 +132,21 @@ if basef is None:
 
 first_header = basef.hdr
 
-arrblock = []
 temps = []
 dates = []
 for ff in ffiles:
-    arrblock.append(ff.data)
     temps.append(ff.ccdtemp)
     dates.append(ff.date)
-arrblock = np.array(arrblock)
 
-if usemean:
-    result = arrblock.mean(axis=0)
-else:
-    result = np.median(arrblock, axis=0)
+with stack:
+    try:
+        result, cstats = combine_frames.combine(stack, cparams, memlimit=memlimit)
+    except combine_frames.CombineErr as e:
+        print("Could not combine files error was", e.args[0], file=sys.stderr)
+        sys.exit(101)
+if verbose:
+    print(outfile, cstats.report(), file=sys.stderr)
+
 data_min = result.min()
 data_max = result.max()
 min_date = Time(min(dates))
@@ -143,6 +166,7 @@ first_header.set('FILTER', filter_name, " filter corresponding to " + quadrant +
 first_header.set('FILENAME', "Combined bias for " + quadrant, ' filename of the image')
 first_header.set('CCDTEMP', np.median(temps), ' [C] median value of CCD Temp of used images')
 
+first_header['HISTORY'] = "Combined using " + cparams.describe()
 first_header['HISTORY'] = datetime.datetime.now().strftime("Created on %a %b %d %H:%M:%S %Y")
 
 hdu = fits.PrimaryHDU(result, first_header)
@@ -0,0 +1,314 @@
+#!  /usr/bin/env python3
+
+"""Create master bias and flat files for each filter over a date range in parallel"""
+
+import datetime
+import argparse
+import warnings
+import sys
+import math
+import os.path
+from multiprocessing import Pool
+from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
+from astropy.io import fits
+from astropy.time import Time
+import numpy as np
+import remdefaults
+import remfits
+import parsetime
+import combine_frames
+
+
+def set_common_header(hdr, descr, dates, nimages, result, filter_name):
+    """Set up header fields common to master bias and flat files"""
+    min_date = Time(min(dates))
+    max_date = Time(max(dates))
+    hdr.set('DATE_MIN', str(min_date.isot), ' (UTC) start date of used ' + descr + ' frames')
+    hdr.set('DATE_MAX', str(max_date.isot), ' (UTC) end date of used ' + descr + ' frames')
+    hdr.set('MJD_MIN', min_date.mjd, ' [day] start MJD of used ' + descr + ' frames')
+    hdr.set('MJD_MAX', max_date.mjd, ' [day] end MJD of used ' + descr + ' frames')
+    hdr.set('N_IMAGES', nimages, '  number of images used')
+    hdr['DATAMIN'] = result.min()
+    hdr['DATAMAX'] = result.max()
+    quadrant = remfits.revfn[filter_name]
+    hdr.set('FILTER', filter_name, " filter corresponding to " + quadrant + " quadrant")
+    return quadrant
+
+
+def write_master(fname, result, hdr, padvalue):
+    """Pad result out to full size and write it with given header, return error message or None"""
+    rrows, rcols = result.shape
+    result = np.pad(result, ((0, 1024 - rrows), (0, 1024 - rcols)), 'constant', constant_values=padvalue)
+    hdr['HISTORY'] = datetime.datetime.now().strftime("Created on %a %b %d %H:%M:%S %Y")
+    for todel in ('BZERO', 'BSCALE', 'BUNIT', 'BLANK'):
+        try:
+            del hdr[todel]
+        except KeyError:
+            pass
+    hdu = fits.PrimaryHDU(result, hdr)
+    try:
+        hdu.writeto(fname, overwrite=force, checksum=True)
+    except OSError:
+        return "Could not write " + fname
+    return None
+
+
+def load_frames(dbcurs, inds, ftcode, ftype, filter_name, messages, dims=None):
+    """Load daily bias or flat files from list of iforbinds one at a time, checking that the type,
+    filter and dimensions match, the dimensions being those of the first file if not given.
+
+    Yield remfits structures loaded, so the caller can drop each one's data before the next is loaded"""
+    for ind in inds:
+        try:
+            rf = remfits.parse_filearg(str(ind), dbcurs, ftcode)
+        except remfits.RemFitsErr as e:
+            messages.append("Loading from {:d} gave error {:s}".format(ind, e.args[0]))
+            continue
+        if rf.ftype != ftype:
+            messages.append("File type of {:d} is {:s} not {:s}".format(ind, rf.ftype, ftype))
+            continue
+        if rf.filter != filter_name:
+            messages.append("Filter of {:d} is {:s} not {:s}".format(ind, rf.filter, filter_name))
+            continue
+        if dims is None:
+            dims = rf.dimscr()
+        elif dims != rf.dimscr():
+            messages.append("Dimensions of {:d} are {:s} whereas expected {:s}".format(ind, str(rf.dimscr()), str(dims)))
+            continue
+        yield rf
+
+
+def build_bias(dbcurs, filter_name, inds, messages):
+    """Build master bias for given filter.
+
+    Return the remfits structure of the first bias file with the data replaced by the combined
+    result so that the flat stage can use it without reading it back, or None if failed"""
+
+    basef = None
+    stack = None
+    temps = []
+    dates = []
+    try:
+        for ff in load_frames(dbcurs, inds, 'B', "Daily bias", filter_name, messages):
+            if stack is None:
+                basef = ff
+                stack = combine_frames.FrameStack(len(inds), ff.data.shape, tmpdir=tmpdir)
+            stack.add(ff.data)
+            ff.data = None
+            temps.append(ff.ccdtemp)
+            dates.append(ff.date)
+        if stack is None:
+            messages.append("No bias files loaded for filter " + filter_name)
+            return None
+        result, cstats = combine_frames.combine(stack, cparams, memlimit=memlimit)
+    finally:
+        if stack is not None:
+            stack.close()
+    if verbose:
+        messages.append("Bias filter " + filter_name + ": " + cstats.report())
+
+    hdr = basef.hdr
+    quadrant = set_common_header(hdr, "bias", dates, len(dates), result, filter_name)
+    hdr.set('FILENAME', "Combined bias for " + quadrant, ' filename of the image')
+    hdr.set('CCDTEMP', np.median(temps), ' [C] median value of CCD Temp of used images')
+    hdr['HISTORY'] = "Combined using " + cparams.describe()
+    err = write_master(biasfiles[filter_name], result, hdr.copy(), 0)
+    if err is not None:
+        messages.append(err)
+        return None
+    basef.data = result
+    return basef
+
+
+def build_flat(dbcurs, filter_name, inds, biasstr, messages):
+    """Build master flat for given filter using bias structure from the bias stage"""
+
+    biasdata = biasstr.data
+    badpixmask = None
+    if badpixfull is not None:
+        badpixmask = badpixfull[biasstr.starty:biasstr.starty + biasstr.nrows, biasstr.startx:biasstr.startx + biasstr.ncolumns]
+
+    basef = None
+    dates = []
+    intfiles = []
+    gm = combine_frames.GeomMeanAccumulator(biasdata.shape, exclude=badpixmask)
+    for ff in load_frames(dbcurs, inds, 'F', "Daily flat", filter_name, messages, biasstr.dimscr()):
+        if basef is None:
+            basef = ff
+        gm.add(ff.data, biasdata)
+        ff.data = None
+        dates.append(ff.date)
+        try:
+            intfiles.append(ff.hdr['FILENAME'])
+        except KeyError:
+            pass
+    if basef is None:
+        messages.append("No flat files loaded for filter " + filter_name)
+        return False
+
+    if gm.nexcluded > 0:
+        messages.append("{:d} zero or negative values excluded from flat for filter {:s}".format(gm.nexcluded, filter_name))
+
+    result = gm.result()
+    if badpixmask is not None:
+        result[badpixmask] = math.nan
+    if np.all(np.isnan(result)):
+        messages.append("No positive values in flat result for filter " + filter_name)
+        return False
+
+    result /= np.nanmean(result)
+    result[np.isnan(result)] = 1.0
+
+    hdr = basef.hdr
+    quadrant = set_common_header(hdr, "flat", dates, len(dates), result, filter_name)
+    hdr.set('FILENAME', "Generated flat for " + quadrant, ' filename of the image')
+    if len(intfiles) != 0:
+        hdr['COMMENT'] = 'The following keywords refer to files used to build the image'
+        for n in range(0, len(intfiles), 4):
+            hdr['HISTORY'] = ",".join(intfiles[n:n + 4])
+    err = write_master(flatfiles[filter_name], result, hdr, math.nan)
+    if err is not None:
+        messages.append(err)
+        return False
+    return True
+
+
+def build_filter(filter_name):
+    """Build bias and then flat for a filter, run as a separate process.
+
+    Return tuple of filter, bias ok, flat ok, messages"""
+
+    messages = []
+    dbase, dbcurs = remdefaults.opendb()
+    biasstr = None
+    flatok = False
+    try:
+        starttime = datetime.datetime.now()
+        biasstr = build_bias(dbcurs, filter_name, biasinds[filter_name], messages)
+        if biasstr is not None and not biasonly:
+            flatok = build_flat(dbcurs, filter_name, flatinds[filter_name], biasstr, messages)
+        if verbose:
+            messages.append("Filter {:s} took {:.2f} seconds".format(filter_name, (datetime.datetime.now() - starttime).total_seconds()))
+    except combine_frames.CombineErr as e:
+        messages.append(e.args[0])
+    finally:
+        dbase.close()
+    return filter_name, biasstr is not None, flatok, messages
+
+
+# Shut up warning messages
+
+warnings.simplefilter('ignore', AstropyWarning)
+warnings.simplefilter('ignore', AstropyUserWarning)
+warnings.simplefilter('ignore', UserWarning)
+
+parsearg = argparse.ArgumentParser(description='Create master bias and flat files for each filter in parallel', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+remdefaults.parseargs(parsearg)
+parsetime.parseargs_daterange(parsearg)
+parsearg.add_argument('--filter', type=str, nargs='*', default=['g', 'r', 'i', 'z'], help='Filters to build masters for')
+parsearg.add_argument('--outprefix', type=str, default='Master', help='Prefix for output files, followed by _bias_filter.fits or _flat_filter.fits')
+parsearg.add_argument('--badpix', type=str, help='Bad pixel mask file to use for flats')
+parsearg.add_argument('--gain', type=float, help='Restrict to given gain value')
+parsearg.add_argument('--biasonly', action='store_true', help='Only build master bias files')
+parsearg.add_argument('--force', action='store_true', help='Force overwrite of existing files')
+combine_frames.parseargs(parsearg, methods=('median', 'mean', 'sigclip', 'minmax'))
+parsearg.add_argument('--memlimit', type=float, default=combine_frames.DEFAULT_MEMLIMIT, help='Memory in MB to use for each band of rows combined in each process')
+parsearg.add_argument('--maxproc', type=int, default=4, help='Maximum number of processes to run')
+parsearg.add_argument('--verbose', action='store_true', help='Report progress and timings')
+
+resargs = vars(parsearg.parse_args())
+remdefaults.getargs(resargs)
+filters = resargs['filter']
+outprefix = resargs['outprefix']
+badpix = resargs['badpix']
+gain = resargs['gain']
+biasonly = resargs['biasonly']
+force = resargs['force']
+memlimit = resargs['memlimit']
+maxproc = resargs['maxproc']
+verbose = resargs['verbose']
+tmpdir = remdefaults.get_tmpdir()
+cparams = combine_frames.getargs(resargs)
+
+fieldselect = ["rejreason IS NULL", "ind!=0", "(typ='bias' OR typ='flat')"]
+try:
+    parsetime.getargs_daterange(resargs, fieldselect)
+except ValueError as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(20)
+
+biasfiles = dict()
+flatfiles = dict()
+errors = 0
+for filter_name in filters:
+    if filter_name not in remfits.revfn:
+        print("Unknown filter", filter_name, file=sys.stderr)
+        errors += 1
+        continue
+    biasfiles[filter_name] = outprefix + "_bias_" + filter_name + ".fits"
+    flatfiles[filter_name] = outprefix + "_flat_" + filter_name + ".fits"
+    for fname in (biasfiles[filter_name], flatfiles[filter_name]):
+        if fname == flatfiles[filter_name] and biasonly:
+            continue
+        if os.path.exists(fname) and not force:
+            print("Will not overwrite existing", fname, "use --force if needed", file=sys.stderr)
+            errors += 1
+if errors > 0:
+    sys.exit(50)
+
+badpixfull = None
+if badpix is not None:
+    try:
+        badpixfull = remdefaults.load_bad_pixmask(badpix)
+    except remdefaults.RemDefError as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(13)
+
+mydb, mycurs = remdefaults.opendb()
+
+fieldselect.append("(" + " OR ".join(["filter=" + mydb.escape(f) for f in filters]) + ")")
+if gain is not None:
+    fieldselect.append("ABS(gain-%.3g) < %.3g" % (gain, gain * 1e-3))
+
+mycurs.execute("SELECT iforbind,filter,typ FROM iforbinf WHERE " + " AND ".join(fieldselect) + " ORDER BY date_obs")
+dbrows = mycurs.fetchall()
+mydb.close()
+
+biasinds = {f: [] for f in filters}
+flatinds = {f: [] for f in filters}
+for iforbind, filter_name, typ in dbrows:
+    if typ == 'bias':
+        biasinds[filter_name].append(iforbind)
+    else:
+        flatinds[filter_name].append(iforbind)
+
+tasks = []
+for filter_name in filters:
+    if len(biasinds[filter_name]) == 0:
+        print("No bias files found for filter", filter_name, file=sys.stderr)
+        errors += 1
+    else:
+        tasks.append(filter_name)
+    if verbose:
+        print("Filter", filter_name, len(biasinds[filter_name]), "bias files", len(flatinds[filter_name]), "flat files", file=sys.stderr)
+
+if len(tasks) == 0:
+    print("Nothing to do", file=sys.stderr)
+    sys.exit(100)
+
+starttime = datetime.datetime.now()
+with Pool(min(len(tasks), maxproc)) as p:
+    for filter_name, biasok, flatok, messages in p.imap_unordered(build_filter, tasks):
+        for m in messages:
+            print(m, file=sys.stderr)
+        if not biasok:
+            print("Failed to create bias for filter", filter_name, file=sys.stderr)
+            errors += 1
+        elif not flatok and not biasonly:
+            print("Failed to create flat for filter", filter_name, file=sys.stderr)
+            errors += 1
+
+if verbose:
+    print("Completed in {:.2f} seconds".format((datetime.datetime.now() - starttime).total_seconds()), file=sys.stderr)
+if errors > 0:
+    sys.exit(200)
@@ -8,7 +8,6 @@ import warnings
 import sys
 import math
 import os.path
-from scipy.stats import gmean
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 from astropy.io import fits
 from astropy.time import Time
@@ -16,6 +15,7 @@ import numpy as np
 import remdefaults
 import remfits
 import col_from_file
+import combine_frames
 
 # Shut up warning messages
 
@@ -27,7 +27,7 @@ warnings.simplefilter('error', RuntimeWarning)
 parsearg = argparse.ArgumentParser(description='Duplicate creation of master flat file ', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parsearg.add_argument('iforbinds', nargs='*', type=str, help='Filenames or ids to process, otherwise use stdin')
 parsearg.add_argument('--colnum', type=int, default=0, help='Column to use from stdin')
-remdefaults.parseargs(parsearg, tempdir=False)
+remdefaults.parseargs(parsearg)
 parsearg.add_argument('--biasfile', type=str, required=True, help='Bias file to use')
 parsearg.add_argument('--outfile', type=str, required=True, help='Output FITS file')
 parsearg.add_argument('--badpix', type=str, help='Bad pixel mask file to use')
@@ -35,6 +35,8 @@ parsearg.add_argument('--filter', type=str, help='Specify filter otherwise deduc
 parsearg.add_argument('--stoperr', action='store_true', help='Stop processing if any files rejected')
 parsearg.add_argument('--force', action='store_true', help='Force overwrite of existing file or things queried')
 parsearg.add_argument('--baseid', type=int, help='ID to use for constructing FITS file if possible')
+combine_frames.parseargs(parsearg, default='gmean')
+parsearg.add_argument('--memlimit', type=float, default=combine_frames.DEFAULT_MEMLIMIT, help='Memory in MB to use for each band of rows combined')
 
 resargs = vars(parsearg.parse_args())
 files = resargs['iforbinds']
@@ -46,6 +48,9 @@ filter_name = resargs['filter']
 stoperr = resargs['stoperr']
 force = resargs['force']
 baseid = resargs['baseid']
+cparams = combine_frames.getargs(resargs)
+memlimit = resargs['memlimit']
+tmpdir = remdefaults.get_tmpdir()
 
 if os.path.exists(outfile) and not force:
     print("Will not overwrite existing", outfile, "use --force if needed", file=sys.stderr)
@@ -139,33 +144,49 @@ if basef is None:
     print("Selected baseid lost, using first available", file=sys.stderr)
     basef = ffiles[0]
 
-arrblock = []
+# Work in log space leaving out zero or negative values after bias subtraction
+# and bad pixels. For the plain geometric mean we can accumulate one frame at a time,
+# otherwise stack up the logs and combine them with rejection.
+
 temps = []
 dates = []
-prebadpm = []
-postbadpm = []
 for ff in ffiles:
-    dat = ff.data - biasdata
-    prebadpm.append(np.count_nonzero(dat <= 0.0))
-    postbadpm.append(np.count_nonzero(dat <= 0.0))
-    arrblock.append(dat)
     temps.append(ff.ccdtemp)
     dates.append(ff.date)
 
-arrblock = np.array(arrblock)
-arrblock -= biasdata
-
 try:
-    if badpixmask is not None:
-        arrblock[:, badpixmask] = 1.0
-    result = gmean(arrblock, axis=0)
-except RuntimeWarning:
-    print("Zeror or negative values in result - aborting", file=sys.stderr)
-    sys.exit(200)
+    if cparams.method == 'gmean':
+        gm = combine_frames.GeomMeanAccumulator(biasdata.shape, exclude=badpixmask)
+        for ff in ffiles:
+            gm.add(ff.data, biasdata)
+            ff.data = None
+        nexcluded = gm.nexcluded
+        result = gm.result()
+    else:
+        nexcluded = 0
+        with combine_frames.FrameStack(len(ffiles), biasdata.shape, tmpdir=tmpdir) as stack:
+            for ff in ffiles:
+                logdata, nneg = combine_frames.log_frame(ff.data, biasdata, badpixmask)
+                ff.data = None
+                stack.add(logdata)
+                nexcluded += nneg
+            result, cstats = combine_frames.combine(stack, cparams, memlimit=memlimit)
+        result = np.exp(result)
+except combine_frames.CombineErr as e:
+    print("Could not combine files error was", e.args[0], file=sys.stderr)
+    sys.exit(101)
+
+if nexcluded > 0:
+    print(nexcluded, "zero or negative values excluded from result", file=sys.stderr)
 
-result /= result.mean()
 if badpixmask is not None:
-    result[badpixmask] = 1.0
+    result[badpixmask] = math.nan
+if np.all(np.isnan(result)):
+    print("No positive values in result - aborting", file=sys.stderr)
+    sys.exit(200)
+
+result /= np.nanmean(result)
+result[np.isnan(result)] = 1.0
 data_min = result.min()
 data_max = result.max()
 min_date = Time(min(dates))
@@ -196,6 +217,7 @@ if len(intfiles) != 0:
     for n in histb:
         first_header['HISTORY'] = ",".join(n)
 
+first_header['HISTORY'] = "Combined using " + cparams.describe()
 first_header['HISTORY'] = datetime.datetime.now().strftime("Created on %a %b %d %H:%M:%S %Y")
 
 for todel in ('BZERO', 'BSCALE', 'BUNIT', 'BLANK'):
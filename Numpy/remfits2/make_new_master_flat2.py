@@ -10,6 +10,7 @@ import numpy as np
 import remdefaults
 import col_from_file
 import stdarray
+import combine_frames
 
 # Shut up warning messages
 
@@ -21,6 +22,7 @@ parsearg.add_argument('--outfile', type=str, default="Flat", help='Output file p
 #parsearg.add_argument('--badpix', type=str, help='Bad pixel mask file to use')
 parsearg.add_argument('--force', action='store_true', help='Force overwrite if file(s) exist')
 parsearg.add_argument('--stoperr', action='store_true', help='Stop processing if any files rejected')
+combine_frames.parseargs(parsearg, default='mean', methods=('mean', 'sigclip', 'minmax'))
 
 resargs = vars(parsearg.parse_args())
 files = resargs['files']
@@ -29,6 +31,7 @@ outfile = resargs['outfile']
 #badpix = resargs['badpix']
 stoperr = resargs['stoperr']
 force = resargs['force']
+cparams = combine_frames.getargs(resargs)
 
 if len(files) == 0:
     files = col_from_file.col_from_file(sys.stdin, resargs['colnum'])
@@ -63,7 +66,6 @@ datalist = np.array(datalist)
 stdlist = np.array(stdlist)
 
 weights = datalist.mean(axis=(1,2))
-sumweights = np.sum(weights)
 numweights = len(weights)
 vecweights = weights.reshape((numweights, 1, 1))
 
@@ -74,10 +76,17 @@ stdlist /= vecweights
 
 # Compute weighted geometric means as exp(SIGMA(wi * log xi) / W) where W is sigma(wi)
 # Compute variance as g**2 * SIGMA(wi**2/W**2 * sigmai**2 / xi**2)
+# Sums are over the values kept after any rejection, so W varies by pixel.
 
 logdata = np.log(datalist)
-gmeans = np.exp(np.sum(logdata * vecweights, axis=0) / sumweights)
-gstdsq = gmeans**2 * np.sum((((stdlist * vecweights) / datalist) / sumweights) ** 2, axis=0)
+try:
+    keep = combine_frames.reject_mask(logdata, cparams, weights)
+except combine_frames.CombineErr as e:
+    print("Could not combine files error was", e.args[0], file=sys.stderr)
+    sys.exit(101)
+gmeans = np.exp(combine_frames.masked_mean(logdata, keep, weights))
+sumweights = np.sum(keep * vecweights, axis=0)
+gstdsq = gmeans**2 * np.sum(np.where(keep, (stdlist * vecweights) / datalist, 0.0) ** 2, axis=0) / sumweights ** 2
 normv = gmeans.mean()
 gmeans *= normv
 gstdsq *= normv
@@ -0,0 +1,49 @@
+#!  /usr/bin/env python3
+
+"""Set up or refresh sky cell index column in objdata"""
+
+import argparse
+import sys
+import pymysql
+import remdefaults
+import skyregion
+
+parsearg = argparse.ArgumentParser(description='Set sky cell numbers of objects for region searches', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+remdefaults.parseargs(parsearg, tempdir=False, inlib=False)
+parsearg.add_argument('--create', action='store_true', help='Add skycell column and index to objdata first')
+parsearg.add_argument('--all', action='store_true', help='Redo all objects not just ones without cell set')
+parsearg.add_argument('--verbose', action='store_true', help='Report number of objects done')
+
+resargs = vars(parsearg.parse_args())
+remdefaults.getargs(resargs)
+create = resargs['create']
+doall = resargs['all']
+verbose = resargs['verbose']
+
+mydb, dbcurs = remdefaults.opendb()
+
+if create:
+    try:
+        dbcurs.execute(skyregion.SKYCELL_COLUMN)
+        dbcurs.execute(skyregion.SKYCELL_INDEX)
+    except pymysql.MySQLError as e:
+        print("Could not create skycell column, error was", e.args[1], file=sys.stderr)
+        sys.exit(10)
+
+if doall:
+    dbcurs.execute("SELECT ind,radeg,decdeg FROM objdata")
+else:
+    dbcurs.execute("SELECT ind,radeg,decdeg FROM objdata WHERE skycell IS NULL")
+
+dbrows = dbcurs.fetchall()
+if len(dbrows) == 0:
+    if verbose:
+        print("No objects to do", file=sys.stderr)
+    sys.exit(0)
+
+inds = [r[0] for r in dbrows]
+cells = skyregion.cell_index([r[1] for r in dbrows], [r[2] for r in dbrows])
+nupd = dbcurs.executemany(skyregion.SKYCELL_UPDATE, [(int(c), ind) for c, ind in zip(cells, inds)])
+mydb.commit()
+if verbose:
+    print(nupd, "objects updated out of", len(inds), file=sys.stderr)
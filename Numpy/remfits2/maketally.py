@@ -6,10 +6,10 @@ import argparse
 import sys
 import warnings
 import os.path
-import numpy as np
 import remdefaults
 import col_from_file
 import remfits
+import tallyfile
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 
 # Shut up warning messages
@@ -28,6 +28,9 @@ parsearg.add_argument('--create', action='store_true', help='Expecting to create
 parsearg.add_argument('--clear', action='store_true', help='Clear contents of existing file')
 parsearg.add_argument('--prefix', required=True, type=str, help='Result file prefix')
 parsearg.add_argument('--trim', type=int, default=0, help='Amount to trim each edge of image')
+parsearg.add_argument('--checkpoint', type=int, default=20, help='Number of files to add between saving updates and journal')
+parsearg.add_argument('--convert', action='store_true', help='Convert old-format tally file to current format first')
+parsearg.add_argument('--verbose', action='store_true', help='Report numbers of files added and skipped')
 
 resargs = vars(parsearg.parse_args())
 remdefaults.getargs(resargs)
@@ -37,6 +40,9 @@ prefix = resargs['prefix']
 ftype = resargs['type']
 clear = resargs['clear']
 trim = resargs['trim']
+checkpoint = resargs['checkpoint']
+verbose = resargs['verbose']
+convert = resargs['convert']
 
 gtype = None
 if ftype == 'flat':
@@ -44,56 +50,84 @@ if ftype == 'flat':
 elif ftype == 'bias':
     gtype = 'B'
 
-if len(files) == 0:
-    files = col_from_file.col_from_file(sys.stdin, resargs['colnum'])
-
 tallyfn = remdefaults.tally_file(prefix)
-tally = None
-
-if create:
-    if clear or not os.path.exists(tallyfn):
-        tally = np.concatenate((np.zeros((3, 2048, 2048), dtype=np.float64),
-                                np.full((1, 2048, 2048), 1e60, dtype=np.float64),
-                                np.full((1, 2048, 2048), -1e60, dtype=np.float64)), axis=0)
-if tally is None:
-    if not os.path.exists(tallyfn):
-        print(tallyfn, "does not exist, use --create if needed (or specify libdir)", file=sys.stderr)
-        sys.exit(11)
+
+if convert:
     try:
-        tally = np.load(tallyfn)
-    except OSError as e:
-        print("Cannot open", e.filename, "error was", e.args[1], file=sys.stderr)
-        sys.exit(12)
+        nkept = tallyfile.convert_tally(tallyfn)
+    except tallyfile.TallyErr as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(14)
+    if verbose:
+        print("Converted", tallyfn, "keeping", nkept, "journal entries", file=sys.stderr)
+    if len(files) == 0:
+        sys.exit(0)
+
+if len(files) == 0:
+    files = col_from_file.col_from_file(sys.stdin, resargs['colnum'])
 
-if tally.shape != (5, 2048, 2048):
-    print("Unexpected tally shape in", tallyfn, "Expected (5,2048,2048) found", tally.shape, file=sys.stderr)
-    sys.exit(13)
+try:
+    if create and (clear or not os.path.exists(tallyfn)):
+        tally = tallyfile.Tally(tallyfn, create=True)
+    else:
+        if not os.path.exists(tallyfn):
+            print(tallyfn, "does not exist, use --create if needed (or specify libdir)", file=sys.stderr)
+            sys.exit(11)
+        tally = tallyfile.Tally(tallyfn)
+except tallyfile.TallyErr as e:
+    print(e.args[0], file=sys.stderr)
+    sys.exit(12)
 
 dbase, dbcurs = remdefaults.opendb()
 
-for file in files:
-    try:
-        ff = remfits.parse_filearg(file, dbcurs, gtype)
-    except remfits.RemFitsErr as e:
-        print("Could not fetch file", file, "error was", e.args[0], file=sys.stderr)
-        continue
-
-    fdat = ff.data
-    if trim != 0:
-        fdat = fdat[trim:-trim, trim:-trim]
-    startx = ff.startx + trim
-    starty = ff.starty + trim
-    endr = ff.endy - trim
-    endc = ff.endx - trim
-
-    try:
-        tally[0, starty:endr, startx:endc] += 1.0
-        tally[1, starty:endr, startx:endc] += fdat
-        tally[2, starty:endr, startx:endc] += fdat ** 2
-        tally[3, starty:endr, startx:endc] = np.minimum(tally[3, starty:endr, startx:endc], fdat)
-        tally[4, starty:endr, startx:endc] = np.maximum(tally[4, starty:endr, startx:endc], fdat)
-    except ValueError:
-        print("Wrong size file = ", file, "r/c/sx/sy", endr - starty, endc - startx, startx, starty, file=sys.stderr)
-
-with open(tallyfn, "wb") as outf:
-    np.save(outf, tally)
+# Journal keys are fitsinds for iforbinds (or obsinds) and full paths for file names
+
+nums = [int(file) for file in files if file.isdigit()]
+fitsinds = dict()
+if len(nums) != 0:
+    table, column = 'obsinf', 'obsind'
+    if gtype is not None:
+        table, column = 'iforbinf', 'iforbind'
+    dbcurs.execute("SELECT " + column + ",ind FROM " + table + " WHERE " + column + " IN (" + ",".join(["%s"] * len(nums)) + ")", nums)
+    fitsinds = {ind: fitsind for ind, fitsind in dbcurs.fetchall() if fitsind != 0}
+
+nadded = nskipped = 0
+
+with tally:
+    for file in files:
+        if file.isdigit():
+            key = fitsinds.get(int(file))
+            if key is None:
+                print("No FITS file loaded for", file, file=sys.stderr)
+                continue
+        else:
+            key = os.path.abspath(file)
+        if tally.already_done(key):
+            nskipped += 1
+            continue
+        try:
+            ff = remfits.parse_filearg(file, dbcurs, gtype)
+        except remfits.RemFitsErr as e:
+            print("Could not fetch file", file, "error was", e.args[0], file=sys.stderr)
+            continue
+
+        fdat = ff.data
+        if trim != 0:
+            fdat = fdat[trim:-trim, trim:-trim]
+
+        try:
+            tally.add(key, fdat, ff.startx + trim, ff.starty + trim)
+        except tallyfile.TallyErr as e:
+            print("Wrong size file = ", file, e.args[0], file=sys.stderr)
+            continue
+
+        nadded += 1
+        if nadded % checkpoint == 0:
+            try:
+                tally.checkpoint()
+            except tallyfile.TallyErr as e:
+                print(e.args[0], file=sys.stderr)
+                sys.exit(13)
+
+if verbose:
+    print(nadded, "files added", nskipped, "done previously", file=sys.stderr)
@@ -10,8 +10,128 @@ import obj_locations
 import find_results
 import match_finds
 import remfits
+import kdmatch
+import apphot
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 
+
+class MatchErr(Exception):
+    """Throw if we cannot match one prefix, with exit code"""
+
+    def __init__(self, code, mess):
+        super().__init__(mess)
+        self.code = code
+
+
+def match_prefix(prefix, imagefile, findresfile, locfile):
+    """Match locations and find results for one prefix"""
+
+    if imagefile is None:
+        imagefile = prefix
+    if findresfile is None:
+        findresfile = prefix
+    if locfile is None:
+        locfile = prefix
+
+    try:
+        inputfile = remfits.parse_filearg(imagefile, None)
+    except remfits.RemFitsErr as e:
+        raise MatchErr(52, e.args[0])
+
+    locations = obj_locations.load_objlist_from_file(locfile, inputfile)
+    findres = find_results.load_results_from_file(findresfile, inputfile)
+
+    if matcher == 'match_finds':
+        try:
+            matchlist = match_finds.allocate_locs(locations, findres, threshold)
+        except match_finds.FindError as e:
+            raise MatchErr(200, "Match of " + findresfile + " gave error " + e.args[0])
+    else:
+        scale = kdmatch.pixel_scale(inputfile.wcs, inputfile.ncolumns, inputfile.nrows)
+        matchlist = kdmatch.allocate_locs(locations, findres, threshold, scale, matcher)
+
+    locr = locations.resultlist
+    findr = findres.resultlist
+
+    hadt = 0
+
+    for row, col, dist in matchlist:
+        f = findr[col]
+        l = locr[row]
+        f.obj = l
+        f.istarget = l.istarget
+        if f.istarget:
+            hadt += 1
+        if l.objinfo.apsize not in (0, f.apsize):
+            f.needs_correction = True
+            f.apsize = l.objinfo.apsize
+
+    if hadt == 0:
+        raise MatchErr(240, "Did not find a target")
+
+    if idonly or usonly:
+        noid = nouse = 0
+        newf = []
+        for fr in findr:
+            if idonly:
+                if  fr.obj is None:
+                    noid += 1
+                elif not fr.obj.usable:
+                    nouse += 1
+                else:
+                    newf.append(fr)
+            else:
+                newf.append(fr)
+        if nouse + noid > 0:
+            findres.resultlist = newf
+            findres.rekey()
+            if verbose:
+                if nouse > 0:
+                    print(nouse, "not usable eliminated", file=sys.stderr)
+                if noid > 0:
+                    print(noid, "not identified eliminated", file=sys.stderr)
+
+    # Recentre the ones needing it with the library search or, if asked for, all the ones with
+    # each aperture size at once using the integral image
+
+    if integral:
+        integ = apphot.integral_image(inputfile)
+        correct = dict()
+        for f in findres.results():
+            if f.needs_correction:
+                correct.setdefault(f.apsize, []).append(f)
+        for apsize, flist in correct.items():
+            cols, rows, sums, npix = apphot.findbest_many(integ, [f.col for f in flist], [f.row for f in flist], apsize, maxshift)
+            for f, col, row, adus in zip(flist, cols, rows, sums):
+                f.col = int(col)
+                f.row = int(row)
+                f.adus = float(adus)
+                f.needs_correction = False
+    else:
+        for f in findres.results():
+            if not f.needs_correction:
+                continue
+            f.col, f.row, f.adus, newpixc = findres.findbest_colrow(f.col, f.row, f.apsize, maxshift)
+            f.needs_correction = False
+
+    findres.reorder()
+    findres.relabel()
+    find_results.save_results_to_file(findres, findresfile, True)
+
+    if findres.num_results() < 2:
+        if findres.num_results(True) == 1:
+            raise MatchErr(241, "No results in file other than target")
+        raise MatchErr(242, "No results in file")
+
+    if verbose:
+        n = nfound = 0
+        for f in findres.results():
+            n += 1
+            if len(f.name) != 0:
+                nfound += 1
+        print(nfound, "found out of", n, file=sys.stderr)
+
+
 # Shut up warning messages
 
 warnings.simplefilter('ignore', AstropyWarning)
@@ -19,7 +139,7 @@ warnings.simplefilter('ignore', AstropyUserWarning)
 warnings.simplefilter('ignore', UserWarning)
 
 parsearg = argparse.ArgumentParser(description='Match locations of objects within image and find object results', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parsearg.add_argument('files', nargs=1, type=str, help='Prefix part of location, find results and image file')
+parsearg.add_argument('files', nargs='+', type=str, help='Prefix part of location, find results and image file, several to do a batch')
 remdefaults.parseargs(parsearg, tempdir=False, inlib=False)
 parsearg.add_argument('--imagefile', type=str, help='Image file in case different from files argument')
 parsearg.add_argument('--findres', type=str, help='Find results file in case different from files argument')
@@ -29,9 +149,11 @@ parsearg.add_argument('--verbose', action='store_true', help='Give statistics')
 parsearg.add_argument('--idonly', action='store_true', help='Just keep things that have been identified')
 parsearg.add_argument('--usonly', action='store_true', help='Just keep things that are usable')
 parsearg.add_argument('--shiftmax', type=int, default=4, help='Maxmimum shift of centre when repositioning')
+parsearg.add_argument('--integral', action='store_true', help='Recentre with integral image all objects with each aperture size at once')
+parsearg.add_argument('--matcher', type=str, default='match_finds', choices=('match_finds',) + kdmatch.MATCH_METHODS, help='Use match_finds or KD-tree with greedy or Hungarian assignment')
 
 resargs = vars(parsearg.parse_args())
-prefix = resargs['files'][0]
+prefixes = resargs['files']
 remdefaults.getargs(resargs)
 threshold = resargs['threshold']
 verbose = resargs['verbose']
@@ -41,92 +163,26 @@ imagefile = resargs['imagefile']
 findresfile = resargs['findres']
 locfile = resargs['objloc']
 maxshift = resargs['shiftmax']
-
-if imagefile is None:
-    imagefile = prefix
-if findresfile is None:
-    findresfile = prefix
-if locfile is None:
-    locfile = prefix
-
-try:
-    inputfile = remfits.parse_filearg(imagefile, None)
-except remfits.RemFitsErr as e:
-    print(e.args[0], file=sys.stderr)
-    sys.exit(52)
-
-locations = obj_locations.load_objlist_from_file(locfile, inputfile)
-findres = find_results.load_results_from_file(findresfile, inputfile)
-
-try:
-    matchlist = match_finds.allocate_locs(locations, findres, threshold)
-except match_finds.FindError as e:
-    print("Match of", findresfile, "gave error", e.args[0], file=sys.stderr)
-    sys.exit(200)
-
-locr = locations.resultlist
-findr = findres.resultlist
-
-hadt = 0
-
-for row, col, dist in matchlist:
-    f = findr[col]
-    l = locr[row]
-    f.obj = l
-    f.istarget = l.istarget
-    if f.istarget:
-        hadt += 1
-    if l.objinfo.apsize not in (0, f.apsize):
-        f.needs_correction = True
-        f.apsize = l.objinfo.apsize
-
-if hadt == 0:
-    print("Did not find a target", file=sys.stderr)
-    sys.exit(240)
-
-if idonly or usonly:
-    noid = nouse = 0
-    newf = []
-    for fr in findr:
-        if idonly:
-            if  fr.obj is None:
-                noid += 1
-            elif not fr.obj.usable:
-                nouse += 1
-            else:
-                newf.append(fr)
-        else:
-            newf.append(fr)
-    if nouse + noid > 0:
-        findres.resultlist = newf
-        findres.rekey()
-        if verbose:
-            if nouse > 0:
-                print(nouse, "not usable eliminated", file=sys.stderr)
-            if noid > 0:
-                print(noid, "not identified eliminated", file=sys.stderr)
-
-for f in findres.results():
-    if not f.needs_correction:
-        continue
-    f.col, f.row, f.adus, newpixc = findres.findbest_colrow(f.col, f.row, f.apsize, maxshift)
-    f.needs_correction = False
-
-findres.reorder()
-findres.relabel()
-find_results.save_results_to_file(findres, findresfile, True)
-
-if findres.num_results() < 2:
-    if findres.num_results(True) == 1:
-        print("No results in file other than target", file=sys.stderr)
-        sys.exit(241)
-    print("No results in file", file=sys.stderr)
-    sys.exit(242)
-
-if verbose:
-    n = nfound = 0
-    for f in findres.results():
-        n += 1
-        if len(f.name) != 0:
-            nfound += 1
-    print(nfound, "found out of", n, file=sys.stderr)
+matcher = resargs['matcher']
+integral = resargs['integral']
+
+if len(prefixes) > 1 and (imagefile is not None or findresfile is not None or locfile is not None):
+    print("Cannot give --imagefile, --findres or --objloc with more than one prefix", file=sys.stderr)
+    sys.exit(50)
+
+errors = 0
+laststatus = 0
+for prefix in prefixes:
+    try:
+        match_prefix(prefix, imagefile, findresfile, locfile)
+    except MatchErr as e:
+        if len(prefixes) == 1:
+            print(e.args[0], file=sys.stderr)
+            sys.exit(e.code)
+        print(prefix + ":", e.args[0], file=sys.stderr)
+        errors += 1
+        laststatus = e.code
+
+if errors > 0:
+    print(errors, "prefixes failed", file=sys.stderr)
+    sys.exit(laststatus)
@@ -0,0 +1,121 @@
+"""Screen many predicted object positions in an image at once.
+
+Rather than looking around each predicted position in turn, the windows around
+all the positions are cut out of the image into one stacked array, and the
+sums in a small disc about every shift within reach of each position are
+found together, to see whether any is significantly above the sky.
+
+This is an approximate screen, not a replacement for FindResults.find_object.
+It only saves running find_object on catalogue objects with nothing near where
+they should be, and objects it passes are still searched for one by one, so it
+can lose faint objects find_object would have found but does not change the
+results for the others. multifind_benchmark.py reports any lost on a real image.
+
+The window helpers here are also used by the whole-image detection in fastdetect."""
+
+import numpy as np
+
+DEFAULT_MAXSHIFT = 4  # If not in the search parameters
+DEFAULT_APSIZE = 2
+DEFAULT_SIGNIF = 5.0
+
+MAD_TO_STD = 1.4826
+
+
+class MultiFindErr(Exception):
+    """Throw if we have problems with the search"""
+
+
+def image_sky(data):
+    """Estimate sky level and noise of image from median and median absolute deviation of finite pixels"""
+    vals = data[np.isfinite(data)]
+    if vals.size == 0:
+        raise MultiFindErr("No valid pixels in image")
+    sky = np.median(vals)
+    return float(sky), float(MAD_TO_STD * np.median(np.abs(vals - sky)))
+
+
+def disc_mask(radius, apsize):
+    """Return mask of pixels within apsize of centre of square of side 2 * radius + 1"""
+    offs = np.arange(-radius, radius + 1)
+    return offs[:, np.newaxis] ** 2 + offs[np.newaxis, :] ** 2 <= apsize ** 2
+
+
+def cut_windows(data, rows, cols, radius):
+    """Cut square windows of side 2 * radius + 1 centred on the given rows and cols into a
+    stack of shape (n, side, side), with NaN for any part outside the image"""
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if np.any(rows < 0) or np.any(cols < 0) or np.any(rows >= data.shape[0]) or np.any(cols >= data.shape[1]):
+        raise MultiFindErr("Position outside image")
+    side = 2 * radius + 1
+    padded = np.pad(data.astype(np.float64), radius, mode='constant', constant_values=np.nan)
+    return np.lib.stride_tricks.sliding_window_view(padded, (side, side))[rows, cols]
+
+
+def window_sums(windows, sky, mask):
+    """Sum sky-subtracted values within mask for each window returning sums and number of valid pixels"""
+    vals = np.where(mask & np.isfinite(windows), windows - sky, 0.0)
+    npix = np.count_nonzero(mask & np.isfinite(windows), axis=(1, 2))
+    return vals.sum(axis=(1, 2)), npix
+
+
+def window_centroids(windows, sky, mask):
+    """Intensity weighted centroids of sky-subtracted values within mask as offsets from window centres,
+    zero where there is nothing above sky"""
+    nwin, side, dummy = windows.shape
+    offs = np.arange(side, dtype=np.float64) - side // 2
+    wts = np.where(mask & np.isfinite(windows), np.maximum(windows - sky, 0.0), 0.0)
+    tot = wts.sum(axis=(1, 2))
+    safe = np.where(tot > 0.0, tot, 1.0)
+    crow = np.dot(wts.sum(axis=2), offs) / safe
+    ccol = np.dot(wts.sum(axis=1), offs) / safe
+    return crow, ccol
+
+
+def shifted_disc_sums(data, rows, cols, maxshift, apsize):
+    """Sum values in discs of radius apsize centred on every shift up to maxshift each way from each of
+    the integer (rows, cols), leaving out NaNs and anything outside the image.
+
+    Return arrays of sums and numbers of pixels of shape (n, 2 * maxshift + 1, 2 * maxshift + 1)"""
+    radius = int(np.ceil(apsize))
+    side = 2 * radius + 1
+    windows = cut_windows(data, rows, cols, maxshift + radius)
+    valid = np.isfinite(windows)
+    mask = disc_mask(radius, apsize).astype(np.float64)
+    vals = np.lib.stride_tricks.sliding_window_view(np.where(valid, windows, 0.0), (side, side), axis=(1, 2))
+    counts = np.lib.stride_tricks.sliding_window_view(valid.astype(np.float64), (side, side), axis=(1, 2))
+    return np.einsum('nijkl,kl->nij', vals, mask), np.einsum('nijkl,kl->nij', counts, mask)
+
+
+def screen(data, rows, cols, sky, skystd, maxshift=DEFAULT_MAXSHIFT, apsize=DEFAULT_APSIZE, signif=DEFAULT_SIGNIF):
+    """Screen positions (rows, cols) for anything signif std devs of the noise expected in a disc of
+    radius apsize above the sky level, in a disc centred within maxshift pixels of the position.
+
+    Return boolean array True for positions with something there"""
+    rows = np.clip(np.rint(np.asarray(rows, dtype=np.float64)).astype(np.int64), 0, data.shape[0] - 1)
+    cols = np.clip(np.rint(np.asarray(cols, dtype=np.float64)).astype(np.int64), 0, data.shape[1] - 1)
+    if rows.size == 0:
+        return np.zeros(0, dtype=bool)
+    if skystd <= 0.0:
+        raise MultiFindErr("Sky noise must be positive")
+    sums, npix = shifted_disc_sums(data, rows, cols, maxshift, apsize)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = (sums - npix * sky) / (skystd * np.sqrt(npix))
+    snr = np.where((npix > 0) & disc_mask(maxshift, maxshift), snr, -np.inf)
+    return snr.reshape(rows.size, -1).max(axis=1) > signif
+
+
+def search_shift(searchpar):
+    """Get maximum shift from predicted position find_object uses from search parameters"""
+    return getattr(searchpar, 'maxshift', DEFAULT_MAXSHIFT)
+
+
+def prescreen(fitsfile, pixlist, maxshift, apsize=DEFAULT_APSIZE, signif=DEFAULT_SIGNIF):
+    """Given list of (col, row) predicted positions in fitsfile, which has had its sky level calculated,
+    return boolean array True where there is something significant within reach worth passing on to find_object"""
+    if len(pixlist) == 0:
+        return np.zeros(0, dtype=bool)
+    pixes = np.asarray(pixlist, dtype=np.float64)
+    return screen(fitsfile.data, pixes[:, 1], pixes[:, 0], fitsfile.meanval, fitsfile.stdval, maxshift, apsize, signif)
+
@@ -0,0 +1,108 @@
+#!  /usr/bin/env python3
+
+"""Compare searching for catalogue objects one at a time with find_object against
+screening them all at once first, on a real image, reporting any objects the
+screened search loses"""
+
+import argparse
+import warnings
+import sys
+import time
+import numpy as np
+from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
+import remdefaults
+import remfits
+import find_results
+import searchparam
+import skyregion
+import multifind
+
+
+def find_objects(findres, fitsfile, pixlist, objlist, searchpar, apsize=multifind.DEFAULT_APSIZE, signif=multifind.DEFAULT_SIGNIF):
+    """Find each object in objlist at corresponding (col, row) in pixlist, screening them all
+    at once and running find_object only on those with something there.
+
+    Return list of new find results with None for objects not found"""
+    results = [None] * len(objlist)
+    for n in np.flatnonzero(multifind.prescreen(fitsfile, pixlist, multifind.search_shift(searchpar), apsize, signif)):
+        pcol, prow = pixlist[n]
+        try:
+            results[n] = findres.find_object(prow, pcol, objlist[n], searchpar)
+        except find_results.FindResultErr:
+            pass
+    return results
+
+
+warnings.simplefilter('ignore', AstropyWarning)
+warnings.simplefilter('ignore', AstropyUserWarning)
+warnings.simplefilter('ignore', UserWarning)
+
+searchpar = searchparam.load()
+parsearg = argparse.ArgumentParser(description='Benchmark screened search for objects against find_object', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parsearg.add_argument('file', nargs=1, type=str, help='Image file')
+searchpar.argparse(parsearg)
+remdefaults.parseargs(parsearg, tempdir=False, inlib=False)
+parsearg.add_argument('--variability', type=float, default=0.0, help='Maximum variability acceptable')
+parsearg.add_argument('--skylevelstd', type=float, default=remfits.DEFAULT_SKYLEVELSTD, help='Theshold level of std devs to include points in sky')
+parsearg.add_argument('--apsize', type=float, default=multifind.DEFAULT_APSIZE, help='Radius of disc summed when screening')
+parsearg.add_argument('--signif', type=float, default=multifind.DEFAULT_SIGNIF, help='Std devs above sky for disc sum when screening')
+
+resargs = vars(parsearg.parse_args())
+infilename = resargs['file'][0]
+remdefaults.getargs(resargs)
+searchpar.getargs(resargs)
+maxvar = resargs['variability']
+skylevstdp = resargs['skylevelstd']
+apsize = resargs['apsize']
+signif = resargs['signif']
+
+mydb, dbcurs = remdefaults.opendb()
+
+try:
+    fitsfile = remfits.parse_filearg(infilename, dbcurs)
+    fitsfile.calc_skylevel(skylevstdp)
+    findres = find_results.FindResults(fitsfile)
+except (remfits.RemFitsErr, find_results.FindResultErr) as e:
+    print("Cannot load", infilename, "error was", e.args[0], file=sys.stderr)
+    sys.exit(10)
+
+objlist = [obj for obj in skyregion.frame_region(dbcurs, fitsfile, maxvar).objects() if not obj.is_target()]
+pixlist = fitsfile.wcs.coords_to_pix([(obj.ra, obj.dec) for obj in objlist])
+inimage = [n for n, (pcol, prow) in enumerate(pixlist) if 0 <= pcol < fitsfile.ncolumns and 0 <= prow < fitsfile.nrows]
+objlist = [objlist[n] for n in inimage]
+pixlist = [tuple(pixlist[n]) for n in inimage]
+
+starttime = time.time()
+singles = []
+for obj, (pcol, prow) in zip(objlist, pixlist):
+    try:
+        singles.append(findres.find_object(prow, pcol, obj, searchpar))
+    except find_results.FindResultErr:
+        singles.append(None)
+singletime = time.time() - starttime
+
+starttime = time.time()
+screened = find_objects(findres, fitsfile, pixlist, objlist, searchpar, apsize=apsize, signif=signif)
+screentime = time.time() - starttime
+
+nobjs = len(objlist)
+nsingle = sum(1 for fr in singles if fr is not None)
+nscreened = sum(1 for fr in screened if fr is not None)
+print("{:<24s} {:>9s} {:>10s} {:>6s}".format("Method", "Time", "Objs/sec", "Found"))
+print("{:<24s} {:8.3f}s {:10.1f} {:6d}".format("find_object each", singletime, nobjs / max(singletime, 1e-6), nsingle))
+print("{:<24s} {:8.3f}s {:10.1f} {:6d}".format("screened", screentime, nobjs / max(screentime, 1e-6), nscreened))
+
+lost = 0
+for obj, single, scr in zip(objlist, singles, screened):
+    if single is None:
+        continue
+    if scr is None:
+        print("Lost", obj.dispname, "at ({:.2f},{:.2f})".format(single.col, single.row), file=sys.stderr)
+        lost += 1
+    elif single.col != scr.col or single.row != scr.row:
+        print("Moved", obj.dispname, "from ({:.2f},{:.2f}) to ({:.2f},{:.2f})".format(single.col, single.row, scr.col, scr.row), file=sys.stderr)
+        lost += 1
+
+if lost > 0:
+    print(lost, "objects differ, try lower --signif or larger --apsize", file=sys.stderr)
+    sys.exit(1)
@@ -4,12 +4,11 @@
 
 import argparse
 import sys
-import math
 import numpy as np
-from scipy.stats import linregress
 import remdefaults
 import objdata
 import col_from_file
+import ensemble
 
 def get_obj_by_label(dbcu, vic, lab):
     """Work out what the object is by the label"""
@@ -23,11 +22,6 @@ def get_obj_by_label(dbcu, vic, lab):
     res.get(dbcu, ind=r[0])
     return  res
 
-def combine_errors(f, x, y, xerr, yerr):
-    """Combine stds for things we are multiplying or dividing
-    return tuple of value and stddev"""
-    return (f, f * math.sqrt((xerr/x)**2+(yerr/y)**2))
-
 parsearg = argparse.ArgumentParser(description='Get object flux by linear regression from reference objects', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parsearg.add_argument('obsids', type=int, nargs='*', help='List of obs ids or use stdin')
 parsearg.add_argument('--colnum', type=int, default=0, help='Column number to take from standard input')
@@ -110,76 +104,49 @@ if len(targrows) == 0:
     print("No target rows to display", file=sys.stderr)
     sys.exit(20)
 
-targbrilu = dict()
-objindtobri = dict()
-resarray = []
-
-for bjdate, obsind, acttargadus, acttargaduerr, filt in targrows:
-
-    if acttargadus / acttargaduerr < minsnr:
-        continue
-
-    filtbri = filt + 'bri'
-    filtbrisd = filtbri + "sd"
+# Drop target results with too low SNR or in filters we have no brightness for
 
-    if filt in targbrilu:
-        targbri, targbrisd = targbrilu[filt]
+targrows = [r for r in targrows if r[2] / r[3] >= minsnr]
+targfilts = set()
+for filt in sorted(set(r[4] for r in targrows)):
+    if filt not in ensemble.FILTERS or getattr(targobj, filt + 'bri', None) is None or getattr(targobj, filt + 'brisd', None) is None:
+        print(target, "has no bri and brisd for filter",  filt, file=sys.stderr)
     else:
-        targbri = getattr(targobj, filt + 'bri', None)
-        targbrisd = getattr(targobj, filt + 'brisd', None)
-        if targbri is None or targbrisd is None:
-            print(target, "has no bri and brisd for filter",  filt, file=sys.stderr)
-            continue
-        targbrilu[filt] = (targbri, targbrisd)
-
-    mycu.execute("SELECT aducount,aduerr,objind FROM aducalc WHERE obsind={:d} AND objind!={:d}".format(obsind, targobj.objind))
-    refrows = mycu.fetchall()
-
-    if len(refrows) < minrefs:
-        continue
-
-    refresults = []
-
-    for aducount, aduerr, objind in refrows:
+        targfilts.add(filt)
+targrows = [r for r in targrows if r[4] in targfilts]
 
-        if objind in objindtobri:
-            bri, brisd = objindtobri[objind]
-        else:
-            mycu.execute("SELECT " + filtbri + "," + filtbrisd + " FROM objdata WHERE ind={:d}".format(objind))
-            try:
-                bri, brisd = mycu.fetchone()
-            except TypeError:
-                continue
-            objindtobri[objind] = (bri, brisd)
-
-        if bri is None or brisd is None:
-            continue
-
-        if aducount / aduerr < minsnr:
-            continue
-
-        refresults.append((aducount, aduerr, bri, brisd))
-
-    if  len(refresults) < minrefs:
-        continue
-
-    refresults = np.array(refresults).transpose()
-    actualvals, dummy, expectedvals, dummy = refresults
+resarray = []
 
-    # Now for linear regression rejecting if correlation is too small
+if len(targrows) != 0:
 
-    lreg = linregress(expectedvals, actualvals)
-    if lreg.rvalue ** 2 < mincorr:
-        continue
+    bjdates, obsinds, targadus, targaduerr, filts = zip(*targrows)
+    targadus = np.array(targadus, dtype=np.float64)
+    targaduerr = np.array(targaduerr, dtype=np.float64)
 
-    # Rescale actual value back to "expected" axis
+    # All reference results for all the observations in one query
 
-    scaledtargbri, scaledtargbrierr = \
-        combine_errors((acttargadus - lreg.intercept) / lreg.slope, acttargadus - lreg.intercept, lreg.slope,
-                       math.sqrt(acttargaduerr**2 + lreg.intercept_stderr**2),
-                       lreg.stderr)
+    mycu.execute("SELECT obsind,objind,aducount,aduerr FROM aducalc WHERE obsind IN ({:s}) AND objind!={:d}".format(",".join(map(str, obsinds)), targobj.objind))
+    refrows = mycu.fetchall()
 
-    resarray.append((bjdate, scaledtargbri, scaledtargbrierr))
+    if len(refrows) != 0:
+        refobsinds, refobjinds, refadus, referrs = zip(*refrows)
+        objinds = np.unique(refobjinds)
+        refadus, referrs = ensemble.dense_matrix(obsinds, objinds, refobsinds, refobjinds, refadus, referrs)
+
+        # Expected brightness of each reference object in the filter of each observation
+
+        mycu.execute("SELECT ind," + ",".join([f + 'bri,' + f + 'brisd' for f in ensemble.FILTERS]) +
+                     " FROM objdata WHERE ind IN ({:s})".format(",".join(map(str, objinds))))
+        brirows = mycu.fetchall()
+        brimat = np.full((objinds.size, 2 * len(ensemble.FILTERS)), np.nan)
+        if len(brirows) != 0:
+            brimat[np.searchsorted(objinds, [r[0] for r in brirows])] = [[np.nan if v is None else v for v in r[1:]] for r in brirows]
+        filtnum = np.array([ensemble.FILTERS.index(f) for f in filts])
+        refbri = brimat[:, 2 * filtnum].T
+        refbrisd = brimat[:, 2 * filtnum + 1].T
+
+        ok, scaled, scalederr = ensemble.lreg_fluxes(targadus, targaduerr, refadus, referrs, refbri, refbrisd, minrefs=minrefs, minsnr=minsnr, mincorr=mincorr)
+        resarray = [(bjdate, sc, scerr) for bjdate, sc, scerr, k in zip(bjdates, scaled, scalederr, ok) if k]
 
 if outfile is None:
     np.savetxt(sys.stdout, resarray)
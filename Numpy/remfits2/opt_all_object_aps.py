@@ -13,6 +13,7 @@ import miscutils
 import remdefaults
 import remfits
 import find_results
+import apphot
 
 matchname = re.compile('(\w+?)(\d+)$')
 
@@ -30,6 +31,7 @@ parsearg.add_argument('--shiftmax', type=int, default=4, help='Maxmimum shift of
 parsearg.add_argument('--maxap', type=int, default=20, help='Maximum aperture size to use')
 parsearg.add_argument('--minap', type=int, default=3, help='Minimum aperture size to use')
 parsearg.add_argument('--update', action='store_true', help='Update apperture in database')
+parsearg.add_argument('--recentreonce', action='store_true', help='Recentre once at the smallest aperture and get all sizes in one go rather than recentring for every size')
 parsearg.add_argument('--verbose', action='store_true', help='Give blow by blow account"')
 
 resargs = vars(parsearg.parse_args())
@@ -40,6 +42,7 @@ shiftmax = resargs['shiftmax']
 maxap = resargs['maxap']
 minap = resargs['minap']
 update = resargs['update']
+recentreonce = resargs['recentreonce']
 verbose = resargs['verbose']
 
 mydb, mycurs = remdefaults.opendb()
@@ -74,41 +77,69 @@ for ffile in flist:
     skylevel = imageff.meanval
     offsets = rstr.get_offsets_in_image()
 
+    if not recentreonce:
+        for r, offs in zip(rstr.results(), offsets):
+            col, row = offs
+            if col < 0 or row < 0:
+                continue
+            if len(r.name) == 0:
+                continue
+            if r.name not in apsizes:
+                apsizes[r.name] = []
+
+            prevextra = 0
+            cutoffap = 1000000
+            for ap in range(minap, maxap + 1):
+                col, row, aduc, npix = rstr.findbest_colrow(col, row, ap, shiftmax)
+                adus_sofar = aduc - npix * skylevel
+                pc = 100 * (adus_sofar - prevextra) / adus_sofar
+                prevextra = adus_sofar
+                if pc < cutoff and ap < cutoffap:
+                    cutoffap = ap
+
+            if cutoffap < 1000:
+                apsizes[r.name].append(cutoffap)
+        continue
+
+    # Recentre each object once at the smallest aperture and then get the growth curves for all of them in one go
+
+    names = []
+    cols = []
+    rows = []
     for r, offs in zip(rstr.results(), offsets):
         col, row = offs
         if col < 0 or row < 0:
             continue
         if len(r.name) == 0:
             continue
-        if r.name not in apsizes:
-            apsizes[r.name] = []
-
-        prevextra = 0
-        prevnpix = 0
-        aps = []
-        adus = []
-        extraaduav = []
-        cutoffap = 1000000
-        cutoffrow = cutoffcol = cutoffadu = -1
-        for ap in range(minap, maxap + 1):
-            optap = rstr.findbest_colrow(col, row, ap, shiftmax)
-            col, row, aduc, npix = optap
-            adus_sofar = aduc - npix * skylevel
-            xtra = adus_sofar - prevextra
-            pc = 100 * xtra / adus_sofar
-            prevextra = adus_sofar
-            prevnpix = npix
-            aps.append(ap)
-            adus.append(adus_sofar)
-            extraaduav.append(pc)
-            if pc < cutoff and ap < cutoffap:
-                cutoffap = ap
-                cutoffrow = row
-                cutoffcol = col
-                cutoffadu = aduc
-
-        if cutoffap < 1000:
-            apsizes[r.name].append(cutoffap)
+        names.append(r.name)
+        cols.append(col)
+        rows.append(row)
+
+    if len(names) == 0:
+        continue
+
+    cols, rows, sums, npix = apphot.findbest_many(apphot.integral_image(imageff), cols, rows, minap, shiftmax)
+
+    try:
+        curves = apphot.growth_curves(imageff.data, cols, rows, minap, maxap, skylevel)
+    except apphot.AppPhotErr as e:
+        print(ffile, e.args[0], file=sys.stderr)
+        continue
+
+    # Percentage extra from each increase in aperture size, the first compared with nothing as above
+
+    adus = curves['adus']
+    prevadus = np.zeros_like(adus)
+    prevadus[:, 1:] = adus[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pc = 100 * (adus - prevadus) / adus
+    below = pc < cutoff
+    for name, bel in zip(names, below):
+        if name not in apsizes:
+            apsizes[name] = []
+        if bel.any():
+            apsizes[name].append(minap + int(bel.argmax()))
 
 # DB might have gone away
 
@@ -0,0 +1,145 @@
+"""Local on-disk cache of results of SIMBAD and GAIA queries.
+
+Results are stored as VOTable files named by the SHA1 of the service, query,
+radius and epoch, with a small file alongside giving those in readable form.
+A query which found nothing is recorded as such so it is not repeated.
+
+The mode says how the cache is used:
+    live    always query the service and do not use the cache
+    record  always query the service and save the result
+    cache   use saved result if there is one, otherwise query and save
+    replay  only use saved results, failing if there isn't one, so scripts
+            can be run offline and always give the same results"""
+
+import os
+import os.path
+import tempfile
+import hashlib
+import json
+import numpy as np
+from astropy.table import Table
+
+DEFAULT_CACHEDIR = "~/.remquerycache"
+QUERY_MODES = ('live', 'record', 'cache', 'replay')
+
+NONE_SUFFIX = ".none"
+
+
+class QueryCacheErr(Exception):
+    """Throw if we have problems with the query cache"""
+
+
+def write_text(fname, text):
+    """Write text to file"""
+    with open(fname, "wt") as outf:
+        outf.write(text)
+
+
+class QueryCache:
+    """Cache of query results, counting hits and misses"""
+
+    def __init__(self, cachedir=DEFAULT_CACHEDIR, mode='cache'):
+        if mode not in QUERY_MODES:
+            raise QueryCacheErr("Unknown query cache mode " + mode)
+        self.cachedir = os.path.expanduser(cachedir)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        if mode != 'live':
+            try:
+                os.makedirs(self.cachedir, exist_ok=True)
+            except OSError as e:
+                raise QueryCacheErr("Cannot create cache directory " + self.cachedir + " error was " + e.strerror)
+
+    def _key(self, service, query, radius, epoch):
+        """Get readable key and hash for file name"""
+        key = json.dumps(dict(service=service, query=query, radius=radius, epoch=epoch), sort_keys=True)
+        return key, os.path.join(self.cachedir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _write(self, fname, writefn):
+        """Write file via temporary file and rename"""
+        fd, tmpname = tempfile.mkstemp(dir=self.cachedir)
+        os.close(fd)
+        try:
+            writefn(tmpname)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise QueryCacheErr("Cannot write cache file " + fname + " error was " + str(e))
+
+    def save(self, service, query, radius, epoch, result):
+        """Save result (which may be None) of query"""
+        key, base = self._key(service, query, radius, epoch)
+        self._write(base + ".json", lambda f: write_text(f, key))
+        if result is None:
+            self._write(base + NONE_SUFFIX, lambda f: write_text(f, ""))
+            try:
+                os.unlink(base + ".xml")
+            except FileNotFoundError:
+                pass
+        else:
+            self._write(base + ".xml", lambda f: result.write(f, format='votable', overwrite=True))
+            try:
+                os.unlink(base + NONE_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def load(self, service, query, radius, epoch):
+        """Load saved result of query.
+
+        Return (found, result) where result may be None if the query found nothing"""
+        key, base = self._key(service, query, radius, epoch)
+        if os.path.exists(base + NONE_SUFFIX):
+            return True, None
+        try:
+            return True, Table.read(base + ".xml", format='votable')
+        except FileNotFoundError:
+            return False, None
+        except (OSError, ValueError) as e:
+            raise QueryCacheErr("Cannot read cache file for " + key + " error was " + str(e))
+
+    def get(self, service, query, radius, epoch, fetch):
+        """Get result of query from cache or by calling fetch according to mode"""
+        if self.mode == 'live':
+            return fetch()
+        if self.mode != 'record':
+            found, result = self.load(service, query, radius, epoch)
+            if found:
+                self.hits += 1
+                return result
+            if self.mode == 'replay':
+                raise QueryCacheErr("No saved result for " + self._key(service, query, radius, epoch)[0])
+        self.misses += 1
+        result = fetch()
+        self.save(service, query, radius, epoch, result)
+        return result
+
+
+def parseargs(argp, defmode='live'):
+    """Add arguments for query cache to argument parser"""
+    argp.add_argument('--querycache', type=str, default=DEFAULT_CACHEDIR, help='Directory for cache of query results')
+    argp.add_argument('--querymode', type=str, default=defmode, choices=QUERY_MODES, help='Query live, record results, use cache or replay from cache only')
+
+
+def getargs(resargs):
+    """Get query cache from arguments"""
+    return QueryCache(resargs['querycache'], resargs['querymode'])
+
+
+def str_column(col):
+    """Get column as array of str whether it came back as bytes or str"""
+    vals = np.ma.asarray(col).filled('')
+    if vals.dtype.kind == 'S':
+        return np.char.decode(vals, 'utf-8')
+    return vals.astype(str)
+
+
+def float_column(col, tounit=None):
+    """Get column as float array with NaN for masked values, converted to tounit if given"""
+    vals = np.ma.asarray(col, dtype=np.float64).filled(np.nan)
+    if tounit is not None and getattr(col, 'unit', None) is not None:
+        vals = (vals * col.unit).to_value(tounit)
+    return vals
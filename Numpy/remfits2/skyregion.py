@@ -0,0 +1,244 @@
+"""Spatial index of objects on the sky and proper motion of many objects at once.
+
+The sky is divided into cells CELL_DEG on a side in RA and Dec, and the
+number of the cell containing each object kept in the skycell column of
+objdata, which is indexed, so the objects in a region are found with one
+query on a few ranges of cell numbers rather than by scanning the table.
+
+Proper motions for all the objects found and for any number of dates are
+done in a single call to SkyCoord.apply_space_motion.
+
+Anything inserting rows into objdata should set skycell from cell_index, or run
+make_skycells.py afterwards, as objects without it are not found."""
+
+import numpy as np
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+import objdata
+
+CELL_DEG = 0.5
+NRA_CELLS = int(round(360.0 / CELL_DEG))
+NDEC_CELLS = int(round(180.0 / CELL_DEG))
+
+DEFAULT_MARGIN = 0.1  # Degrees allowed for proper motion
+
+MAS_YR = u.mas / u.yr
+
+SKYCELL_COLUMN = "ALTER TABLE objdata ADD COLUMN skycell INT"
+SKYCELL_INDEX = "ALTER TABLE objdata ADD INDEX skycell_idx (skycell)"
+SKYCELL_UPDATE = "UPDATE objdata SET skycell=%s WHERE ind=%s"
+SKYCELL_NAME_UPDATE = "UPDATE objdata SET skycell=%s WHERE objname=%s"
+
+SKY_FIELDS = "ind,objname,dispname,vicinity,label,radeg,decdeg,rapm,decpm,dist,rv,apsize"
+
+
+class SkyRegionErr(Exception):
+    """Throw if we have problems with sky regions"""
+
+
+def cell_index(ra, dec):
+    """Get cell numbers for arrays of RA and Dec in degrees"""
+    ra = np.mod(np.asarray(ra, dtype=np.float64), 360.0)
+    dec = np.asarray(dec, dtype=np.float64)
+    racell = np.minimum((ra / CELL_DEG).astype(np.int64), NRA_CELLS - 1)
+    deccell = np.clip(((dec + 90.0) / CELL_DEG).astype(np.int64), 0, NDEC_CELLS - 1)
+    return deccell * NRA_CELLS + racell
+
+
+def ra_range(ras):
+    """Get minimum and maximum of RAs allowing for them straddling 0, in which case the minimum is negative"""
+    ras = np.mod(np.asarray(ras, dtype=np.float64), 360.0)
+    if ras.max() - ras.min() > 180.0:
+        ras = np.where(ras > 180.0, ras - 360.0, ras)
+    return ras.min(), ras.max()
+
+
+def region_cells(ras, decs, margin=DEFAULT_MARGIN):
+    """Get list of (first, last) ranges of cell numbers covering the region containing the given RAs
+    and Decs (e.g. corners of an image) with margin degrees all round"""
+    mindec = max(-90.0, min(decs) - margin)
+    maxdec = min(90.0, max(decs) + margin)
+    minra, maxra = ra_range(ras)
+    maxabsdec = max(abs(mindec), abs(maxdec))
+    if maxabsdec >= 89.0:
+        ramargin = 360.0
+    else:
+        ramargin = margin / np.cos(np.radians(maxabsdec))
+    minra -= ramargin
+    maxra += ramargin
+    if maxra - minra >= 360.0:
+        rapieces = [(0, NRA_CELLS - 1)]
+    else:
+        first = int(np.floor(minra / CELL_DEG)) % NRA_CELLS
+        last = int(np.floor(maxra / CELL_DEG)) % NRA_CELLS
+        if first <= last:
+            rapieces = [(first, last)]
+        else:
+            rapieces = [(first, NRA_CELLS - 1), (0, last)]
+    firstdec = int(cell_index(0.0, mindec) // NRA_CELLS)
+    lastdec = int(cell_index(0.0, maxdec) // NRA_CELLS)
+    ranges = []
+    for deccell in range(firstdec, lastdec + 1):
+        for first, last in rapieces:
+            ranges.append((deccell * NRA_CELLS + first, deccell * NRA_CELLS + last))
+    return ranges
+
+
+def propagate_pairs(ra, dec, rapm, decpm, dist, rv, dates, fromdate='J2000'):
+    """Apply proper motion to arrays of objects each to its own date in dates, all at once.
+
+    dist (light years) and rv (km/s) may be NaN where not known, in which case the
+    object is moved only by its proper motion as in the objpm table.
+
+    Return arrays of RA, Dec and distance, NaN where not known"""
+
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    rapm = np.nan_to_num(np.asarray(rapm, dtype=np.float64))
+    decpm = np.nan_to_num(np.asarray(decpm, dtype=np.float64))
+    dist = np.asarray(dist, dtype=np.float64)
+    rv = np.asarray(rv, dtype=np.float64)
+    resra = np.empty(ra.size)
+    resdec = np.empty(ra.size)
+    resdist = np.full(ra.size, np.nan)
+    if ra.size == 0:
+        return resra, resdec, resdist
+
+    # Objects with distance and radial velocity have to be done separately from ones without
+
+    newtimes = Time(list(dates))
+    full = np.isfinite(dist) & np.isfinite(rv)
+    for sel in (full, ~full):
+        if not sel.any():
+            continue
+        args = dict(ra=ra[sel] * u.deg, dec=dec[sel] * u.deg, obstime=Time(fromdate), pm_ra_cosdec=rapm[sel] * MAS_YR, pm_dec=decpm[sel] * MAS_YR)
+        if sel is full:
+            args['distance'] = dist[sel] * u.lightyear
+            args['radial_velocity'] = rv[sel] * u.km / u.second
+        spos = SkyCoord(**args).apply_space_motion(new_obstime=newtimes[sel])
+        resra[sel] = spos.ra.deg
+        resdec[sel] = spos.dec.deg
+        if sel is full:
+            resdist[sel] = spos.distance.lightyear
+    return resra, resdec, resdist
+
+
+def propagate(ra, dec, rapm, decpm, dist, rv, dates, fromdate='J2000'):
+    """Apply proper motion to arrays of objects for all the given dates at once.
+
+    Return RA and Dec arrays of shape (number of dates, number of objects)"""
+
+    nobjs = np.size(ra)
+    ndates = len(dates)
+    if ndates == 0 or nobjs == 0:
+        return np.empty((ndates, nobjs)), np.empty((ndates, nobjs))
+
+    # Each object repeated for each date so it can all go in one call
+
+    tiled = [np.tile(np.asarray(a, dtype=np.float64), ndates) for a in (ra, dec, rapm, decpm, dist, rv)]
+    newra, newdec, newdist = propagate_pairs(*tiled, np.repeat(np.asarray(dates), nobjs), fromdate)
+    return newra.reshape(ndates, nobjs), newdec.reshape(ndates, nobjs)
+
+
+class SkyObjects:
+    """Objects found in a region with arrays of their details and positions at the date asked for"""
+
+    def __init__(self, dbrows):
+        self.objinds = np.array([r[0] for r in dbrows], dtype=np.int64)
+        self.objnames = [r[1] for r in dbrows]
+        self.dispnames = [r[2] for r in dbrows]
+        self.vicinities = [r[3] for r in dbrows]
+        self.labels = [r[4] for r in dbrows]
+        cols = np.array([[np.nan if v is None else v for v in r[5:]] for r in dbrows], dtype=np.float64).reshape(-1, 7)
+        self.radeg, self.decdeg, self.rapm, self.decpm, self.dist, self.rv, self.apsize = cols.T
+        self.ra = self.radeg.copy()
+        self.dec = self.decdeg.copy()
+
+    def __len__(self):
+        return self.objinds.size
+
+    def select(self, mask):
+        """Keep only objects where mask is True"""
+        inds = np.flatnonzero(mask)
+        self.objinds = self.objinds[inds]
+        self.objnames = [self.objnames[i] for i in inds]
+        self.dispnames = [self.dispnames[i] for i in inds]
+        self.vicinities = [self.vicinities[i] for i in inds]
+        self.labels = [self.labels[i] for i in inds]
+        for attr in ('radeg', 'decdeg', 'rapm', 'decpm', 'dist', 'rv', 'apsize', 'ra', 'dec'):
+            setattr(self, attr, getattr(self, attr)[inds])
+
+    def objects(self):
+        """Get list of objdata.ObjData for the objects with ra and dec at the date asked for"""
+        result = []
+        for n in range(len(self)):
+            obj = objdata.ObjData(objname=self.objnames[n], dispname=self.dispnames[n])
+            obj.objind = int(self.objinds[n])
+            obj.vicinity = self.vicinities[n]
+            obj.label = self.labels[n]
+            obj.ra = float(self.ra[n])
+            obj.dec = float(self.dec[n])
+            for attr in ('rapm', 'decpm', 'dist', 'rv'):
+                val = getattr(self, attr)[n]
+                setattr(obj, attr, float(val) if np.isfinite(val) else None)
+            if np.isfinite(self.apsize[n]):
+                obj.apsize = float(self.apsize[n])
+            result.append(obj)
+        return result
+
+
+def set_object_cell(dbcurs, objname, ra, dec):
+    """Set skycell of object in objdata given by name from its RA and Dec"""
+    dbcurs.execute(SKYCELL_NAME_UPDATE, (int(cell_index(ra, dec)), objname))
+
+
+def get_sky_region(dbcurs, ras, decs, obsdate=None, margin=DEFAULT_MARGIN, vicinity=None, maxvar=None):
+    """Get objects within the region bounded by ras and decs (e.g. the corners of an image) in one query
+    using the skycell index, leaving out suppressed objects.
+
+    If vicinity is given, only objects in that vicinity are included, and if maxvar is given
+    only those with variability up to that.
+
+    If obsdate is given, positions are moved by proper motion to that date.
+
+    Return SkyObjects structure"""
+
+    ranges = region_cells(ras, decs, margin)
+    where = ["(" + " OR ".join(["skycell BETWEEN %s AND %s"] * len(ranges)) + ")", "suppress=0"]
+    params = [c for rng in ranges for c in rng]
+    if vicinity is not None:
+        where.append("vicinity=%s")
+        params.append(vicinity)
+    if maxvar is not None:
+        where.append("variability<=%s")
+        params.append(maxvar)
+    dbcurs.execute("SELECT " + SKY_FIELDS + " FROM objdata WHERE " + " AND ".join(where), params)
+    result = SkyObjects(dbcurs.fetchall())
+    if len(result) == 0:
+        return result
+
+    if obsdate is not None:
+        moving = (result.rapm != 0.0) | (result.decpm != 0.0)
+        moving &= np.isfinite(result.rapm) & np.isfinite(result.decpm)
+        if moving.any():
+            newra, newdec = propagate(result.radeg[moving], result.decdeg[moving], result.rapm[moving], result.decpm[moving],
+                                      result.dist[moving], result.rv[moving], [obsdate])
+            result.ra[moving] = newra[0]
+            result.dec[moving] = newdec[0]
+
+    minra, maxra = ra_range(ras)
+    ra = result.ra
+    if minra < 0.0:
+        ra = np.where(ra > 180.0, ra - 360.0, ra)
+    result.select((ra >= minra) & (ra <= maxra) & (result.dec >= min(decs)) & (result.dec <= max(decs)))
+    return result
+
+
+def frame_region(dbcurs, fitsfile, maxvar=None, margin=DEFAULT_MARGIN, vicinity=None):
+    """Get objects on the image in fitsfile at its date using corners given by its WCS
+
+    Return SkyObjects structure"""
+    nrows, ncols = fitsfile.data.shape
+    corners = fitsfile.wcs.pix_to_coords(((0, 0), (ncols - 1, 0), (0, nrows - 1), (ncols - 1, nrows - 1)))
+    return get_sky_region(dbcurs, [c[0] for c in corners], [c[1] for c in corners], fitsfile.date, margin, vicinity, maxvar)
@@ -0,0 +1,362 @@
+"""Tally of pixel statistics over the whole CCD held in a memory-mapped .npy file.
+
+The planes are counts, running means, running sums of squared deviations from
+the mean (as per Welford's algorithm), minima and maxima.
+
+The .npy file holds one record of a checkpoint generation number and the planes,
+which also marks it as being in this format rather than the old one of a plain
+array of counts, sums, sums of squares, minima and maxima, which has to be
+converted explicitly with convert_tally.
+
+Updates are made to the memory-mapped tally in place. Before a band of UNDO_ROWS
+rows is first changed after a checkpoint, its previous contents are appended to
+an undo file, so only the rows changed are copied. Alongside the tally is a
+journal file listing which files have been folded in, by fitsind, each with the
+generation of the checkpoint including it.
+
+At a checkpoint the tally is flushed, the journal entries written, then the new
+generation written to the tally and the undo file removed. Journal entries with
+later generations than the tally are ignored and an undo file for the tally's
+own generation is played back when it is next opened, so a crash at any point
+leaves the tally and journal agreeing and re-running over an overlapping list of
+files only adds the new ones."""
+
+import os
+import os.path
+import numpy as np
+
+TALLY_SHAPE = (5, 2048, 2048)
+COUNT_PLANE = 0
+MEAN_PLANE = 1
+M2_PLANE = 2
+MIN_PLANE = 3
+MAX_PLANE = 4
+
+INIT_MIN = 1e60
+INIT_MAX = -1e60
+
+GEN_FIELD = 'generation'
+PLANES_FIELD = 'planes'
+
+JOURNAL_SUFFIX = '.journal'
+WORK_SUFFIX = '.work'
+UNDO_SUFFIX = '.undo'
+JOURNAL_MARKER = '# welford generations'
+OLD_JOURNAL_MARKER = '# welford'
+
+CONVERT_ROWS = 256
+UNDO_ROWS = 64
+
+
+class TallyErr(Exception):
+    """Throw if we have problems with tally files"""
+
+
+def journal_file(fname):
+    """Get name of journal file corresponding to tally file"""
+    return fname + JOURNAL_SUFFIX
+
+
+def tally_dtype(shape):
+    """Get record type of tally file with planes of given shape"""
+    return np.dtype([(GEN_FIELD, np.int64), (PLANES_FIELD, np.float64, tuple(shape))])
+
+
+def load_tally(fname, mode='r'):
+    """Load tally file memory-mapped, returning the record array, which is None if in the old format,
+    and the plain array otherwise"""
+    try:
+        arr = np.load(fname, mmap_mode=mode)
+    except OSError as e:
+        raise TallyErr("Cannot open " + fname + " error was " + e.strerror)
+    except ValueError as e:
+        raise TallyErr("Cannot load " + fname + " error was " + e.args[0])
+    if arr.dtype.names is None:
+        return None, arr
+    if arr.dtype.names != (GEN_FIELD, PLANES_FIELD) or arr.shape != (1, ):
+        raise TallyErr("Tally file " + fname + " is not in expected format")
+    return arr, None
+
+
+def write_journal(jname, entries):
+    """Write journal from scratch with given list of (generation, fitsind) via temporary file"""
+    tmpname = jname + WORK_SUFFIX
+    try:
+        with open(tmpname, 'w') as jf:
+            print(JOURNAL_MARKER, file=jf)
+            for gen, name in entries:
+                print(gen, name, file=jf)
+            jf.flush()
+            os.fsync(jf.fileno())
+        os.replace(tmpname, jname)
+    except OSError as e:
+        raise TallyErr("Cannot write journal " + jname + " error was " + e.strerror)
+
+
+def read_journal(jname):
+    """Read journal, returning list of (generation, fitsind)"""
+    try:
+        with open(jname) as jf:
+            lines = jf.read().splitlines()
+    except OSError as e:
+        raise TallyErr("Cannot read journal " + jname + " error was " + e.strerror)
+    if len(lines) == 0 or lines[0] != JOURNAL_MARKER:
+        raise TallyErr("Journal " + jname + " is not in expected format")
+    entries = []
+    for line in lines[1:]:
+        try:
+            gen, name = line.split(' ', 1)
+            entries.append((int(gen), name))
+        except ValueError:
+            raise TallyErr("Journal " + jname + " has invalid line " + line)
+    return entries
+
+
+def read_undo(uname, generation):
+    """Read undo file, returning list of (band, saved planes) recorded since the checkpoint of
+    the given generation, empty if it is left from an earlier one, ignoring a partly-written last record"""
+    bands = []
+    try:
+        with open(uname, 'rb') as uf:
+            while True:
+                try:
+                    hdr = np.load(uf)
+                    saved = np.load(uf)
+                except (EOFError, ValueError):
+                    break
+                if int(hdr[0]) != generation:
+                    return []
+                bands.append((int(hdr[1]), saved))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        raise TallyErr("Cannot read undo file " + uname + " error was " + e.strerror)
+    return bands
+
+
+def band_rows(band):
+    """Get slice of rows for band of rows in undo file"""
+    return slice(band * UNDO_ROWS, (band + 1) * UNDO_ROWS)
+
+
+def convert_tally(fname):
+    """Convert old-style tally file to the current format in place via a working copy.
+
+    The planes of sums and sums of squares are converted to means and sums of squared deviations
+    unless there is a journal from the first version of the running tally saying they already are.
+
+    Return number of journal entries kept"""
+    rec, old = load_tally(fname)
+    if old is None:
+        raise TallyErr("Tally file " + fname + " is already in the current format")
+    if old.ndim != 3 or old.shape[0] != TALLY_SHAPE[0]:
+        raise TallyErr("Unexpected tally shape in " + fname + " found " + str(old.shape))
+    jname = journal_file(fname)
+    names = []
+    convert = True
+    if os.path.exists(jname):
+        try:
+            with open(jname) as jf:
+                lines = jf.read().splitlines()
+        except OSError as e:
+            raise TallyErr("Cannot read journal " + jname + " error was " + e.strerror)
+        if len(lines) != 0 and lines[0] == OLD_JOURNAL_MARKER:
+            convert = False
+            names = lines[1:]
+    workname = fname + WORK_SUFFIX
+    try:
+        work = np.lib.format.open_memmap(workname, mode='w+', dtype=tally_dtype(old.shape), shape=(1, ))
+        planes = work[PLANES_FIELD][0]
+        work[GEN_FIELD] = 0
+        for startrow in range(0, old.shape[1], CONVERT_ROWS):
+            rows = slice(startrow, startrow + CONVERT_ROWS)
+            cnts = np.array(old[COUNT_PLANE, rows])
+            planes[:, rows] = old[:, rows]
+            if convert:
+                means = np.where(cnts > 0, old[MEAN_PLANE, rows] / np.maximum(cnts, 1.0), 0.0)
+                planes[M2_PLANE, rows] = np.maximum(old[M2_PLANE, rows] - cnts * means ** 2, 0.0)
+                planes[MEAN_PLANE, rows] = means
+        work.flush()
+        del planes, work, old
+        write_journal(jname, [(0, name) for name in names])
+        os.replace(workname, fname)
+    except OSError as e:
+        raise TallyErr("Cannot convert " + fname + " error was " + e.strerror)
+    return len(names)
+
+
+class Tally:
+    """Tally file opened read-only or for updates in place"""
+
+    def __init__(self, fname, create=False, checkshape=True, readonly=False):
+        self.filename = fname
+        self.checkshape = checkshape
+        self.readonly = readonly
+        self.journalname = journal_file(fname)
+        self.undoname = fname + UNDO_SUFFIX
+        self.done = set()
+        self.pending = []
+        self.generation = 0
+        self.rec = None
+        self.tally = None
+        self.undo = None
+        self.saved = set()
+        if create:
+            self._create()
+        else:
+            self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _create(self):
+        """Create new empty tally and journal"""
+        workname = self.filename + WORK_SUFFIX
+        try:
+            work = np.lib.format.open_memmap(workname, mode='w+', dtype=tally_dtype(TALLY_SHAPE), shape=(1, ))
+            work[GEN_FIELD] = 0
+            planes = work[PLANES_FIELD][0]
+            planes[COUNT_PLANE:MIN_PLANE] = 0.0
+            planes[MIN_PLANE] = INIT_MIN
+            planes[MAX_PLANE] = INIT_MAX
+            work.flush()
+            del planes, work
+            write_journal(self.journalname, [])
+            try:
+                os.unlink(self.undoname)
+            except FileNotFoundError:
+                pass
+            os.replace(workname, self.filename)
+        except OSError as e:
+            raise TallyErr("Cannot create " + self.filename + " error was " + e.strerror)
+        self._open()
+
+    def _open(self):
+        """Open existing tally and load journal entries up to its generation, putting back rows
+        changed since then from the undo file, in memory only if read only"""
+        rec, old = load_tally(self.filename, 'r' if self.readonly else 'r+')
+        if rec is None:
+            raise TallyErr("Tally file " + self.filename + " is in the old format, convert it with maketally.py --convert")
+        planes = rec[PLANES_FIELD][0]
+        if planes.shape[0] != TALLY_SHAPE[0] or (self.checkshape and planes.shape != TALLY_SHAPE):
+            raise TallyErr("Unexpected tally shape in " + self.filename + " expected " + str(TALLY_SHAPE) + " found " + str(planes.shape))
+        self.generation = int(rec[GEN_FIELD][0])
+        bands = read_undo(self.undoname, self.generation)
+        if self.readonly and len(bands) != 0:
+            planes = np.array(planes)
+        for band, saved in reversed(bands):
+            planes[:, band_rows(band)] = saved
+        entries = read_journal(self.journalname)
+        current = [(gen, name) for gen, name in entries if gen <= self.generation]
+        self.done = set(name for gen, name in current)
+        self.rec = rec
+        self.tally = planes
+        if self.readonly:
+            return
+        rec.flush()
+        try:
+            os.unlink(self.undoname)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise TallyErr("Cannot remove undo file " + self.undoname + " error was " + e.strerror)
+        if len(current) != len(entries):
+            write_journal(self.journalname, current)
+
+    def _save_rows(self, startrow, endrow):
+        """Append previous contents of bands of rows not saved since the checkpoint to the undo file"""
+        bands = [b for b in range(startrow // UNDO_ROWS, (endrow - 1) // UNDO_ROWS + 1) if b not in self.saved]
+        if len(bands) == 0:
+            return
+        try:
+            if self.undo is None:
+                self.undo = open(self.undoname, 'wb')
+            for band in bands:
+                np.save(self.undo, np.array([self.generation, band], dtype=np.int64))
+                np.save(self.undo, np.array(self.tally[:, band_rows(band)]))
+            self.undo.flush()
+            os.fsync(self.undo.fileno())
+        except OSError as e:
+            raise TallyErr("Cannot write undo file " + self.undoname + " error was " + e.strerror)
+        self.saved.update(bands)
+
+    def already_done(self, name):
+        """Report whether file given by fitsind has been folded in already"""
+        return str(name) in self.done
+
+    def add(self, name, fdat, startx, starty):
+        """Fold in data from file with given fitsind at given position on CCD"""
+        if self.readonly:
+            raise TallyErr("Tally " + self.filename + " opened read only")
+        name = str(name)
+        if name in self.done:
+            return False
+        nrows, ncols = fdat.shape
+        endy = starty + nrows
+        endx = startx + ncols
+        if startx < 0 or starty < 0 or endy > self.tally.shape[1] or endx > self.tally.shape[2]:
+            raise TallyErr("Data from " + name + " at ({:d},{:d}) size {:d}x{:d} does not fit".format(startx, starty, ncols, nrows))
+        self._save_rows(starty, endy)
+        region = (slice(starty, endy), slice(startx, endx))
+        counts = self.tally[COUNT_PLANE][region]
+        means = self.tally[MEAN_PLANE][region]
+        m2 = self.tally[M2_PLANE][region]
+        counts += 1.0
+        delta = fdat - means
+        means += delta / counts
+        delta *= fdat - means
+        m2 += delta
+        np.minimum(self.tally[MIN_PLANE][region], fdat, out=self.tally[MIN_PLANE][region])
+        np.maximum(self.tally[MAX_PLANE][region], fdat, out=self.tally[MAX_PLANE][region])
+        self.done.add(name)
+        self.pending.append(name)
+        return True
+
+    def checkpoint(self):
+        """Flush the tally, journal the files added, then mark the tally with the next generation
+        and discard the undo file"""
+        if len(self.pending) == 0:
+            return
+        gen = self.generation + 1
+        try:
+            self.rec.flush()
+            with open(self.journalname, 'a') as jf:
+                for name in self.pending:
+                    print(gen, name, file=jf)
+                jf.flush()
+                os.fsync(jf.fileno())
+            self.rec[GEN_FIELD] = gen
+            self.rec.flush()
+            self.undo.close()
+            self.undo = None
+            os.unlink(self.undoname)
+        except OSError as e:
+            raise TallyErr("Cannot update " + self.filename + " error was " + e.strerror)
+        self.generation = gen
+        self.pending = []
+        self.saved = set()
+
+    def close(self):
+        """Checkpoint and finish with tally"""
+        if self.tally is None:
+            return
+        if not self.readonly:
+            self.checkpoint()
+        self.tally = None
+        self.rec = None
+
+    def mean_std(self):
+        """Return array of counts, means, std devs, minima and maxima with zeros where there
+        is no data in the same format as mean/std dev files"""
+        counts = np.array(self.tally[COUNT_PLANE])
+        msk = counts == 0
+        means = np.array(self.tally[MEAN_PLANE])
+        sdds = np.sqrt(self.tally[M2_PLANE] / np.maximum(counts, 1.0))
+        mins = np.array(self.tally[MIN_PLANE])
+        maxes = np.array(self.tally[MAX_PLANE])
+        for arr in (means, sdds, mins, maxes):
+            arr[msk] = 0.0
+        return np.array([counts, means, sdds, mins, maxes])
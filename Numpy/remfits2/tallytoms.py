@@ -7,6 +7,7 @@ import sys
 import os.path
 import miscutils
 import numpy as np
+import tallyfile
 import warnings
 
 # Cope with divisions by zero
@@ -37,29 +38,12 @@ if os.path.exists(outfile) and not force:
     sys.exit(10)
 
 try:
-    tally = np.load(tfile)
-except OSError as e:
-    print("Problem with file", tfile, "error was", e.args[1], file=sys.stderr)
+    with tallyfile.Tally(tfile, checkshape=not nocheck, readonly=True) as tally:
+        result = tally.mean_std()
+except tallyfile.TallyErr as e:
+    print("Problem with file", tfile, "error was", e.args[0], file=sys.stderr)
     sys.exit(11)
 
-if not nocheck and tally.shape != (5, 2048, 2048):
-    print("Expecting tally file", tfile, "to be 5x2048x2048", file=sys.stderr)
-    sys.exit(12)
-
-counts, sums, sumsq, mins, maxes = tally
-
-means = sums / counts
-vars = sumsq / counts - means ** 2
-msk = np.isnan(means)
-means[msk] = 0.0
-vars[msk] = 0.0
-mins[msk] = 0.0
-maxes[msk] = 0.0
-
-sdds = np.sqrt(vars)
-
-result = np.array([counts, means, sdds, mins, maxes])
-
 outf = open(outfile, "wb")
 np.save(outf, result)
 outf.close()
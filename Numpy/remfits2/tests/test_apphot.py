@@ -0,0 +1,66 @@
+"""Tests for vectorised aperture photometry and the integral image"""
+
+import numpy as np
+import pytest
+import apphot
+
+
+def brute_disc(data, row, col, radius):
+    rr, cc = np.mgrid[:data.shape[0], :data.shape[1]]
+    inside = ((rr - row) ** 2 + (cc - col) ** 2 <= radius * radius) & np.isfinite(data)
+    return data[inside].sum(), int(inside.sum())
+
+
+def test_default_weights_close_to_exact_area():
+    for radius in (2.0, 3.0, 6.5, 10.0):
+        area = apphot.overlap_weights([10.3], [20.7], [radius], int(radius) + 1).sum()
+        assert area == pytest.approx(np.pi * radius * radius, rel=0.015)
+
+
+def test_nsub_one_counts_pixel_centres():
+    data = np.random.default_rng(0).normal(100.0, 10.0, (60, 60))
+    data[30, 31] = np.nan
+    res = apphot.aperture_sums(data, [30.0, 12.0], [29.0, 50.0], [3, 5.5], nsub=1)
+    for n, (col, row) in enumerate(((30, 29), (12, 50))):
+        for m, radius in enumerate((3, 5.5)):
+            adus, npix = brute_disc(data, row, col, radius)
+            assert res['adus'][n, m] == pytest.approx(adus)
+            assert res['npix'][n, m] == npix
+
+
+def test_chunking_gives_same_results(monkeypatch):
+    rng = np.random.default_rng(1)
+    data = rng.normal(100.0, 10.0, (100, 100))
+    cols = rng.uniform(5, 95, 37)
+    rows = rng.uniform(5, 95, 37)
+    whole = apphot.aperture_sums(data, cols, rows, [2, 4, 6], 100.0)
+    monkeypatch.setattr(apphot, 'WEIGHTS_CHUNK_BYTES', 1)
+    chunked = apphot.aperture_sums(data, cols, rows, [2, 4, 6], 100.0)
+    for name in ('adus', 'aduerr', 'npix'):
+        np.testing.assert_allclose(chunked[name], whole[name])
+
+
+def test_errors_and_growth_curves():
+    data = np.full((40, 40), 5.0)
+    res = apphot.aperture_sums(data, [20.0], [20.0], [4], 4.0)
+    assert res['aduerr'][0, 0] == pytest.approx(2.0 * np.sqrt((apphot.overlap_weights([20.0], [20.0], [4], 5) ** 2).sum()))
+    curves = apphot.growth_curves(data, [20.0], [20.0], 2, 6, sky=5.0)
+    np.testing.assert_allclose(curves['adus'], 0.0, atol=1e-9)
+    with pytest.raises(apphot.AppPhotErr):
+        apphot.aperture_sums(data, [40.0], [0.0], [3])
+
+
+def test_integral_image_sums_and_best_centre():
+    data = np.random.default_rng(2).normal(0.0, 1.0, (50, 50))
+    data[9, 9] = np.nan
+    rr, cc = np.mgrid[:50, :50]
+    data += 500.0 * np.exp(-((rr - 25) ** 2 + (cc - 28) ** 2) / 4.5)
+    integ = apphot.IntegralImage(data)
+    sums, npix = integ.box_sums([10, 0], [10, 49], 2)
+    assert sums[0] == pytest.approx(np.nansum(data[8:13, 8:13]))
+    assert npix[0] == 24 and npix[1] == 9
+    for row, col, radius in ((10, 10, 3.5), (0, 0, 4), (25, 28, 2)):
+        s, n = integ.disc_sums(row, col, radius)
+        bs, bn = brute_disc(np.where(np.isfinite(data), data, np.nan), row, col, radius)
+        assert s == pytest.approx(bs) and n == bn
+    assert apphot.findbest_colrow(integ, 26, 23, 2, 4)[:2] == (28, 25)
@@ -0,0 +1,25 @@
+"""Tests for ensemble photometry regressions"""
+
+import numpy as np
+from scipy import stats
+import ensemble
+
+
+def test_masked_linregress_matches_linregress():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(10, 15, (20, 12))
+    y = 3.0 * x + rng.normal(0, 0.5, x.shape)
+    valid = rng.uniform(size=x.shape) > 0.2
+    results = ensemble.masked_linregress(x, y, valid)
+    for n in range(x.shape[0]):
+        lr = stats.linregress(x[n, valid[n]], y[n, valid[n]])
+        for got, want in zip(results, (lr.slope, lr.intercept, lr.rvalue, lr.stderr, lr.intercept_stderr)):
+            assert np.isclose(got[n], want)
+
+
+def test_lreg_fluxes_rejects_degenerate_observations():
+    refbri = np.array([[1, 2, 3, 4, 5, 6.], [3, 3, 3, 3, 3, 3.], [1, 2, 3, 4, 5, 6.], [1, 2, 3, 4, 5, 6.]])
+    refadus = np.array([[10, 20, 30, 40, 50, 61.], [10, 20, 30, 40, 50, 60.], [5, 5, 5, 5, 5, 5.], [10, 60, 20, 50, 30, 40.]])
+    ok, scaled, scalederr = ensemble.lreg_fluxes(np.full(4, 35.0), np.ones(4), refadus, np.ones_like(refadus), refbri, np.ones_like(refbri))
+    assert ok.tolist() == [True, False, False, False]
+    assert np.isclose(scaled[0], 3.5, atol=0.05)
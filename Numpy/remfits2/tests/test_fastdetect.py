@@ -0,0 +1,80 @@
+"""Tests for whole-image detection against synthetic frames and the library search"""
+
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import fastdetect
+
+SKY = 100.0
+SKYSTD = 5.0
+STARS = ((40.3, 50.6, 40000.0), (120.0, 30.2, 20000.0), (200.7, 210.1, 8000.0), (100.4, 180.8, 30000.0), (128.0, 134.0, 30000.0))
+
+
+def star_frame(seed=0, shape=(256, 256), stars=STARS, sigma=1.5):
+    data = np.random.default_rng(seed).normal(SKY, SKYSTD, shape)
+    rr, cc = np.mgrid[:shape[0], :shape[1]]
+    for row, col, total in stars:
+        data += total * np.exp(-((rr - row) ** 2 + (cc - col) ** 2) / (2 * sigma ** 2)) / (2 * np.pi * sigma ** 2)
+    return data
+
+
+def test_detect_finds_each_star_with_fields():
+    dets = fastdetect.detect(star_frame(), sign=10.0, apsize=6)
+    assert len(dets) == len(STARS)
+    assert np.all(np.diff(dets.adus) <= 0)
+    for row, col, total in STARS:
+        n = np.argmin(np.hypot(dets.row - row, dets.col - col))
+        assert abs(dets.row[n] - row) < 0.1 and abs(dets.col[n] - col) < 0.1
+        assert dets.adus[n] == pytest.approx(total, rel=0.05)
+        assert dets.sigma[n] == pytest.approx(1.5, rel=0.1)
+        assert dets.modadus[n] == pytest.approx(total, rel=0.1)
+        assert dets.ampstd[n] == pytest.approx(SKYSTD, rel=0.1)
+        assert 0.0 < dets.xoffstd[n] < 0.1
+
+
+def test_detect_keeps_close_companions():
+    stars = ((100.0, 100.0, 40000.0), (100.0, 106.0, 20000.0))
+    dets = fastdetect.detect(star_frame(1, stars=stars), sign=10.0, apsize=6)
+    assert len(dets) == 2
+    assert dets.col[0] < 103.0 < dets.col[1]
+    assert np.all(np.abs(dets.row - 100.0) < 0.5)
+
+
+def test_detect_ignores_edges_and_noise():
+    data = star_frame(2, stars=((3.0, 128.0, 40000.0), ))
+    assert len(fastdetect.detect(data, ignbottom=10)) == 0
+    assert len(fastdetect.detect(data)) == 1
+    assert len(fastdetect.detect(star_frame(3, stars=()))) == 0
+    with pytest.raises(fastdetect.FastDetectErr):
+        fastdetect.detect(data, ignleft=128, ignright=128)
+
+
+def test_set_result_fills_find_result_fields():
+    dets = fastdetect.detect(star_frame(), apsize=6)
+    wcs = SimpleNamespace(colrow_to_coords=lambda col, row: (col / 100.0, row / 100.0))
+    fr = fastdetect.set_result(SimpleNamespace(), dets, 0, wcs)
+    for name in fastdetect.RESULT_FIELDS:
+        assert getattr(fr, name) == getattr(dets, name)[0]
+    assert fr.rdiff == 0.0 and fr.cdiff == 0.0 and fr.apsize == 6
+    assert fr.radeg == fr.col / 100.0 and fr.decdeg == fr.row / 100.0
+
+
+def test_engines_agree_on_synthetic_frame(tmp_path):
+    fits = pytest.importorskip("astropy.io.fits")
+    find_results = pytest.importorskip("find_results")
+    remfits = pytest.importorskip("remfits")
+    fname = str(tmp_path / "synth.fits")
+    fits.PrimaryHDU(star_frame().astype(np.float32)).writeto(fname)
+
+    libfile = remfits.parse_filearg(fname, None)
+    librstr = find_results.FindResults(libfile)
+    nlib = librstr.findfast(sign=10.0, apsize=6, totsign=1.0)
+    dets = fastdetect.detect(remfits.parse_filearg(fname, None).data, sign=10.0, apsize=6, totsign=1.0)
+    assert nlib == len(dets)
+    for lib in librstr.resultlist:
+        n = np.argmin(np.hypot(dets.row - lib.row, dets.col - lib.col))
+        assert abs(dets.row[n] - lib.row) < 0.5 and abs(dets.col[n] - lib.col) < 0.5
+        assert dets.adus[n] == pytest.approx(lib.adus, rel=0.05)
+        fr = fastdetect.set_result(find_results.FindResult(), dets, n)
+        for name in ('amp', 'sigma', 'modadus'):
+            assert getattr(fr, name) == pytest.approx(getattr(lib, name), rel=0.2)
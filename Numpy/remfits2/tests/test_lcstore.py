@@ -0,0 +1,78 @@
+"""Tests for the light curve store"""
+
+import datetime
+import numpy as np
+import pytest
+import lcstore
+
+
+class FakeCursor:
+    """Stands in for a database cursor, answering the obsind and row queries from lists,
+    rows given as (row, hide) pairs being hidden find results"""
+
+    def __init__(self, obsinds, rows):
+        self.obsinds = obsinds
+        self.rows = [r if len(r) == 2 else (r, 0) for r in rows]
+        self.queries = []
+        self.result = []
+
+    def execute(self, query, params):
+        self.queries.append(query)
+        if query == lcstore.OBSINDS_QUERY:
+            self.result = [(o, ) for o in self.obsinds]
+        else:
+            wanted = set(params)
+            self.result = [r for r, hide in self.rows if r[3] in wanted and (hide == 0 or "findresult.hide=0" not in query)]
+
+    def fetchall(self):
+        return self.result
+
+
+def db_row(objind, filt, obsind, adus, apsize=5.5):
+    return (objind, filt, 2459000.0 + obsind / 100.0, obsind, datetime.datetime(2020, 1, 1, 0, obsind), adus, 1.0, 100.0, 5.0, apsize)
+
+
+def test_rows_query_joins_through_findresult():
+    query = lcstore.ROWS_QUERY
+    assert "findresult.ind=aducalc.frind" in query
+    assert "obsinf.obsind=findresult.obsind" in query
+    assert query.startswith("SELECT findresult.objind,")
+    assert "findresult.hide=0" in query
+
+
+def test_hidden_find_results_left_out(tmp_path):
+    rows = [db_row(1, 'g', 1, 10.0), (db_row(2, 'g', 1, 20.0), 1), db_row(1, 'g', 2, 30.0), (db_row(2, 'g', 2, 40.0), 0)]
+    assert lcstore.update(FakeCursor([1, 2], rows), "v", storedir=str(tmp_path)) == 2
+    table = lcstore.load("v", str(tmp_path))
+    assert list(zip(table['objind'], table['obsind'])) == [(1, 1), (1, 2), (2, 2)]
+
+
+def test_fetch_rows_keeps_fractional_apsize_and_nulls():
+    curs = FakeCursor([], [db_row(1, 'g', 3, 1000.0, 6.25), db_row(2, 'r', 3, None, None)])
+    rows = lcstore.fetch_rows(curs, [3])
+    assert rows.dtype['apsize'] == np.float64
+    assert rows['apsize'][0] == 6.25
+    assert np.isnan(rows['apsize'][1]) and np.isnan(rows['adus'][1])
+
+
+def test_update_adds_new_drops_rejected_and_sorts(tmp_path):
+    storedir = str(tmp_path)
+    rows = [db_row(2, 'g', 1, 10.0), db_row(1, 'r', 1, 20.0), db_row(1, 'g', 2, 30.0), db_row(1, 'g', 1, 40.0)]
+    assert lcstore.update(FakeCursor([1, 2], rows), "BD+20 1790", storedir=storedir) == 2
+    table = lcstore.load("BD+20 1790", storedir)
+    assert list(zip(table['objind'], table['filter'], table['obsind'])) == [(1, 'g', 1), (1, 'g', 2), (1, 'r', 1), (2, 'g', 1)]
+
+    curs = FakeCursor([2, 3], rows + [db_row(1, 'g', 3, 50.0)])
+    assert lcstore.update(curs, "BD+20 1790", storedir=storedir) == 1
+    table = lcstore.load("BD+20 1790", storedir)
+    assert sorted(set(table['obsind'].tolist())) == [2, 3]
+    np.testing.assert_array_equal(lcstore.object_rows(table, 1, 'g')['obsind'], [2, 3])
+    assert lcstore.update(curs, "BD+20 1790", storedir=storedir) == 0
+
+
+def test_load_rejects_old_format(tmp_path):
+    old = np.zeros(1, dtype=[(n, np.int32 if n == 'apsize' else t) for n, t in
+                             ((n, lcstore.LC_DTYPE.fields[n][0]) for n in lcstore.LC_DTYPE.names)])
+    np.save(lcstore.store_file(str(tmp_path), "v"), old)
+    with pytest.raises(lcstore.LcStoreErr):
+        lcstore.load("v", str(tmp_path))
@@ -0,0 +1,74 @@
+"""Tests for screening many predicted positions at once"""
+
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import multifind
+
+SKY = 100.0
+SKYSTD = 10.0
+
+
+def noise_image(seed=0, shape=(256, 256)):
+    return np.random.default_rng(seed).normal(SKY, SKYSTD, shape)
+
+
+def add_star(data, row, col, total, sigma=1.5):
+    rr, cc = np.mgrid[:data.shape[0], :data.shape[1]]
+    data += total * np.exp(-((rr - row) ** 2 + (cc - col) ** 2) / (2 * sigma ** 2)) / (2 * np.pi * sigma ** 2)
+
+
+def test_cut_windows_pads_with_nan():
+    data = np.arange(100, dtype=np.float64).reshape(10, 10)
+    wins = multifind.cut_windows(data, [5, 0], [5, 9], 2)
+    np.testing.assert_array_equal(wins[0], data[3:8, 3:8])
+    assert np.all(np.isnan(wins[1][:2])) and np.all(np.isnan(wins[1][:, 3:]))
+    np.testing.assert_array_equal(wins[1][2:, :3], data[:3, 7:])
+    with pytest.raises(multifind.MultiFindErr):
+        multifind.cut_windows(data, [10], [0], 2)
+
+
+def test_shifted_disc_sums_match_brute_force():
+    data = noise_image(1, (40, 40))
+    data[3, 4] = np.nan
+    rows = np.array([5, 20, 36])
+    cols = np.array([4, 20, 30])
+    maxshift, apsize = 3, 2.5
+    sums, npix = multifind.shifted_disc_sums(data, rows, cols, maxshift, apsize)
+    rr, cc = np.mgrid[:40, :40]
+    for n in range(rows.size):
+        for i, dr in enumerate(range(-maxshift, maxshift + 1)):
+            for j, dc in enumerate(range(-maxshift, maxshift + 1)):
+                inside = ((rr - rows[n] - dr) ** 2 + (cc - cols[n] - dc) ** 2 <= apsize ** 2) & np.isfinite(data)
+                assert sums[n, i, j] == pytest.approx(data[inside].sum())
+                assert npix[n, i, j] == inside.sum()
+
+
+def test_noise_positions_screened_out():
+    data = noise_image(2, (1024, 1024))
+    rng = np.random.default_rng(3)
+    rows = rng.uniform(0, 1023, 5000)
+    cols = rng.uniform(0, 1023, 5000)
+    assert not multifind.screen(data, rows, cols, SKY, SKYSTD).any()
+
+
+def test_stars_within_shift_found():
+    data = noise_image(4)
+    add_star(data, 50.0, 60.0, 2000.0)
+    add_star(data, 150.0, 160.0, 2000.0)
+    found = multifind.screen(data, [52.4, 150, 150], [62.6, 160, 170], SKY, SKYSTD, maxshift=4)
+    assert found.tolist() == [True, True, False]
+
+
+def test_file_sky_level_used():
+    data = noise_image(5) + 1000.0
+    fitsfile = SimpleNamespace(data=data, meanval=SKY + 1000.0, stdval=SKYSTD)
+    assert not multifind.prescreen(fitsfile, [(100.0, 100.0), (30.0, 200.0)], 4).any()
+    fitsfile.meanval = SKY
+    assert multifind.prescreen(fitsfile, [(100.0, 100.0), (30.0, 200.0)], 4).all()
+    assert multifind.prescreen(fitsfile, [], 4).size == 0
+
+
+def test_search_shift_from_search_parameters():
+    assert multifind.search_shift(SimpleNamespace(maxshift=7)) == 7
+    assert multifind.search_shift(SimpleNamespace()) == multifind.DEFAULT_MAXSHIFT
@@ -0,0 +1,72 @@
+"""Tests for the query cache, mostly replaying saved results"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("astropy")
+from astropy.table import Table, MaskedColumn
+import astropy.units as u
+import querycache
+
+QUERY = ("simbad", "region(ICRS 101.28 -16.71)", 0.1, "J2016.0")
+
+
+def sample_table():
+    return Table(dict(main_id=[b"Sirius", b"Sirius B"], ra=[101.287, 101.289] * u.deg,
+                      pmra=MaskedColumn([-546.0, 0.0], mask=[False, True], unit=u.mas / u.yr)))
+
+
+class Fetcher:
+    """Counts calls, returning the given result"""
+
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.result
+
+
+def test_record_then_replay_gives_same_table(tmp_path):
+    fetch = Fetcher(sample_table())
+    rec = querycache.QueryCache(str(tmp_path), 'record')
+    rec.get(*QUERY, fetch)
+    rec.get(*QUERY, fetch)
+    assert fetch.calls == 2 and rec.misses == 2
+
+    rep = querycache.QueryCache(str(tmp_path), 'replay')
+    result = rep.get(*QUERY, Fetcher(None))
+    assert rep.hits == 1 and rep.misses == 0
+    assert querycache.str_column(result['main_id']).tolist() == ["Sirius", "Sirius B"]
+    np.testing.assert_allclose(querycache.float_column(result['ra']), [101.287, 101.289])
+    pmra = querycache.float_column(result['pmra'], u.arcsec / u.yr)
+    assert pmra[0] == pytest.approx(-0.546) and np.isnan(pmra[1])
+
+
+def test_replay_misses_and_empty_results(tmp_path):
+    rep = querycache.QueryCache(str(tmp_path), 'replay')
+    with pytest.raises(querycache.QueryCacheErr):
+        rep.get(*QUERY, Fetcher(sample_table()))
+
+    cache = querycache.QueryCache(str(tmp_path), 'cache')
+    fetch = Fetcher(None)
+    assert cache.get(*QUERY, fetch) is None
+    assert cache.get(*QUERY, fetch) is None
+    assert fetch.calls == 1 and cache.hits == 1
+    assert rep.get(*QUERY, Fetcher(sample_table())) is None
+
+    other = QUERY[:3] + ("J2000.0", )
+    with pytest.raises(querycache.QueryCacheErr):
+        rep.get(*other, Fetcher(None))
+
+
+def test_live_does_not_touch_cache(tmp_path):
+    live = querycache.QueryCache(str(tmp_path / "unused"), 'live')
+    fetch = Fetcher(sample_table())
+    live.get(*QUERY, fetch)
+    live.get(*QUERY, fetch)
+    assert fetch.calls == 2
+    assert not (tmp_path / "unused").exists()
+    with pytest.raises(querycache.QueryCacheErr):
+        querycache.QueryCache(str(tmp_path), 'offline')
@@ -0,0 +1,46 @@
+"""Tests for sky cells and proper motion of many objects at once"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("astropy")
+pytest.importorskip("objdata")
+import skyregion
+
+
+def test_cell_index_and_region_cells_wrap_at_zero():
+    cells = skyregion.cell_index([359.9, 0.1, 180.0], [0.0, 0.0, -90.0])
+    assert cells[0] % skyregion.NRA_CELLS == skyregion.NRA_CELLS - 1
+    assert cells[1] % skyregion.NRA_CELLS == 0
+    assert cells[2] == skyregion.NRA_CELLS // 2
+    ranges = skyregion.region_cells([359.8, 0.2], [10.0, 10.2], margin=0.0)
+    for cell in skyregion.cell_index([359.9, 0.1], [10.1, 10.1]):
+        assert any(first <= cell <= last for first, last in ranges)
+
+
+def test_propagate_grid_matches_pairs():
+    ra = [101.287, 269.452]
+    dec = [-16.716, 4.693]
+    rapm = [-546.0, -801.6]
+    decpm = [-1223.1, 10362.5]
+    dist = [8.6, np.nan]
+    rv = [-5.5, np.nan]
+    dates = ['2020-01-01', '2024-06-30']
+    gridra, griddec = skyregion.propagate(ra, dec, rapm, decpm, dist, rv, dates)
+    assert gridra.shape == (2, 2)
+    for d, date in enumerate(dates):
+        pra, pdec, pdist = skyregion.propagate_pairs(ra, dec, rapm, decpm, dist, rv, [date, date])
+        np.testing.assert_allclose(gridra[d], pra)
+        np.testing.assert_allclose(griddec[d], pdec)
+        assert np.isfinite(pdist[0]) and np.isnan(pdist[1])
+    assert griddec[1, 1] - griddec[0, 1] == pytest.approx(10.3625 * 4.5 / 3600.0, rel=0.01)
+
+
+def test_objects_keep_fractional_apsize():
+    rows = [(1, 'Star A', 'Star A', None, None, 10.0, 20.0, None, None, None, None, 5.5),
+            (2, 'Star B', 'Star B', 'Field', 'B', 10.1, 20.1, 1.5, -2.0, 12.0, 3.0, None)]
+    objs = skyregion.SkyObjects(rows).objects()
+    assert objs[0].apsize == 5.5
+    assert objs[0].rapm is None
+    assert objs[1].rapm == 1.5 and objs[1].dist == 12.0
+    assert objs[1].ra == 10.1 and objs[1].objind == 2
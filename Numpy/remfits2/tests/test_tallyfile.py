@@ -0,0 +1,159 @@
+"""Tests for tally files updated in place with an undo file and journal"""
+
+import os
+import numpy as np
+import pytest
+import tallyfile
+
+SHAPE = (5, 16, 16)
+
+
+@pytest.fixture
+def tallyfn(tmp_path, monkeypatch):
+    monkeypatch.setattr(tallyfile, 'TALLY_SHAPE', SHAPE)
+    return str(tmp_path / "tally.npy")
+
+
+def frames(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.normal(1000000.0, 3.0, size=(n, ) + SHAPE[1:])
+
+
+def test_mean_std_matches_numpy(tallyfn):
+    data = frames(7)
+    with tallyfile.Tally(tallyfn, create=True) as tally:
+        for n, fdat in enumerate(data):
+            tally.add(100 + n, fdat, 0, 0)
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        counts, means, sdds, mins, maxes = tally.mean_std()
+    assert np.all(counts == 7)
+    np.testing.assert_allclose(means, data.mean(axis=0), rtol=1e-14)
+    np.testing.assert_allclose(sdds, data.std(axis=0), rtol=1e-9)
+    np.testing.assert_array_equal(mins, data.min(axis=0))
+    np.testing.assert_array_equal(maxes, data.max(axis=0))
+    assert not os.path.exists(tallyfn + tallyfile.WORK_SUFFIX)
+    assert not os.path.exists(tallyfn + tallyfile.UNDO_SUFFIX)
+
+
+def test_rerun_skips_files_done(tallyfn):
+    data = frames(4)
+    with tallyfile.Tally(tallyfn, create=True) as tally:
+        for n in range(3):
+            tally.add(100 + n, data[n], 0, 0)
+    with tallyfile.Tally(tallyfn) as tally:
+        assert tally.already_done(101)
+        assert not tally.add(101, data[1], 0, 0)
+        assert tally.add(103, data[3], 0, 0)
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        result = tally.mean_std()
+    assert np.all(result[0] == 4)
+    np.testing.assert_allclose(result[1], data.mean(axis=0), rtol=1e-14)
+
+
+def test_updates_not_checkpointed_are_lost_not_doubled(tallyfn):
+    data = frames(3)
+    with tallyfile.Tally(tallyfn, create=True) as tally:
+        tally.add(100, data[0], 0, 0)
+    tally = tallyfile.Tally(tallyfn)
+    tally.add(101, data[1], 0, 0)
+    tally.rec.flush()
+
+    # Crash before checkpoint with the changes on disk, which the undo file puts back
+
+    del tally
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        np.testing.assert_array_equal(tally.mean_std()[0], 1.0)
+    assert os.path.exists(tallyfn + tallyfile.UNDO_SUFFIX)
+    with tallyfile.Tally(tallyfn) as tally:
+        assert not tally.already_done(101)
+        assert tally.add(101, data[1], 0, 0)
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        np.testing.assert_array_equal(tally.mean_std()[0], 2.0)
+
+
+def test_journal_entries_after_tally_generation_ignored(tallyfn):
+    data = frames(2)
+    with tallyfile.Tally(tallyfn, create=True) as tally:
+        tally.add(100, data[0], 0, 0)
+    gen = tally.generation
+
+    # Crash after journalling before the rename
+
+    with open(tallyfile.journal_file(tallyfn), 'a') as jf:
+        print(gen + 1, 101, file=jf)
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        assert not tally.already_done(101)
+    with tallyfile.Tally(tallyfn) as tally:
+        assert tally.add(101, data[1], 0, 0)
+    entries = tallyfile.read_journal(tallyfile.journal_file(tallyfn))
+    assert entries == [(1, '100'), (2, '101')]
+
+
+def test_only_changed_rows_saved_and_stale_undo_ignored(tallyfn, monkeypatch):
+    monkeypatch.setattr(tallyfile, 'UNDO_ROWS', 4)
+    data = frames(2)
+    with tallyfile.Tally(tallyfn, create=True) as tally:
+        tally.add(100, data[0], 0, 0)
+    with tallyfile.Tally(tallyfn) as tally:
+        tally.add(101, data[1][:3, :5], 2, 6)
+        assert tally.saved == {1, 2}
+        before = tally.mean_std()
+
+    # Crash after the new generation is written but before the undo file is removed
+
+    gen = tally.generation
+    with open(tallyfn + tallyfile.UNDO_SUFFIX, 'wb') as uf:
+        np.save(uf, np.array([gen - 1, 0], dtype=np.int64))
+        np.save(uf, np.zeros((5, 4, 16)))
+    with tallyfile.Tally(tallyfn) as tally:
+        np.testing.assert_array_equal(tally.mean_std(), before)
+    assert not os.path.exists(tallyfn + tallyfile.UNDO_SUFFIX)
+
+
+def write_old(tallyfn, data):
+    np.save(tallyfn, np.array([np.full(SHAPE[1:], float(len(data))), data.sum(axis=0), (data ** 2).sum(axis=0), data.min(axis=0), data.max(axis=0)]))
+
+
+def test_old_format_not_converted_on_read(tallyfn):
+    data = frames(5)
+    write_old(tallyfn, data)
+    before = open(tallyfn, 'rb').read()
+    with pytest.raises(tallyfile.TallyErr):
+        tallyfile.Tally(tallyfn, readonly=True)
+    with pytest.raises(tallyfile.TallyErr):
+        tallyfile.Tally(tallyfn)
+    assert open(tallyfn, 'rb').read() == before
+    assert not os.path.exists(tallyfile.journal_file(tallyfn))
+
+
+def test_convert_old_format(tallyfn):
+    data = frames(5)
+    write_old(tallyfn, data)
+    tallyfile.convert_tally(tallyfn)
+    with pytest.raises(tallyfile.TallyErr):
+        tallyfile.convert_tally(tallyfn)
+
+    # Deleting the journal must not convert again
+
+    os.unlink(tallyfile.journal_file(tallyfn))
+    with pytest.raises(tallyfile.TallyErr):
+        tallyfile.Tally(tallyfn, readonly=True)
+    tallyfile.write_journal(tallyfile.journal_file(tallyfn), [])
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        counts, means, sdds, mins, maxes = tally.mean_std()
+    np.testing.assert_allclose(means, data.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(sdds, data.std(axis=0), rtol=0.1)
+
+
+def test_convert_first_running_version(tallyfn):
+    data = frames(3)
+    np.save(tallyfn, np.array([np.full(SHAPE[1:], 3.0), data.mean(axis=0), data.var(axis=0) * 3, data.min(axis=0), data.max(axis=0)]))
+    with open(tallyfile.journal_file(tallyfn), 'w') as jf:
+        print(tallyfile.OLD_JOURNAL_MARKER, file=jf)
+        print("200", file=jf)
+    assert tallyfile.convert_tally(tallyfn) == 1
+    with tallyfile.Tally(tallyfn, readonly=True) as tally:
+        assert tally.already_done(200)
+        result = tally.mean_std()
+    np.testing.assert_allclose(result[1], data.mean(axis=0), rtol=1e-14)
+    np.testing.assert_allclose(result[2], data.std(axis=0), rtol=1e-9)